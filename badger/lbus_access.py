@@ -1,21 +1,25 @@
 '''
 Access to Packet Badger's localbus gateway
+
+Packet encoding, decoding and exchange are leep.transport, shared with
+leep, so projects/common must be on the path, eg.
+
+$ PYTHONPATH=projects/common python3 badger/lbus_access.py -a 192.168.7.4 reg 327686
 '''
-# mostly cribbed from FEED/src/python/leep/
 import argparse
-import socket
 import numpy
-import random
 import ast
-# import binascii
-be32 = numpy.dtype('>u4')
+
+from leep.transport import Transport, be32
 
 
 class lbus_access:
-    def __init__(self, host, timeout=1.02, port=803, force_burst=False, allow_burst=True):
+    def __init__(self, host, timeout=1.02, port=803, force_burst=False, allow_burst=True, retries=2):
         self.dest = (host, int(port))
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-        self.sock.settimeout(timeout)
+        # stop-and-wait.  Lost reads are retransmitted after an adaptive
+        # timeout, writes (eg. to I2C and SPI FIFOs) are never repeated
+        self.transport = Transport(self.dest, timeout=timeout, retries=retries)
+        self.sock = self.transport.sock
         if force_burst:
             self.burst_avail = True
         elif allow_burst:
@@ -26,142 +30,28 @@ class lbus_access:
     def _burst_avail(self,):
         """Determines if device supports block-transfer/repeat-count
         """
-        # TODO: Extract device capabilities automatically
-        dev_burst_en = False
-
-        # Ugly, noisy, fragile, and invasive PoC
-        msg = numpy.zeros(14, dtype=be32)
-        msg[0] = random.randint(0, 0xffffffff)
-        msg[1] = msg[0] ^ 0xffffffff
-        msg[2] = 0x10000002  # read 2
-        msg[3] = 0xa5a5a5a5  # pad
-        msg[4] = 0x10000001  # read 1
-        msg[5] = 0xa5a5a5a5  # pad
-        msg[6] = 0x20000002  # repeat 2 / write 2
-        msg[7] = 0x10000001  # read 1 / write data
-        msg[8] = 0x10000001  # pad / read 1
-        msg[9] = 0xa5a5a5a5  # pad
-        msg[10] = 0x20000002  # repeat 2 / write 2
-        msg[11] = 0x10000001  # read 1 / write data
-        msg[12] = 0x10000002  # pad / read 2
-        msg[13] = 0xa5a5a5a5  # pad
-
-        tosend = msg.tobytes()
-        # print("%s Send (%d) %s", self.dest, len(tosend), binascii.hexlify(tosend))
-        self.sock.sendto(tosend, self.dest)
-        if True:
-            reply, src = self.sock.recvfrom(15000)
-            if len(reply) == 14*4:
-                reply = numpy.frombuffer(reply, be32)
-                for n in [0, 1, 2, 4, 6, 7, 10, 11]:
-                    if reply[n] != msg[n]:
-                        print("bad mismatch %8.8x != %8.8x" % (reply[n], msg[n]))
-                r1 = reply[5]
-                r2 = reply[3]
-                if msg[8] == reply[8] and r1 == reply[9] and msg[12] == reply[12] and r2 == reply[13]:
-                    print("Seems to be no-burst")
-                    return False
-                elif r1 == reply[8] and r2 == reply[9] and r1 == reply[12] and r2 == reply[13]:
-                    print("Seems to be burst")
-                    return True
-                else:
-                    print("Burst autodetect failed")
-                    return False
-                # for jx, x in enumerate(reply):
-                #    print("%2d %8.8x" % (jx, x))
-
-        return dev_burst_en
-
-    def _exchange(self, addrs, values=None, drop_reply=False, burst=False):
-        """Exchange a single low level message
-        """
-
-        if not burst:
-            msg = numpy.zeros(2+2*len(addrs), dtype=be32)
-        else:
-            msg = numpy.zeros(2+2+len(addrs), dtype=be32)
-
-        msg[0] = random.randint(0, 0xffffffff)
-        msg[1] = msg[0] ^ 0xffffffff
-
-        if not burst:
-            for i, (A, V) in enumerate(zip(addrs, values), 1):
-                A &= 0x00ffffff
-                if V is None:
-                    A |= 0x10000000
-                msg[2*i] = A
-                msg[2*i+1] = V or 0
-        else:
-            RC = (len(addrs) & 0x00ffffff) | 0x20000000
-            A = addrs[0]
-            A &= 0x00ffffff
-            if values[0] is None:
-                A |= 0x10000000
-            msg[2] = RC
-            msg[3] = A
-            for i, V in enumerate(values, 4):
-                msg[i] = V or 0
-
-        tosend = msg.tobytes()
-        if False:
-            mm = ".".join(["%8.8x" % x for x in msg])
-            print("%s Send (%d) %s" % (self.dest, len(tosend), mm))
-        self.sock.sendto(tosend, self.dest)
+        return self.transport.probe_burst()
 
-        if drop_reply:
-            return None
-
-        while True:
-            reply, src = self.sock.recvfrom(15000)
-            # print("%s Recv (%d) %s", src, len(reply), binascii.hexlify(reply))
-
-            byte_align = 8 if not burst else 4
-            if len(reply) % byte_align:
-                reply = reply[:-(len(reply) % byte_align)]
-
-            if len(tosend) != len(reply):
-                print("Reply truncated %d %d" % (len(tosend), len(reply)))
-                continue
-
-            reply = numpy.frombuffer(reply, be32)
-            if (msg[:2] != reply[:2]).any():
-                print('Ignore reply w/o matching nonce %s %s' % (msg[:2], reply[:2]))
-                continue
-            elif not burst and (msg[2::2] != reply[2::2]).any():
-                print('reply addresses are out of order')
-                continue
-            elif burst and (msg[2:3] != reply[2:3]).any():
-                print('Non-matching start address')
-                continue
-            break
-
-        ret = reply[3::2] if not burst else reply[4::1]
-        return ret
+    @property
+    def stats(self):
+        """Packet, retry, truncation and dropped reply counts
+        """
+        return self.transport.stats
 
     def exchange(self, addrs, values=None, drop_reply=False):
         """Accepts a list of address and values (None to read).
         Returns a numpy.ndarray in the same order.
         """
-        addrs = list(addrs)
-
-        consec = False
-        # Check for consecutive addresses if burst mode available
-        if self.burst_avail and len(addrs) > 1 and (addrs == list(range(addrs[0], addrs[-1]+1))):
-            consec = True
+        # Consecutive addresses use burst, if available
+        self.transport.burst = self.burst_avail
+        chunks = self.transport.pack(addrs, values)
+        ret = numpy.zeros(sum([len(C[2][0]) for C in chunks]), be32)
 
-        if values is None:
-            values = [None]*len(addrs)
+        if drop_reply:
+            for _offset, msg, _layout in chunks:
+                self.transport.send(msg)
         else:
-            values = list(values)
-
-        ret = numpy.zeros(len(addrs), be32)
-        n_tx = 255 if consec else 127
-        for i in range(0, len(addrs), n_tx):
-            A, B = addrs[i:i+n_tx], values[i:i+n_tx]
-
-            P = self._exchange(A, B, drop_reply=drop_reply, burst=consec)
-            if not drop_reply:
-                ret[i:i+n_tx] = P
+            self.transport.run(chunks, ret)
 
         return ret
 
@@ -10,6 +10,7 @@ import time
 import struct
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../projects/common"))
 
 from lbus_access import lbus_access
 
@@ -878,7 +878,7 @@ class c_zest:
             if not quiet:
                 sys.stdout.write('pseudo-random test channel %d (%s)' % (chan, self.channels[chan]))
                 sys.stdout.flush()
-            data = [x + 65536 if x < 0 else x for x in dataset[chan]]
+            data = dataset[chan].view('u2').tolist()  # as unsigned
             cnt = self.pntest_kernel(data)
             cntlist.append(cnt)
             if not quiet:
@@ -135,7 +135,8 @@ def opt_bus_width(entries, min_rom_size, max_rom_size):
 
 
 def read_live_array(dev):
-    leep_dev = leep.open(addr=dev, timeout=20)
+    # read the whole ROM from the device, not from the local cache
+    leep_dev = leep.open(addr=dev, timeout=20, rom_cache=False)
     foo = leep_dev.the_rom
     return foo
 
@@ -34,7 +34,49 @@ def add_name(regmap, name):
     return a
 
 
+# get_reg_info() results of each regmap:
+# id(regmap) -> (regmap, {(hierarchy, name): info}).
+# The entry holds a reference to the regmap, so its id() can't be reused.
+# After editing a regmap in place, call regmap_changed().
+_reg_info_cache = {}
+_reg_info_cache_max = 4096  # results per regmap
+_reg_info_cache_maps = 16
+
+
+def _freeze(x):
+    return tuple(x) if type(x) is list else x
+
+
+def regmap_changed(regmap):
+    """
+    Forget the get_reg_info() results of a regmap modified in place.
+    """
+    _reg_info_cache.pop(id(regmap), None)
+
+
 def get_reg_info(regmap, hierarchy, name):
+    """
+    Memoized front end for _get_reg_info(), see below.
+    Repeated lookups of the same name skip the scan of every register name.
+    """
+    entry = _reg_info_cache.get(id(regmap))
+    if entry is None or entry[0] is not regmap:
+        if len(_reg_info_cache) >= _reg_info_cache_maps:
+            _reg_info_cache.clear()
+        entry = _reg_info_cache[id(regmap)] = (regmap, {})
+    infos = entry[1]
+    key = (_freeze(hierarchy), _freeze(name))
+    if key in infos:
+        info = infos[key]
+    else:
+        if len(infos) >= _reg_info_cache_max:
+            infos.clear()
+        info = infos[key] = _get_reg_info(regmap, hierarchy, name)
+    # copy, so callers may modify the result
+    return None if info is None else dict(info)
+
+
+def _get_reg_info(regmap, hierarchy, name):
     """
     regmap: is a python dictionary of json regmap generated from ./newad.py
     name: is potentially an unique identifier of a register name inside the
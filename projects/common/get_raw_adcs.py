@@ -1,5 +1,4 @@
 import time
-import struct
 from banyan_ch_find import banyan_ch_find
 import numpy
 import datetime
@@ -75,36 +74,34 @@ def get_raw_adcs_run(dev, filewritepath='raw_adcs_', mask="0xff", npt_wish=0, co
     # print process_adcs(dev,npt,mask_int)#,block,timestamp);
 
 
-def pair_ram(buff, idx, count):
+def _split_pairs(pairs):
+    """
+    pairs: (4, npt, 2) '>i2' view of the 4 banyan RAMs, [high, low] halves
+    returns (8, npt) int16: RAM 2k holds the low, 2k+1 the high halves
+    """
+    npt = pairs.shape[1]
+    return pairs[:, :, ::-1].transpose(0, 2, 1).astype(numpy.int16, order='C').reshape(8, npt)
 
-    buff_slice = buff[idx:idx+count]
 
-    # break 32-bit elements into 16-bit raw ADC samples
-    ram1 = [(x >> 16) & 0xffff for x in buff_slice]
-    ram2 = [x & 0xffff for x in buff_slice]
-    return [ram2, ram1]
+def unpack_banyan(buf, astep, npt):
+    """
+    Unpack the banyan_data buffer, 4 RAMs of 2*astep 32-bit words,
+    each holding two 16-bit samples, into 8 RAM blocks of npt samples.
+    returns (8, npt) int16 array
+    """
+    words = numpy.asarray(buf).astype('>u4', copy=False)
+    return _split_pairs(words[:8*astep].view('>i2').reshape(4, 2*astep, 2)[:, :npt])
 
 
-def pair_ram_prc(prc, addr, count):
-    foo = prc.reg_read_alist(range(addr, addr+count))
-    uuu = [struct.unpack('!hh', x[2]) for x in foo]
-    ram1 = [x[1] for x in uuu]
-    ram2 = [x[0] for x in uuu]
-    return [ram1, ram2]
+def by_channel(block, chans):
+    """
+    Rows of block, in banyan order (see banyan_ch_find), sorted by ADC channel
+    """
+    return block[numpy.argsort(chans)]
 
 
 def reshape_buffer(buf, astep, npt):
-    # TODO: This copy can be avoided if leep/raw.py spits out numpy arrays,
-    #       which we should look into
-    data = numpy.array(buf)
-    # Read the upper and lower part of the banyan buffer
-    p1, p2 = (data & 0xffff).astype('int16'), ((data >> 16) & 0xffff).astype('int16')
-    out = numpy.empty((8, 2*astep))
-    # Interleave p1 and p2
-    out[::2, :] = p1.reshape(4, 2*astep)
-    out[1::2, :] = p2.reshape(4, 2*astep)
-    out = out[:, :npt]
-    return out
+    return unpack_banyan(buf, astep, npt)
 
 
 def gen_test_data(npt):
@@ -137,13 +134,10 @@ def collect(dev, npt, print_minmax=True, allow_clk_frozen=False, slow_chain=True
         exit(3)
     astep = 1 << ((b_status >> 24) & 0x3F)
 
-    # TODO: The I/O call here takes twice as long, as leep/raw.py is not aware of the banyan, dual
-    #       read option. The old collect_prc takes advantage of that but not leep.
+    # leep/raw.py reads this contiguous buffer with block-transfer/repeat-count
+    # transactions when the gateway supports them.
     full_buffer, = dev.reg_read([('banyan_data')])
-    value = []
-    for ix in range(0, 8, 2):
-        value.extend(pair_ram(full_buffer, ix*astep, npt))
-    return value, timestamp
+    return unpack_banyan(full_buffer, astep, npt), timestamp
 
 
 def collect_prc(prc, npt, print_minmax=True, allow_clk_frozen=False):
@@ -167,10 +161,9 @@ def collect_prc(prc, npt, print_minmax=True, allow_clk_frozen=False):
         exit(3)
     astep = 1 << ((b_status >> 24) & 0x3F)
     addr_wave0 = prc.get_read_address('banyan_data')
-    value = []
-    for ix in range(0, 8, 2):
-        value.extend(pair_ram_prc(prc, addr_wave0+ix*astep, npt))
-    return value, timestamp
+    raw = b''.join(x[2] for ix in range(0, 8, 2)
+                   for x in prc.reg_read_alist(range(addr_wave0+ix*astep, addr_wave0+ix*astep+npt)))
+    return _split_pairs(numpy.frombuffer(raw, '>i2').reshape(4, npt, 2)), timestamp
 
 
 def collect_adcs(dev, npt, nchans, print_minmax=True):
@@ -178,18 +171,9 @@ def collect_adcs(dev, npt, nchans, print_minmax=True):
     nchans must be the result of len(banyan_ch_find())
     '''
     value, timestamp = collect(dev, npt, print_minmax)
-    # value holds 8 raw RAM blocks
-    # block will have these assembled into ADC channels
-    mult = 8//nchans
-    block = []
-    for ix in range(nchans):
-        aaa = [value[jx] for jx in range(int(ix*mult), int(ix*mult+mult))]
-        block.append(sum(aaa, []))
-    block2 = []
-    for bx in block:
-        bx2 = [x if x < 32768 else x-65536 for x in bx]
-        block2.append(bx2)
-    return block2, timestamp
+    # value holds 8 raw RAM blocks, 8//nchans consecutive ones per ADC channel,
+    # so block is (nchans, npt*8//nchans), in banyan_ch_find() order
+    return value.reshape(nchans, -1), timestamp
 
 
 def process_adcs(dev, npt, mask_int):  # ,block,timestamp):
@@ -0,0 +1,456 @@
+"""asyncio access to LEEP devices
+
+Many devices may be polled concurrently from a single event loop.
+
+>>> import asyncio
+>>> from leep.aio import open, read_many
+>>> async def main():
+...     devs = await asyncio.gather(open('leep://10.0.0.1'),
+...                                 open('leep://10.0.0.2'))
+...     print(await read_many(devs, ['dsp_tag', 'wave_samp_per']))
+>>> asyncio.run(main())
+"""
+
+import logging
+
+import asyncio
+import random
+import socket
+
+import numpy
+
+from . import RomError
+from .base import print_reg
+from .raw import LEEPDevice, LEEPReadPlan, LEEPWritePlan
+from .stats import timed
+from .transport import (be32, burst_probe, burst_check, new_stats, unpack,
+                        words, RTTEstimator)
+
+_log = logging.getLogger(__name__)
+# special logger for use in exchange()
+_spam = logging.getLogger(__name__ + '.packets')
+_spam.propagate = False
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    """Dispatch replies to pending requests by nonce
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.transport = None
+        # nonce -> (future, check)
+        # check(reply) returns result, or None to ignore the reply
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, reply, src):
+        _spam.debug("%s Recv (%d) %s", src, len(reply), repr(reply))
+        self.stats['packets_in'] += 1
+        self.stats['bytes_in'] += len(reply)
+        if len(reply) < 8:
+            _log.error("Reply truncated %d", len(reply))
+            self.stats['truncated'] += 1
+            return
+
+        nonce = int(numpy.frombuffer(reply[:4], be32)[0])
+        P = self.pending.get(nonce)
+        if P is None:
+            # perhaps a late reply to a retransmitted request
+            _log.debug('Ignore reply w/o matching nonce %08x', nonce)
+            self.stats['dropped'] += 1
+            return
+
+        fut, check = P
+        if fut.done():
+            return
+        ret = check(reply)
+        if ret is not None:
+            fut.set_result(ret)
+
+    def error_received(self, exc):
+        for fut, _check in self.pending.values():
+            if not fut.done():
+                fut.set_exception(exc)
+
+    def connection_lost(self, exc):
+        exc = exc or ConnectionError('Transport closed')
+        self.error_received(exc)
+
+
+class AsyncLEEPDevice(LEEPDevice):
+    """LEEP device accessed through an asyncio datagram transport.
+
+    Methods which communicate with the device are coroutines,
+    otherwise semantics are the same as :py:class:`raw.LEEPDevice`.
+    Calling a plan from prepare_read()/prepare_write() returns an
+    awaitable.
+    Create with :py:func:`open`, or construct and then
+    ``await dev.connect()``.
+
+    Up to window requests are kept in flight per device,
+    whether from one exchange() or from several concurrent callers.
+    """
+    backend = 'leep'
+
+    def __init__(self, addr, timeout=0.1, window=1, retries=2,
+                 allow_burst=False, force_burst=False, rom_cache=True,
+                 write_retries=0, min_timeout=0.002, **kws):
+        # bypass LEEPDevice.__init__(), which does blocking I/O
+        super(LEEPDevice, self).__init__(**kws)
+        host, _sep, port = addr.partition(':')
+        self.dest = (host, int(port or '50006'))
+
+        self.window = max(1, int(window))
+        self.retries = retries
+        self.write_retries = write_retries
+        self.timeout = timeout
+        self.rtt = RTTEstimator(timeout, min_timeout)
+        self._plans = {}
+        self._timebases = {}
+        self.stats.update(new_stats())
+        self._writes = 0
+        self._set_rom_cache(rom_cache)
+
+        self._allow_burst = allow_burst
+        self.burst_avail = force_burst
+
+        self._proto = None
+        self._inflight = None
+
+    async def connect(self):
+        """Open transport, detect burst support and read ROM.
+        """
+        loop = asyncio.get_running_loop()
+        host, port = self.dest
+        # resolve once, not for every datagram
+        info = await loop.getaddrinfo(host, port, family=socket.AF_INET,
+                                      type=socket.SOCK_DGRAM)
+        self.dest = info[0][4]
+
+        _transport, self._proto = await loop.create_datagram_endpoint(
+            lambda: _Protocol(self.stats), remote_addr=self.dest)
+        self._inflight = asyncio.Semaphore(self.window)
+
+        if not self.burst_avail and self._allow_burst:
+            self.burst_avail = await self._burst_avail()
+
+        await self._readrom()
+        self._app_detect()
+        return self
+
+    def close(self):
+        if self._proto is not None and self._proto.transport is not None:
+            self._proto.transport.close()
+        self._proto = None
+
+    async def __aenter__(self):
+        if self._proto is None:
+            await self.connect()
+        return self
+
+    async def __aexit__(self, A, B, C):
+        self.close()
+
+    def __setitem__(self, key, value):
+        raise TypeError('Use await dev.reg_write()')
+
+    def __getitem__(self, key):
+        raise TypeError('Use await dev.reg_read()')
+
+    async def _transact(self, msg, check, write=False):
+        """Send msg and wait for a reply accepted by check(),
+        retransmitting up to self.retries times (self.write_retries
+        if msg writes).  Same timeout policy as
+        :py:class:`leep.transport.Transport`.
+        """
+        proto = self._proto
+        if proto is None:
+            raise RuntimeError('Not connected')
+        loop = asyncio.get_running_loop()
+        limit = self.write_retries if write else self.retries
+
+        async with self._inflight:
+            for tries in range(limit + 1):
+                wait = self.rtt.rto if tries < limit else self.timeout
+                if tries:
+                    _log.debug('Retransmit to %s', self.dest)
+                    self.stats['retries'] += 1
+                    msg[0] = random.randint(0, 0xffffffff)
+                    msg[1] = msg[0] ^ 0xffffffff
+                nonce = int(msg[0])
+                fut = loop.create_future()
+                proto.pending[nonce] = (fut, check)
+                try:
+                    tosend = msg.tobytes()
+                    _spam.debug("%s Send (%d) %s", self.dest, len(tosend),
+                                repr(tosend))
+                    proto.transport.sendto(tosend)
+                    self.stats['packets_out'] += 1
+                    self.stats['bytes_out'] += len(tosend)
+                    start = loop.time()
+                    ret = await asyncio.wait_for(fut, wait)
+                    self.rtt.sample(loop.time() - start)
+                    return ret
+                except asyncio.TimeoutError:
+                    self.rtt.backoff()
+                finally:
+                    del proto.pending[nonce]
+
+        self.stats['timeouts'] += 1
+        raise socket.timeout('exchange timeout after %d retries' % limit)
+
+    async def _burst_avail(self):
+        msg = burst_probe()
+
+        def check(reply):
+            if len(reply) != 4 * len(msg):
+                return None
+            return numpy.frombuffer(reply, be32)
+
+        try:
+            reply = await self._transact(msg, check)
+        except socket.timeout:
+            _log.debug('Burst autodetect timeout')
+            return False
+        return burst_check(msg, reply)
+
+    async def exchange(self, addrs, values=None):
+        """Accepts a list of address and values (None to read).
+        Returns a numpy.ndarray in the same order.
+        """
+        addrs = list(addrs)
+
+        if values is None:
+            values = [None] * len(addrs)
+        else:
+            values = list(values)
+            self._writes += 1
+
+        ret = numpy.zeros(len(addrs), be32)
+        await self._run(self._pack(addrs, values), ret)
+        return ret
+
+    @timed('exchange')
+    async def _run(self, chunks, ret):
+        """Exchange messages from _pack() concurrently.
+        Reply data is stored in ret, unless ret is None.
+        """
+        async def chunk(offset, msg, layout):
+            # copy, the same plan may be in use by another caller
+            msg = msg.copy()
+            msg[0] = random.randint(0, 0xffffffff)
+            msg[1] = msg[0] ^ 0xffffffff
+            P = await self._transact(
+                msg, lambda reply: unpack(msg, layout, words(reply),
+                                          self.stats), write=layout[2])
+            if ret is not None:
+                ret[offset:offset + len(P)] = P
+
+        await asyncio.gather(*[chunk(*C) for C in chunks])
+
+    async def _plan_read(self, plan, raw=None):
+        if raw is None:
+            raw = numpy.empty(plan.size, dtype='u4')
+        await self._run(plan.chunks, raw)
+        return plan.decode(raw)
+
+    async def _plan_write(self, plan, values):
+        self._writes += 1
+        await self._run(plan.encode(values), None)
+
+    @print_reg
+    async def reg_write(self, ops, instance=[]):
+        assert isinstance(ops, (list, tuple))
+
+        plan = self._cached_plan(LEEPWritePlan, [op[0] for op in ops],
+                                 instance)
+        await self._plan_write(plan, [op[1] for op in ops])
+
+    @print_reg
+    @timed('reg_read')
+    async def reg_read(self, names, instance=[]):
+        return await self._plan_read(
+            self._cached_plan(LEEPReadPlan, names, instance))
+
+    async def set_decimate(self, dec, instance=[]):
+        wave_shift, _Ymax = self._yscale(dec)
+
+        assert dec >= 1 and dec <= 255
+        await self.reg_write([
+            ('wave_samp_per', dec),
+            ('wave_shift', wave_shift),
+        ], instance=instance)
+
+    async def get_decimate(self, instance=[]):
+        return await self.reg_read(['wave_samp_per'], instance=instance)
+
+    async def set_channel_mask(self, chans=[], instance=[]):
+        chans = self._channel_mask(chans, instance=instance)
+        await self.reg_write([('chan_keep', chans)], instance=instance)
+
+    async def get_channel_mask(self, instance=[]):
+        chans, = await self.reg_read(['chan_keep'], instance=instance)
+        return chans
+
+    async def _step(self, op):
+        if op[0] == 'read':
+            return await self._plan_read(*op[1:])
+        elif op[0] == 'write':
+            return await self._plan_write(op[1], op[2])
+        elif op[0] == 'sleep':
+            return await asyncio.sleep(op[1])
+        raise ValueError(op[0])
+
+    async def _drive(self, steps):
+        """Run the I/O steps yielded by a generator.
+        See :py:meth:`raw.LEEPDevice._drive`.
+        """
+        R = None
+        try:
+            while True:
+                R = await self._step(steps.send(R))
+        except StopIteration as e:
+            return e.value
+
+    @timed('wait_for_acq')
+    async def wait_for_acq(self, tag=False, toggle_tag=False, timeout=5.0,
+                           instance=[]):
+        """Wait for next waveform acquisition to complete.
+        See :py:meth:`raw.LEEPDevice.wait_for_acq`.
+        """
+        ret, = await self._drive(self._acq_steps([instance], tag=tag,
+                                                 toggle_tag=toggle_tag,
+                                                 timeout=timeout))
+        return ret
+
+    async def acquire(self, chans, instances=[[]], tag=False,
+                      toggle_tag=False, timeout=5.0, dtype=None):
+        """See :py:meth:`raw.LEEPDevice.acquire`.
+        """
+        return await self._drive(self._acquire_steps(
+            chans, instances, tag=tag, toggle_tag=toggle_tag,
+            timeout=timeout, dtype=dtype))
+
+    async def iter_acquisitions(self, chans, instance=[], depth=2, tag=False,
+                                timeout=5.0, dtype=None):
+        """Asynchronous iterator of acquisitions.
+        See :py:meth:`raw.LEEPDevice.iter_acquisitions`.
+
+        >>> async for now, T, (A, B) in dev.iter_acquisitions([0, 1]):
+        ...     process(A, B)
+        """
+        steps = self._stream_steps(chans, instance=instance, depth=depth,
+                                   tag=tag, timeout=timeout, dtype=dtype)
+        R = None
+        while True:
+            op = steps.send(R)
+            if op[0] == 'record':
+                R = None
+                yield op[1]
+            else:
+                R = await self._step(op)
+
+    @timed('get_channels')
+    async def get_channels(self, chans=[], instance=[], out=None,
+                           dtype=None):
+        names, inst = self._channel_regs(instance)
+        keep, dec, data = await self.reg_read(names, instance=inst)
+        return self._demux(chans, keep, dec, data, instance=instance,
+                           out=out, dtype=dtype)
+
+    async def get_timebase(self, chans=[], instance=[]):
+        info, inst = self._timebase_regs(instance)
+        keep, dec = await self.reg_read(['chan_keep', 'wave_samp_per'],
+                                        instance=inst)
+        return self._timebase(chans, info, keep, dec)
+
+    async def tgen_reg_sequence(self, prog, instance=[]):
+        val = self.assemble_tgen(prog, instance=instance)
+        next, = await self.reg_read(['bank_next'])
+
+        return [('XXX', val), ('bank_next', next ^ 1), ]
+
+    async def _trysize(self, start_addr):
+        self.rom_addr = start_addr
+        end_addr = start_addr + self.preamble_max_size
+        values = await self.exchange(range(start_addr, end_addr))
+        values_preamble = numpy.array(values)
+        self._checkrom(values, True)
+        if self.size_rom != 0:
+            values_full = self._rom_cache_load(values_preamble)
+            if values_full is not None:
+                return values_full
+            total_rom_size = (self.hash_descriptor_size
+                              + self.size_desc + self.size_rom)
+            stop_addr = end_addr + total_rom_size - self.preamble_max_size
+            values_json = await self.exchange(range(end_addr, stop_addr))
+            preamble_json = numpy.concatenate((values_preamble, values_json))
+            values_full = numpy.array(preamble_json, be32)
+            self._checkrom(values_full)
+            self._rom_cache_store(values_preamble, values_full)
+            return values_full
+        else:
+            raise RomError("ROM not found, size is zero")
+
+    async def _readrom(self):
+        self.descript = None
+        self.codehash = None
+        self.jsonhash = None
+        self.regmap = None
+        self._json_sha1 = None
+
+        try:
+            self.the_rom = await self._trysize(self.init_rom_addr)
+        except (RuntimeError, ValueError, RomError):
+            try:
+                self.the_rom = await self._trysize(self.max_rom_addr)
+            except RomError as e:
+                _log.error("aio.py: %s. Quitting." % str(e))
+                raise
+            except (RuntimeError, ValueError):
+                msg = "Could not read ROM using either start addresses"
+                raise ValueError(msg)
+        _log.debug("ROM was successfully read")
+
+
+async def open(addr, **kws):
+    """Connect to a single LEEP Device.
+
+    :param str addr: Device address "leep://<ip>[:<port>]"
+    :returns: :py:class:`AsyncLEEPDevice`
+    """
+    if not addr.startswith('leep://'):
+        raise ValueError("Unknown '%s' must begin with leep://" % addr)
+    dev = AsyncLEEPDevice(addr[7:], **kws)
+    try:
+        await dev.connect()
+    except Exception:
+        dev.close()
+        raise
+    return dev
+
+
+async def read_many(devs, names, instance=[], return_exceptions=False):
+    """Read the same registers from many devices concurrently.
+
+    :param list devs: A list of :py:class:`AsyncLEEPDevice`.
+    :param list names: A list of register names.
+    :param list instance: List of instance identifiers.
+    :param bool return_exceptions: If True, a failing device gives
+                                   its exception in place of a result.
+    :returns: A list with one reg_read() result per device.
+    """
+    return await asyncio.gather(
+        *[dev.reg_read(names, instance=instance) for dev in devs],
+        return_exceptions=return_exceptions)
+
+
+async def write_many(devs, ops, instance=[], return_exceptions=False):
+    """Apply the same register writes to many devices concurrently.
+    """
+    return await asyncio.gather(
+        *[dev.reg_write(ops, instance=instance) for dev in devs],
+        return_exceptions=return_exceptions)
@@ -2,6 +2,10 @@ import logging
 
 import re
 import os
+from bisect import bisect_left
+from functools import lru_cache
+
+from .stats import Stats
 
 
 _log = logging.getLogger(__name__)
@@ -75,11 +79,105 @@ def open(addr, **kws):
         raise ValueError(msg)
 
 
+class ReadPlan(object):
+    """A prepared register read.  See :py:meth:`DeviceBase.prepare_read`.
+
+    Calling the plan returns the same as
+    ``dev.reg_read(names, instance=instance)``.
+    """
+
+    def __init__(self, dev, names):
+        self.dev = dev
+        self.names = names  # full register names
+
+    def __call__(self):
+        return self.dev._plan_read(self)
+
+
+class WritePlan(ReadPlan):
+    """A prepared register write.  See :py:meth:`DeviceBase.prepare_write`.
+
+    Calling the plan with a list of values, one for each name,
+    is the same as ``dev.reg_write(list(zip(names, values)))``.
+    """
+
+    def __call__(self, values):
+        return self.dev._plan_write(self, values)
+
+
+class RegIndex(object):
+    """Register name lookup index for DeviceBase.expand_regname()
+
+    Built once from a regmap.  Register names are stored reversed and
+    sorted, so the names ending with a given suffix form a contiguous
+    range found by bisection.  Only this short list of candidates is
+    matched against the fragment pattern.  Results are kept in an LRU
+    cache keyed by name and instance fragments.
+    """
+
+    def __init__(self, regmap, cachesize=4096):
+        self.regmap = regmap
+        self.size = len(regmap)
+        self._order = dict((name, i) for i, name in enumerate(regmap))
+        self._rnames = sorted(name[::-1] for name in regmap)
+        self.lookup = lru_cache(maxsize=cachesize)(self._lookup)
+
+    def valid(self, regmap):
+        """Is this index still up to date for regmap?
+        """
+        return regmap is self.regmap and len(regmap) == self.size
+
+    def endswith(self, suffix):
+        """:returns: List of register names ending with suffix
+        """
+        rsuffix = suffix[::-1]
+        i = bisect_left(self._rnames, rsuffix)
+        ret = []
+        for rname in self._rnames[i:]:
+            if not rname.startswith(rsuffix):
+                break
+            ret.append(rname[::-1])
+        return ret
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def pattern(fragments):
+        # build a regexp
+        # from a list of name fragments
+        # match when consecutive fragments are seperated by
+        #  1. a single '_'.  ['A', 'B'] matches 'A_B'.
+        #  2. two '_' with anything inbetween.  'A_blah_B' or 'A_x_y_z_B'.
+        regx = r'_(?:.*_)?'.join([re.escape(str(i)) for i in fragments])
+        return re.compile('^.*%s$' % regx)
+
+    def _lookup(self, fragments):
+        """:param tuple fragments: Instance fragments, then register name.
+        :returns: The full register name.
+        """
+        R = self.pattern(fragments)
+
+        # any match must end with the last fragment
+        ret = [x for x in self.endswith(str(fragments[-1])) if R.match(x)]
+        if len(ret) == 1:
+            return ret[0]
+        elif len(ret) > 1:
+            ret.sort(key=self._order.get)  # in regmap order
+            subs = (R.pattern, ' '.join(ret))
+            msg = '%s Matches more than one register: %s' % subs
+            raise RuntimeError(msg)
+        else:
+            msg = 'No match for register pattern %s' % R.pattern
+            raise RuntimeError(msg)
+
+
 class DeviceBase(object):
     backend = None  # 'ca' or 'leep'
 
     def __init__(self, instance=[]):
         self.instance = instance[:]  # shallow copy
+        self._regindex = None  # see expand_regname()
+        # counters and latency histograms.  See leep.stats
+        self.stats = Stats()
 
         # Machinery to enable r/w tracing. See print_reg decorator.
         self.trace = False
@@ -110,25 +208,12 @@ class DeviceBase(object):
         if name in self.regmap or instance is None:
             return name
 
-        # build a regexp
-        # from a list of name fragments
-        fragments = self.instance + instance + [name]
-        # match when consecutive fragments are seperated by
-        #  1. a single '_'.  ['A', 'B'] matches 'A_B'.
-        #  2. two '_' with anything inbetween.  'A_blah_B' or 'A_x_y_z_B'.
-        regx = r'_(?:.*_)?'.join([re.escape(str(i)) for i in fragments])
-        R = re.compile('^.*%s$' % regx)
+        index = self._regindex
+        if index is None or not index.valid(self.regmap):
+            index = self._regindex = RegIndex(self.regmap)
 
-        ret = [x for x in self.regmap if R.match(x)]
-        if len(ret) == 1:
-            return ret[0]
-        elif len(ret) > 1:
-            subs = (R.pattern, ' '.join(ret))
-            msg = '%s Matches more than one register: %s' % subs
-            raise RuntimeError(msg)
-        else:
-            msg = 'No match for register pattern %s' % R.pattern
-            raise RuntimeError(msg)
+        fragments = tuple(self.instance) + tuple(instance) + (name,)
+        return index.lookup(fragments)
 
     def reg_write(self, ops, instance=[]):
         """Write to registers.
@@ -156,6 +241,46 @@ class DeviceBase(object):
         """
         raise NotImplementedError
 
+    def prepare_read(self, names, instance=[]):
+        """Prepare to read the same list of registers repeatedly.
+
+        Register names are expanded once.  Backends may also
+        precompute the requests to be sent.
+
+        >>> P = D.prepare_read(['reg_a', 'reg_b'])
+        >>> A, B = P()
+
+        :param list names: A list of register names.
+        :param list instance: List of instance identifiers.
+        :returns: A :py:class:`ReadPlan`
+        """
+        if instance is not None:
+            names = [self.expand_regname(name, instance=instance)
+                     for name in names]
+        return ReadPlan(self, list(names))
+
+    def prepare_write(self, names, instance=[]):
+        """Prepare to write the same list of registers repeatedly.
+
+        >>> P = D.prepare_write(['reg_a', 'reg_b'])
+        >>> P([5, 6])
+
+        :param list names: A list of register names.
+        :param list instance: List of instance identifiers.
+        :returns: A :py:class:`WritePlan`
+        """
+        if instance is not None:
+            names = [self.expand_regname(name, instance=instance)
+                     for name in names]
+        return WritePlan(self, list(names))
+
+    def _plan_read(self, plan):
+        return self.reg_read(plan.names, instance=None)
+
+    def _plan_write(self, plan, values):
+        assert len(values) == len(plan.names), (len(values), plan.names)
+        return self.reg_write(list(zip(plan.names, values)), instance=None)
+
     def __setitem__(self, key, value):
         self.reg_write([(key, value)])
 
@@ -205,11 +330,38 @@ class DeviceBase(object):
         """
         raise NotImplementedError
 
+    def iter_acquisitions(self, chans, instance=[], depth=2, tag=False,
+                          timeout=5.0):
+        """Generator of waveform acquisitions, for continuous streaming.
+
+        >>> for now, T, (A, B) in dev.iter_acquisitions([0, 1]):
+        ...     process(A, B)
+
+        Yields (timestamp, tag, channels) tuples, where tag is the
+        dsp_tag of the acquisition (or None) and channels is as returned by
+        :py:meth:`get_channels`.  If tag=True, the first acquisition
+        includes the side-effects of all preceding register writes.
+
+        :param list chans: A list of channel numbers.
+        :param list instance: List of instance identifiers.
+        :param int depth: Number of acquisitions which may be buffered.
+        :param float timeout: How long to wait for each acquisition.
+        """
+        while True:
+            tag_match, slow, now = self.wait_for_acq(tag=tag, timeout=timeout,
+                                                     instance=instance)
+            yield now, slow[33], self.get_channels(chans, instance=instance)
+            tag = False
+
     def get_channels(self, chans=[], instance=[]):
         """:returns: a list of :py:class:`numpy.ndarray` with the numbered
         channels. `chans` may be a bit mask or a list of channel numbers.
 
         The returned arrays have been scaled.
+
+        The leep:// backend also accepts out= (preallocated result
+        array(s), written in place) and dtype= (eg. float32, or an
+        integer type for raw unscaled samples).
         """
         raise NotImplementedError
 
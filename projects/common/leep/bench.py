@@ -0,0 +1,299 @@
+"""Host side benchmarks of register and waveform access
+
+Runs reproducible scenarios against simulated devices (see leep.sim),
+served from a separate process, and reports for each:
+words/s, packets/s, p50/p99 latency per call, and peak Python
+memory allocated per call (tracemalloc).
+
+$ python -m leep.bench -o bench.json
+$ python -m leep.bench -s reg_read -s array_16k --latency 0.0001
+"""
+
+import logging
+
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+from . import sim
+from .raw import LEEPDevice
+
+_log = logging.getLogger(__name__)
+
+_common = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_top = os.path.dirname(os.path.dirname(_common))
+
+
+def _reg(base, addr_width=0, data_width=32, sign='unsigned'):
+    return {
+        'access': 'rw',
+        'addr_width': addr_width,
+        'sign': sign,
+        'base_addr': base,
+        'data_width': data_width,
+    }
+
+
+# Register map of the simulated device
+regmap = {
+    'scalar': _reg(0x10),
+    'circle_buf_flip': _reg(0x11, data_width=2),
+    'llrf_circle_ready': _reg(0x12, data_width=2),
+    'shell_0_dsp_tag': _reg(0x13, data_width=8),
+    'shell_0_dsp_chan_keep': _reg(0x14, data_width=12),
+    'shell_0_dsp_wave_samp_per': _reg(0x15, data_width=8),
+    'shell_0_dsp_wave_shift': _reg(0x16, data_width=3),
+    'banyan_status': _reg(0x20),
+    'rawadc_trig': _reg(0x21, data_width=1),
+    'clk_status_out': _reg(0x22, data_width=2),
+    'shell_0_slow_data': _reg(0x40, addr_width=6, data_width=8),
+    'array': _reg(0x10000, addr_width=14),
+    'shell_0_circle_data': _reg(0x20000, addr_width=14, data_width=22,
+                                sign='signed'),
+    'banyan_data': _reg(0x30000, addr_width=14),
+}
+
+
+def _serve(conn, latency, burst_modes):
+    """Simulator process.  Replies to 'stats' until 'stop'.
+    """
+    serv = sim.Server(latency=latency, seed=0)
+    urls = []
+    for burst in burst_modes:
+        B = sim.Board(regmap, burst=burst, sample_period=1e-9, seed=0)
+        B.reg('clk_status_out')[0] = 2
+        urls.append(serv.add(B))
+    serv.start()
+    conn.send(urls)
+    while True:
+        cmd = conn.recv()
+        if cmd == 'stats':
+            conn.send(dict(serv.stats))
+        else:
+            break
+    serv.stop()
+
+
+class SimProcess(object):
+    """Simulated devices, with and without burst support,
+    in a child process.
+    """
+
+    def __init__(self, latency=0.0):
+        self.conn, child = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(
+            target=_serve, args=(child, latency, (True, False)), daemon=True)
+        self.proc.start()
+        self.burst_url, self.plain_url = self.conn.recv()
+
+    def packets(self):
+        """:returns: Requests received so far
+        """
+        self.conn.send('stats')
+        return self.conn.recv()['requests']
+
+    def close(self):
+        self.conn.send('stop')
+        self.proc.join()
+
+
+def measure(fn, count, words, sim, warmup=3):
+    """Time count calls of fn().
+
+    :returns: A dict of results.
+    """
+    for _n in range(warmup):
+        fn()
+
+    P0 = sim.packets()
+    T = numpy.empty(count)
+    for n in range(count):
+        T0 = time.perf_counter()
+        fn()
+        T[n] = time.perf_counter() - T0
+    packets = sim.packets() - P0
+    total = T.sum()
+
+    # separate pass, as tracing slows everything down
+    peak = []
+    tracemalloc.start()
+    try:
+        for _n in range(min(count, 10)):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            fn()
+            peak.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'calls': count,
+        'words_per_call': words,
+        'packets_per_call': packets / count,
+        'words_per_s': words * count / total,
+        'packets_per_s': packets / total,
+        'latency_p50_us': numpy.percentile(T, 50) * 1e6,
+        'latency_p99_us': numpy.percentile(T, 99) * 1e6,
+        'alloc_bytes_per_call': int(numpy.median(peak)),
+    }
+
+
+def _size(name):
+    return 2**regmap[name]['addr_width']
+
+
+def bench_reg_read(sim, count):
+    with LEEPDevice(sim.burst_url[7:], force_burst=True) as dev:
+        return measure(lambda: dev.reg_read(['scalar']), count, 1, sim)
+
+
+def bench_array_16k(sim, count):
+    ret = {}
+    for label, url in (('burst', sim.burst_url), ('plain', sim.plain_url)):
+        with LEEPDevice(url[7:], force_burst=url == sim.burst_url) as dev:
+            ret[label] = measure(lambda: dev.reg_read(['array']), count,
+                                 _size('array'), sim)
+    return ret
+
+
+def bench_get_channels(sim, count):
+    words = _size('shell_0_circle_data') + 2
+    with LEEPDevice(sim.burst_url[7:], force_burst=True) as dev:
+        dev.set_channel_mask([0, 1], instance=[0])
+        dev.set_decimate(1, instance=[0])
+        ret = {
+            'float': measure(lambda: dev.get_channels([0, 1], instance=[0]),
+                             count, words, sim),
+        }
+        out = numpy.empty((2, words // 2 - 1), dtype='f4')
+        ret['float32_out'] = measure(
+            lambda: dev.get_channels([0, 1], instance=[0], out=out),
+            count, words, sim)
+
+        def acquire():
+            dev.wait_for_acq(instance=[0])
+            dev.get_channels([0, 1], instance=[0])
+        ret['wait_for_acq'] = measure(acquire, count, words, sim)
+    return ret
+
+
+def bench_rom_load(sim, count):
+    def load():
+        LEEPDevice(sim.burst_url[7:], force_burst=True,
+                   rom_cache=False).close()
+    rom = LEEPDevice(sim.burst_url[7:], force_burst=True,
+                     rom_cache=False)
+    words = len(rom.the_rom)
+    rom.close()
+    return measure(load, count, words, sim)
+
+
+def bench_lbus_access(sim, count):
+    sys.path.append(os.path.join(_top, 'badger'))
+    from lbus_access import lbus_access
+    N = _size('array')
+    base = regmap['array']['base_addr']
+    ret = {}
+    for label, url, burst in (('burst', sim.burst_url, True),
+                              ('plain', sim.plain_url, False)):
+        host, port = url[7:].split(':')
+        dev = lbus_access(host, port=int(port), force_burst=burst,
+                          allow_burst=False)
+        ret[label] = measure(lambda: dev.exchange(range(base, base + N)),
+                             count, N, sim)
+        dev.sock.close()
+    return ret
+
+
+def bench_get_raw_adcs(sim, count):
+    sys.path.append(_common)
+    sys.path.append(os.path.join(_top, 'dsp'))
+    import get_raw_adcs
+    npt = _size('banyan_data') // 8
+    with LEEPDevice(sim.burst_url[7:], force_burst=True) as dev:
+        return measure(lambda: get_raw_adcs.collect(dev, npt,
+                                                    print_minmax=False,
+                                                    slow_chain=False),
+                       count, _size('banyan_data'), sim)
+
+
+scenarios = [
+    ('reg_read', bench_reg_read),
+    ('array_16k', bench_array_16k),
+    ('get_channels', bench_get_channels),
+    ('rom_load', bench_rom_load),
+    ('lbus_access', bench_lbus_access),
+    ('get_raw_adcs', bench_get_raw_adcs),
+]
+
+
+def run(names=None, count=100, latency=0.0):
+    """Run benchmark scenarios.
+
+    :param list names: Scenario names.  Default all.
+    :param int count: Calls per measurement.
+    :param float latency: Simulated device latency (seconds).
+    :returns: A dict, suitable for JSON encoding.
+    """
+    todo = [(name, fn) for name, fn in scenarios
+            if names is None or name in names]
+    results = {}
+    sim = SimProcess(latency=latency)
+    try:
+        for name, fn in todo:
+            _log.info('Running %s', name)
+            try:
+                results[name] = fn(sim, count)
+            except ImportError as e:
+                _log.warning('Skip %s: %s', name, e)
+                results[name] = {'skipped': str(e)}
+    finally:
+        sim.close()
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'count': count,
+        'latency': latency,
+        'results': results,
+    }
+
+
+def getargs():
+    from argparse import ArgumentParser
+    P = ArgumentParser(description='leep host side benchmarks')
+    P.add_argument('-d', '--debug', action='store_const',
+                   const=logging.DEBUG, default=logging.INFO)
+    P.add_argument('-s', '--scenario', action='append',
+                   choices=[name for name, _fn in scenarios],
+                   help='Run only this scenario.  May be repeated.')
+    P.add_argument('-n', '--count', type=int, default=100,
+                   help='Calls per measurement')
+    P.add_argument('--latency', type=float, default=0.0,
+                   help='Simulated device latency (seconds)')
+    P.add_argument('-o', '--output', help='JSON output file (default stdout)')
+    return P.parse_args()
+
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.debug)
+    R = run(args.scenario, count=args.count, latency=args.latency)
+    text = json.dumps(R, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as F:
+            F.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,7 @@ import numpy
 from functools import reduce
 
 from .base import DeviceBase, print_reg
+from .stats import timed
 
 caget = caput = camonitor = None
 try:
@@ -109,6 +110,7 @@ class CADevice(DeviceBase):
             caput(pvname, value, wait=True, timeout=self.timeout)
 
     @print_reg
+    @timed('reg_read')
     def reg_read(self, names, instance=[]):
         ret = [None] * len(names)
         for i, name in enumerate(names):
@@ -178,6 +180,7 @@ class CADevice(DeviceBase):
                  if self.pv_read('circle_data', 'enable%d' % n)]
         return reduce(lambda l, r: l | r, chans, 0)
 
+    @timed('wait_for_acq')
     def wait_for_acq(self, toggle_tag=False, tag=False, timeout=5.0,
                      instance=[]):
         """Wait for next waveform acquisition to complete.
@@ -224,6 +227,7 @@ class CADevice(DeviceBase):
 
         return tag_match, slow, now
 
+    @timed('get_channels')
     def get_channels(self, chans=[], instance=[]):
         """:returns: a list of :py:class:`numpy.ndarray` with the numbered channels.
         chans may be a bit mask or a list of channel numbers
@@ -14,6 +14,7 @@ import numpy
 
 from . import open
 from . import RomError
+from .stats import to_prometheus
 
 
 _log = logging.getLogger(__name__)
@@ -206,6 +207,11 @@ def getargs():
                    const=logging.WARN, dest='debug')
     P.add_argument('-t', '--timeout', type=float, default=5.0)
     P.add_argument('-i', '--inst', action='append', default=[])
+    P.add_argument('-B', '--burst', action='store_true', default=False,
+                   help='Probe for block-transfer support (writes address 2'
+                        ' of a gateway without it)')
+    P.add_argument('-S', '--stats', choices=['json', 'prometheus'],
+                   help='Print transaction statistics to stderr when done')
     P.add_argument('dest', metavar="URI",
                    help="Server address.  ca://Prefix or leep://host[:port]")
 
@@ -261,12 +267,21 @@ def main():
     args = getargs()
     logging.basicConfig(level=args.debug)
     try:
-        dev = open(args.dest, timeout=args.timeout, instance=args.inst)
+        kws = {'allow_burst': True} if args.burst else {}
+        dev = open(args.dest, timeout=args.timeout, instance=args.inst,
+                   **kws)
     except RomError as e:
         _log.error("cli.py: %s, %s. Quitting." % (args.dest, str(e)))
         return
 
-    args.func(args, dev)
+    try:
+        args.func(args, dev)
+    finally:
+        if args.stats == 'json':
+            json.dump(dev.stats.snapshot(), sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        elif args.stats == 'prometheus':
+            sys.stderr.write(to_prometheus({args.dest: dev}))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,374 @@
+"""Aggregating proxy for LEEP devices
+
+Several clients (leep.raw, leep.ca IOC, oscope, ...) speak the usual
+UDP LEEP protocol to the proxy, which shares one pipelined upstream
+connection per device.
+
+- Reads of the ROM are answered from the (cached) ROM.
+- Read-only requests arriving within a short window are merged into
+  one upstream exchange.  Each keeps its own order of addresses, and
+  any repeated address, as FIFO and clear-on-read registers depend on
+  these.  Identical requests are read once.
+- Requests which write are passed through, in order.
+- Acquisitions are serialized.  Once a client writes dsp_tag or
+  circle_buf_flip, writes to these by other clients are held until
+  the first client reads back the waveform, or lease seconds pass.
+  A write held for longer than hold seconds (less than the client
+  timeout) is dropped without being applied, so the client sees a
+  timeout for a write which did not happen, and may retry.
+
+The proxy always handles block-transfer/repeat-count (burst) requests,
+whether or not the device does.
+
+$ python -m leep.proxy 50006=leep://192.168.1.10 50007=leep://192.168.1.11
+
+With --metrics [HOST:]PORT, statistics of the upstream devices and of the
+proxy are served over HTTP in the Prometheus text format.
+"""
+
+import logging
+
+import asyncio
+import time
+
+import numpy
+
+from .aio import open as aio_open
+from .raw import _base_addr
+from .stats import serve_metrics, to_prometheus
+from .transport import be32
+
+_log = logging.getLogger(__name__)
+
+
+def parse_request(msg):
+    """Decode a request message.
+
+    :param msg: Request words, including nonce.
+    :returns: (addrs, values, didx) lists.  values[i] is None for a read.
+              didx[i] is the index in msg of the data word.
+    """
+    addrs, values, didx = [], [], []
+    i = 2
+    while i + 1 < len(msg):
+        if (msg[i] >> 28) & 3 == 2:
+            # burst.  repeat count, then command/address
+            count = int(msg[i]) & 0x1ff
+            cmd, i = int(msg[i + 1]), i + 2
+        else:
+            count, cmd = 1, int(msg[i])
+            i += 1
+        addr = cmd & 0xffffff
+        read = bool(cmd & 0x10000000)
+        for n in range(count):
+            if i >= len(msg):
+                break
+            addrs.append(addr + n)
+            values.append(None if read else int(msg[i]))
+            didx.append(i)
+            i += 1
+    return addrs, values, didx
+
+
+class Busy(Exception):
+    """Another client holds the acquisition registers.
+    """
+
+
+class _Protocol(asyncio.DatagramProtocol):
+    def __init__(self, board):
+        self.board = board
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8 or len(data) % 4:
+            _log.debug('Ignore malformed request from %s', addr)
+            return
+        self.board._spawn(self.board.handle(data, addr))
+
+
+class Board(object):
+    """Proxy for one device.
+
+    :param dev: A connected :py:class:`leep.aio.AsyncLEEPDevice`.
+    :param float merge_window: Time (seconds) over which reads are merged.
+    :param float lease: Longest time (seconds) one client may hold
+                        the acquisition registers.
+    :param float hold: Longest time (seconds) a write is held while
+                       another client holds the acquisition registers.
+                       Keep below the client timeout (default 0.1).
+    """
+
+    def __init__(self, dev, merge_window=0.001, lease=1.0, hold=0.05):
+        self.dev = dev
+        self.merge_window = merge_window
+        self.lease = lease
+        self.hold = hold
+        self.transport = None
+        self._tasks = set()
+
+        rom = numpy.asarray(dev.the_rom, dtype='u4')
+        self.rom_range = (dev.rom_addr, dev.rom_addr + len(rom))
+        self.rom = rom
+
+        # registers of the acquisition handshake, and waveform data
+        self.acq_addrs = set()
+        self.wave_addrs = set()
+        for name, info in dev.regmap.items():
+            if name == '__metadata__':
+                continue
+            if name.endswith('dsp_tag') or name.endswith('circle_buf_flip'):
+                dest = self.acq_addrs
+            elif 'circle_data' in name and not name.endswith('_ready'):
+                dest = self.wave_addrs
+            else:
+                continue
+            base = _base_addr(info)
+            dest.update(range(base, base + 2**info.get('addr_width', 0)))
+
+        self._batch = None  # [(addrs, future)] awaiting next upstream read
+        self._holder = None  # (client, expires) of acquisition lease
+        self._released = asyncio.Event()
+
+        self.stats = {
+            'requests': 0,  # from clients
+            'rom': 0,  # requests answered entirely from ROM
+            'merged': 0,  # read requests merged into another exchange
+            'upstream': 0,  # exchanges with device
+            'held': 0,  # writes delayed by another acquisition
+            'busy': 0,  # writes dropped, held for too long
+        }
+
+    def _spawn(self, coro):
+        T = asyncio.ensure_future(coro)
+        self._tasks.add(T)
+        T.add_done_callback(self._tasks.discard)
+
+    async def handle(self, data, client):
+        msg = numpy.frombuffer(data, be32).copy()
+        addrs, values, didx = parse_request(msg)
+        self.stats['requests'] += 1
+        try:
+            if all([V is None for V in values]):
+                result = await self.read(addrs, client)
+            else:
+                result = await self.write(addrs, values, client)
+        except Busy:
+            # not applied.  No reply, the client times out.
+            self.stats['busy'] += 1
+            _log.debug('Drop write from %s, acquisition busy', client)
+            return
+        except (OSError, asyncio.TimeoutError, RuntimeError) as e:
+            # no reply.  The client will retry.
+            _log.warning('%s request from %s fails: %s', self.dev.dest,
+                         client, e)
+            return
+        if len(didx):
+            msg[didx] = result
+        self.transport.sendto(msg.tobytes(), client)
+
+    async def read(self, addrs, client=None):
+        """Read through the merge window and ROM cache.
+        :returns: An array of values.
+        """
+        ret = numpy.zeros(len(addrs), 'u4')
+        A = numpy.asarray(addrs, dtype='u4')
+        lo, hi = self.rom_range
+        inrom = (A >= lo) & (A < hi)
+        ret[inrom] = self.rom[A[inrom] - lo]
+        if inrom.all():
+            self.stats['rom'] += 1
+            return ret
+
+        rest = [int(a) for a in A[~inrom]]
+        fut = asyncio.get_running_loop().create_future()
+        if self._batch is None:
+            self._batch = []
+            self._spawn(self._flush())
+        else:
+            self.stats['merged'] += 1
+        self._batch.append((rest, fut))
+        ret[~inrom] = await fut
+
+        if self._holder and self._holder[0] == client and \
+                self.wave_addrs.intersection(rest):
+            # waveform read back, acquisition complete
+            self._release()
+        return ret
+
+    async def _flush(self):
+        await asyncio.sleep(self.merge_window)
+        batch, self._batch = self._batch, None
+
+        # offset of each distinct request in the upstream exchange
+        offsets, upstream = {}, []
+        for addrs, _fut in batch:
+            key = tuple(addrs)
+            if key not in offsets:
+                offsets[key] = len(upstream)
+                upstream.extend(addrs)
+        try:
+            self.stats['upstream'] += 1
+            vals = await self.dev.exchange(upstream)
+        except Exception as e:
+            for _addrs, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for addrs, fut in batch:
+            if not fut.done():
+                start = offsets[tuple(addrs)]
+                fut.set_result(vals[start:start + len(addrs)])
+
+    async def write(self, addrs, values, client=None):
+        """Pass through a request with writes, in order.
+        :returns: An array of values.
+        """
+        if self.acq_addrs.intersection(
+                [A for A, V in zip(addrs, values) if V is not None]):
+            await self._acquire(client)
+
+        dev = self.dev
+        ret = numpy.zeros(len(addrs), be32)
+        # chunks in sequence, as a write may depend on an earlier read
+        for C in dev._pack(addrs, values):
+            self.stats['upstream'] += 1
+            await dev._run([C], ret)
+        return ret
+
+    async def _acquire(self, client):
+        """Take, or wait up to self.hold for, the acquisition lease.
+        Raises Busy if it is still held by another client.
+        """
+        give_up = time.monotonic() + self.hold
+        held = False
+        while self._holder is not None and self._holder[0] != client:
+            now = time.monotonic()
+            remain = self._holder[1] - now
+            if remain <= 0:
+                _log.debug('Acquisition lease of %s expires',
+                           self._holder[0])
+                break
+            if now >= give_up:
+                raise Busy()
+            if not held:
+                self.stats['held'] += 1
+                held = True
+            self._released.clear()
+            try:
+                await asyncio.wait_for(self._released.wait(),
+                                       min(remain, give_up - now))
+            except asyncio.TimeoutError:
+                pass
+        self._holder = (client, time.monotonic() + self.lease)
+
+    def _release(self):
+        self._holder = None
+        self._released.set()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        for T in list(self._tasks):
+            T.cancel()
+        self.dev.close()
+
+
+async def serve(upstream, bind=('127.0.0.1', 50006), merge_window=0.001,
+                lease=1.0, hold=0.05, window=8, **kws):
+    """Connect to a device, and start serving clients.
+
+    :param str upstream: Device address "leep://<ip>[:<port>]"
+    :param tuple bind: Local (host, port) to listen on.
+    :param int window: Requests in flight to the device.
+    :returns: A :py:class:`Board`.  Call close() to stop.
+    """
+    dev = await aio_open(upstream, window=window, **kws)
+    board = Board(dev, merge_window=merge_window, lease=lease, hold=hold)
+    try:
+        loop = asyncio.get_running_loop()
+        board.transport, _proto = await loop.create_datagram_endpoint(
+            lambda: _Protocol(board), local_addr=bind)
+    except Exception:
+        board.close()
+        raise
+    _log.info('Proxy %s:%d -> %s', bind[0], bind[1], upstream)
+    return board
+
+
+def getargs():
+    from argparse import ArgumentParser
+    P = ArgumentParser(description='Aggregating LEEP proxy')
+    P.add_argument('-d', '--debug', action='store_const',
+                   const=logging.DEBUG, default=logging.INFO)
+    P.add_argument('-t', '--timeout', type=float, default=0.1,
+                   help='Upstream timeout (seconds)')
+    P.add_argument('-W', '--merge-window', type=float, default=0.001,
+                   help='Read merge window (seconds)')
+    P.add_argument('-w', '--window', type=int, default=8,
+                   help='Upstream requests in flight')
+    P.add_argument('-l', '--lease', type=float, default=1.0,
+                   help='Acquisition lease (seconds)')
+    P.add_argument('-B', '--burst', action='store_true', default=False,
+                   help='Probe devices for block-transfer support'
+                        ' (writes address 2 of a gateway without it)')
+    P.add_argument('-H', '--hold', type=float, default=0.05,
+                   help='Longest hold of a write during another acquisition'
+                        ' (seconds).  Keep below the client timeout.')
+    P.add_argument('-M', '--metrics', metavar='[HOST:]PORT',
+                   help='Serve Prometheus metrics over HTTP')
+    P.add_argument('boards', nargs='+', metavar='[HOST:]PORT=URI',
+                   help='Local address, and device leep://host[:port]')
+    return P.parse_args()
+
+
+def metrics(boards):
+    """:returns: Statistics of boards in the Prometheus text format.
+    """
+    devs = dict(('%s:%d' % B.dev.dest[:2], B.dev) for B in boards)
+    return to_prometheus(devs) + to_prometheus(
+        dict(('%s:%d' % B.dev.dest[:2], B.stats) for B in boards),
+        prefix='leep_proxy')
+
+
+async def amain(args):
+    boards, server = [], None
+    try:
+        for spec in args.boards:
+            local, _eq, upstream = spec.partition('=')
+            host, _sep, port = local.rpartition(':')
+            boards.append(await serve(upstream,
+                                      bind=(host or '127.0.0.1', int(port)),
+                                      merge_window=args.merge_window,
+                                      window=args.window, lease=args.lease,
+                                      hold=args.hold, timeout=args.timeout,
+                                      allow_burst=args.burst))
+        if args.metrics:
+            host, _sep, port = args.metrics.rpartition(':')
+            server = serve_metrics(lambda: metrics(boards),
+                                   bind=(host or '127.0.0.1', int(port)))
+        await asyncio.Event().wait()  # forever
+    finally:
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+        for board in boards:
+            board.close()
+
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.debug)
+    try:
+        asyncio.run(amain(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,28 @@
 from __future__ import print_function
 import numpy
 from datetime import datetime
+import hashlib
 import json
 import zlib
-import random
-import socket
 import sys
+import time
+import threading
+from collections import deque
 from functools import reduce
 
 from . import RomError
-from .base import DeviceBase, print_reg
+from .base import DeviceBase, ReadPlan, WritePlan, print_reg
+from .romcache import RomCache
+from .stats import timed
+from .transport import Transport, pack, be32, MAX_WORDS, MAX_BURST
 import logging
 
 
 _log = logging.getLogger(__name__)
-# special logger for use in exchange()
-_spam = logging.getLogger(__name__ + '.packets')
-_spam.propagate = False
 
 if sys.version_info >= (3, 0):
     unicode = str
 
-be32 = numpy.dtype('>u4')
 be16 = numpy.dtype('>u2')
 
 
@@ -105,7 +106,138 @@ def yscale_rfs(wave_samp_per=1):
         raise RuntimeError("yscale_rfs(%s) %s" % (wave_samp_per, e))
 
 
+def _base_addr(info):
+    base_addr = info['base_addr']
+    if isinstance(base_addr, (bytes, str, unicode)):
+        base_addr = int(base_addr, 0)
+    return base_addr
+
+
+class LEEPReadPlan(ReadPlan):
+    """A prepared LEEPDevice.reg_read()
+
+    Holds the encoded request messages, and the location and sign of
+    each register in the reply.
+    """
+
+    def __init__(self, dev, names):
+        ReadPlan.__init__(self, dev, names)
+        addrs = []
+        # (name, start, stop, signed, scalar) for each register
+        self.regs = []
+        # sign extension mask for each word, or None
+        self.ext = None
+        signed = []
+        for name in names:
+            info = dev.get_reg_info(name, instance=None)
+            L = 2**info.get('addr_width', 0)
+            base_addr = _base_addr(info)
+
+            sign = info.get('sign', 'unsigned') == 'signed'
+            if sign:
+                # mask of data bits excluding sign bit
+                mask = (2**(info['data_width'] - 1)) - 1
+                # invert to give mask of sign bit and extension bits
+                mask ^= 0xffffffff
+                signed.append((len(addrs), len(addrs) + L, mask))
+
+            scalar = info.get('addr_width', 0) == 0
+            self.regs.append((name, len(addrs), len(addrs) + L, sign, scalar))
+            addrs.extend(range(base_addr, base_addr + L))
+
+        if signed:
+            self.ext = numpy.zeros(len(addrs), dtype='u4')
+            for start, stop, mask in signed:
+                self.ext[start:stop] = mask
+
+        self.size = len(addrs)
+        self.chunks = dev._pack(addrs, [None] * len(addrs))
+
+    def decode(self, raw):
+        """Split and sign extend the words read.
+        raw is modified.
+        """
+        if self.ext is not None:
+            # extend only negative numbers
+            neg = (raw & self.ext) != 0
+            raw |= numpy.where(neg, self.ext, 0).astype('u4')
+
+        ret = []
+        for name, start, stop, sign, scalar in self.regs:
+            data = raw[start:stop]
+            if sign:
+                # cast to signed
+                data = data.view('i4')
+            _log.debug('reg_read %s -> %s ...', name, data[:10])
+            # unwrap scalar from ndarray
+            if scalar:
+                data = data[0]
+            ret.append(data)
+
+        return ret
+
+
+class LEEPWritePlan(WritePlan):
+    """A prepared LEEPDevice.reg_write()
+
+    Holds the encoded request messages, into which values are placed.
+    """
+
+    def __init__(self, dev, names):
+        WritePlan.__init__(self, dev, names)
+        addrs = []
+        self.regs = []  # (name, start, stop, scalar) for each register
+        for name in names:
+            info = dev.get_reg_info(name, instance=None)
+            L = 2**info.get('addr_width', 0)
+            base_addr = _base_addr(info)
+
+            self.regs.append((name, len(addrs), len(addrs) + L, L == 1))
+            addrs.extend(range(base_addr, base_addr + L))
+
+        self.size = len(addrs)
+        self.chunks = dev._pack(addrs, [0] * len(addrs))
+
+    def encode(self, values):
+        """:returns: Messages, as from _pack(), to write values.
+        """
+        assert len(values) == len(self.regs), (len(values), self.names)
+
+        flat = numpy.empty(self.size, dtype=be32)
+        for (name, start, stop, scalar), value in zip(self.regs, values):
+            value = numpy.asarray(value, dtype='I')
+
+            if not scalar:
+                _log.debug('reg_write %s <- %s ...', name, value[:10])
+                assert value.ndim == 1 and value.shape[0] == stop - start, \
+                       ('must write whole register', value.shape,
+                        stop - start)
+            else:
+                assert value.ndim == 0, 'scalar register'
+                _log.debug('reg_write %s <- %s', name, value)
+            flat[start:stop] = value
+
+        ret = []
+        for offset, msg, layout in self.chunks:
+            didx = layout[0]
+            msg = msg.copy()
+            msg[didx] = flat[offset:offset + len(didx)]
+            ret.append((offset, msg, layout))
+        return ret
+
+
 class LEEPDevice(DeviceBase):
+    """Device accessed over UDP.
+
+    May be shared between threads.  Concurrent exchanges each use a
+    socket (source port) from a pool of up to max_sockets, while the
+    regmap and cached plans are shared.  Acquisition (wait_for_acq() etc.)
+    is one handshake per device, and should be done from one thread.
+
+    Block-transfer/repeat-count (burst) is used with force_burst, or with
+    allow_burst if a probe finds it.  The probe writes to address 2 of a
+    gateway without burst support, so is not done by default.
+    """
     backend = 'leep'
     init_rom_addr = 0x800
     max_rom_addr = 0x4000
@@ -118,20 +250,57 @@ class LEEPDevice(DeviceBase):
         (hash and description) is one.
     '''
     hash_descriptor_size = 24
+    max_words = MAX_WORDS
+    max_burst = MAX_BURST
+    # size limit of reg_read()/reg_write() plan cache
+    max_plans = 256
+    # bounds on time between polls in wait_for_acq()
+    acq_poll_min = 0.0005
+    acq_poll_max = 0.05
     size_desc = 0
     size_rom = 0
     the_rom = []
 
-    def __init__(self, addr, timeout=0.1, **kws):
+    def __init__(self, addr, timeout=0.1, window=1, retries=2,
+                 allow_burst=False, force_burst=False, rom_cache=True,
+                 write_retries=0, min_timeout=0.002, max_sockets=8, **kws):
         DeviceBase.__init__(self, **kws)
         host, _sep, port = addr.partition(':')
         self.dest = (host, int(port or '50006'))
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
-        self.sock.settimeout(timeout)
+        # timeout and retry policy, see leep.transport.Transport
+        self.transport = Transport(self.dest, timeout=timeout,
+                                   window=window, retries=retries,
+                                   write_retries=write_retries,
+                                   min_timeout=min_timeout,
+                                   stats=self.stats)
+        self.sock = self.transport.sock
+        # idle transports, and limit on all.  see _run()
+        self._idle = deque([self.transport])
+        self._transports = [self.transport]
+        self._slots = threading.BoundedSemaphore(max_sockets)
+        self._plans = {}  # see _cached_plan()
+        self._local = threading.local()  # per-thread buffers
+        self._timebases = {}  # see _timebase()
+        self._writes = 0  # count of writes, see iter_acquisitions()
+        self._set_rom_cache(rom_cache)
+
+        # block-transfer/repeat-count support, probed once
+        if force_burst:
+            self.burst_avail = True
+        elif allow_burst:
+            self.burst_avail = self.transport.probe_burst()
+        else:
+            self.burst_avail = False
 
         self._readrom()
+        self._app_detect()
 
+    def close(self):
+        for T in self._transports:
+            T.close()
+
+    def _app_detect(self):
         try:
             app_string = self.regmap["__metadata__"]["application"]
         except KeyError:
@@ -146,92 +315,71 @@ class LEEPDevice(DeviceBase):
         else:
             self.rfs = True
 
+    def _cached_plan(self, cls, names, instance):
+        """Plan for reg_read()/reg_write(), reused when the same
+        names and instance are seen again.
+        """
+        key = (cls, tuple(names),
+               None if instance is None else tuple(instance))
+        plan = self._plans.get(key)
+        if plan is None:
+            if instance is not None:
+                names = [self.expand_regname(name, instance=instance)
+                         for name in names]
+            if len(self._plans) >= self.max_plans:
+                self._plans.clear()
+            plan = self._plans[key] = cls(self, names)
+        return plan
+
+    def prepare_read(self, names, instance=[]):
+        if instance is not None:
+            names = [self.expand_regname(name, instance=instance)
+                     for name in names]
+        return LEEPReadPlan(self, names)
+
+    def prepare_write(self, names, instance=[]):
+        if instance is not None:
+            names = [self.expand_regname(name, instance=instance)
+                     for name in names]
+        return LEEPWritePlan(self, names)
+
+    prepare_read.__doc__ = DeviceBase.prepare_read.__doc__
+    prepare_write.__doc__ = DeviceBase.prepare_write.__doc__
+
+    def _plan_read(self, plan, raw=None):
+        if raw is None:
+            raw = numpy.empty(plan.size, dtype='u4')
+        self._run(plan.chunks, raw)
+        return plan.decode(raw)
+
+    def _plan_write(self, plan, values):
+        self._writes += 1
+        self._run(plan.encode(values), None)
+
     @print_reg
     def reg_write(self, ops, instance=[]):
-
         assert isinstance(ops, (list, tuple))
 
-        addrs, values = [], []
-        for name, value in ops:
-            if instance is not None:
-                name = self.expand_regname(name, instance=instance)
-            info = self.get_reg_info(name, instance=None)
-            L = 2**info.get('addr_width', 0)
-
-            base_addr = info['base_addr']
-            if isinstance(base_addr, (bytes, unicode)):
-                base_addr = int(base_addr, 0)
-
-            value = numpy.asarray(value, dtype='I')
-
-            if L > 1:
-                _log.debug('reg_write %s <- %s ...', name, value[:10])
-                assert value.ndim == 1 and value.shape[0] == L, \
-                       ('must write whole register', value.shape, L)
-                # array register
-                for A, V in enumerate(value, base_addr):
-                    addrs.append(A)
-                    values.append(V)
-            else:
-                assert value.ndim == 0, 'scalar register'
-                _log.debug('reg_write %s <- %s', name, value)
-                addrs.append(base_addr)
-                values.append(value)
-
-        addrs = numpy.asarray(addrs)
-        values = numpy.asarray(values)
-
-        self.exchange(addrs, values)
+        plan = self._cached_plan(LEEPWritePlan, [op[0] for op in ops],
+                                 instance)
+        self._plan_write(plan, [op[1] for op in ops])
 
     @print_reg
+    @timed('reg_read')
     def reg_read(self, names, instance=[]):
-        addrs = []
-        lens = []
-        for name in names:
-            if instance is not None:
-                name = self.expand_regname(name, instance=instance)
-            info = self.get_reg_info(name, instance=None)
-            L = 2**info.get('addr_width', 0)
+        return self._plan_read(
+            self._cached_plan(LEEPReadPlan, names, instance))
 
-            lens.append((info, L))
-            base_addr = info['base_addr']
-            if isinstance(base_addr, (bytes, str, unicode)):
-                base_addr = int(base_addr, 0)
-            addrs.extend(range(base_addr, base_addr + L))
-
-        raw = self.exchange(addrs)
-
-        ret = []
-        for i, (info, L) in enumerate(lens):
-            data, raw = raw[:L], raw[L:]
-            assert len(data) == L, (len(data), L)
-            if info.get('sign', 'unsigned') == 'signed':
-                # sign extend
-                # mask of data bits excluding sign bit
-                mask = (2**(info['data_width'] - 1)) - 1
-                # invert to give mask of sign bit and extension bits
-                mask ^= 0xffffffff
-                # test sign bit
-                neg = (data & mask) != 0
-                # extend only negative numbers
-                data[neg] |= mask
-                # cast to signed
-                data = data.astype('i4')
-            _log.debug('reg_read %s -> %s ...', names[i], data[:10])
-            # unwrap scalar from ndarray
-            if info.get('addr_width', 0) == 0:
-                data = data[0]
-            ret.append(data)
-
-        return ret
-
-    def set_decimate(self, dec, instance=[]):
+    def _yscale(self, dec):
         if self.rfs:
-            wave_shift, _Ymax = yscale_rfs(dec)
+            return yscale_rfs(dec)
         elif self.resctrl:
-            wave_shift, _Ymax = yscale_resctrl(dec)
+            return yscale_resctrl(dec)
         elif self.injector:
-            wave_shift, _Ymax = yscale_inj(dec)
+            return yscale_inj(dec)
+
+    def set_decimate(self, dec, instance=[]):
+        wave_shift, _Ymax = self._yscale(dec)
 
         assert dec >= 1 and dec <= 255
         self.reg_write([
@@ -243,8 +391,8 @@ class LEEPDevice(DeviceBase):
         return self.reg_read(['wave_samp_per'],
                              instance=instance)
 
-    def set_channel_mask(self, chans=[], instance=[]):
-        """Enabled specified channels.
+    def _channel_mask(self, chans, instance=[]):
+        """Translate a list of channel numbers to a chan_keep bit mask.
         """
         info = self.get_reg_info('chan_keep', instance=instance)
         nch = info['data_width']
@@ -252,27 +400,21 @@ class LEEPDevice(DeviceBase):
         if isinstance(chans, list):
             chans = reduce(lambda l, r: l | r,
                            [2**(nch - 1 - n) for n in chans], 0)
+        return chans
+
+    def set_channel_mask(self, chans=[], instance=[]):
+        """Enabled specified channels.
+        """
+        chans = self._channel_mask(chans, instance=instance)
         self.reg_write([('chan_keep', chans)], instance=instance)
 
     def get_channel_mask(self, instance=[]):
         chans, =  self.reg_read(['chan_keep'], instance=instance)
         return chans
 
-    def wait_for_acq(self, tag=False, toggle_tag=False, timeout=5.0,
-                     instance=[]):
-        """Wait for next waveform acquisition to complete.
-        If tag=True, then wait for the next acquisition which includes the
-        side-effects of all preceding register writes
+    def _acq_mask(self, instance=[]):
+        """circle_buf_flip/ready bit mask for an instance
         """
-        start = datetime.utcnow()
-
-        if self.rfs:
-            T, = self.reg_read(['dsp_tag'], instance=instance)
-            if tag or toggle_tag:
-                T = (T + 1) & 0xff
-                self.reg_write([('dsp_tag', T)], instance=instance)
-                _log.debug('Set Tag %d', T)
-
         inst = self.instance + instance
         # assume that the shell_#_ number is the first
         mask = 1
@@ -281,211 +423,467 @@ class LEEPDevice(DeviceBase):
 
         if self.resctrl:
             mask = 0xF  # Always re-arm 4 channels
+        return mask
 
-        while True:
-            if self.injector:
-                self.reg_write([('circle_buf_flip', mask)], instance=[])
-            else:
-                self.reg_write([('circle_buf_flip', mask)], instance=None)
+    def _acq_flip(self):
+        """Full name of the register which re-arms acquisition
+        """
+        if self.injector:
+            return self.expand_regname('circle_buf_flip', instance=[])
+        else:
+            return 'circle_buf_flip'
 
-            while True:
-                now = datetime.utcnow()
-                delta = now - start
-                delta_us = delta.seconds + delta.microseconds / 1e6
-                if delta_us >= timeout:
-                    raise RuntimeError('Timeout')
+    def _acq_ready_reg(self):
+        if self.rfs or self.injector:
+            return 'llrf_circle_ready'
+        else:
+            return 'circle_data_ready'
 
-                ''' TODO:
-                    use exchange() and optimize to fetch slow_data[33] as well
-                '''
-                if self.rfs or self.injector:
-                    ready_register = 'llrf_circle_ready'
-                else:
-                    ready_register = 'circle_data_ready'
-                ready, = self.reg_read([ready_register], instance=None)
+    def _acq_tag_match(self, T, slow, check=True):
+        """Compare dsp_tag with the tags of an acquisition.
+        If check, raise if another client has changed the tag.
+        """
+        tag_old = slow[34]
+        tag_new = slow[33]
+        dT = (tag_old - T) & 0xff
+        tag_match = dT == 0 and tag_new == tag_old
+
+        if check and not tag_match and dT != 0xff:
+            msg = 'acquisition collides with another client:'
+            msg += '%d %d %d' % (tag_old, tag_new, T)
+            raise RuntimeError(msg)
+        return tag_match
 
-                if ready & mask:
-                    break
+    def _acq_interval(self, keep, dec, instance=[]):
+        """Time between ready polls.  A fraction of the time to fill
+        the waveform buffer.
+        """
+        try:
+            names, inst = self._channel_regs(instance)
+            info = self.get_reg_info(names[-1], instance=inst)
+            nbits = bin(keep).count('1') or 1
+            fill = (2**info['addr_width'] // nbits) * self._sample_period(dec)
+        except (KeyError, IndexError, RuntimeError, TypeError,
+                ZeroDivisionError):
+            # eg. RES_CTRL w/o instance, which circle_data_# is unknown.
+            # Poll at the fixed, shortest interval
+            fill = 0.0
+        return min(max(fill / 16, self.acq_poll_min), self.acq_poll_max)
+
+    def _acq_steps(self, instances, tag=False, toggle_tag=False,
+                   timeout=5.0):
+        """Wait for acquisition of each of several instances (shells).
+
+        A generator yielding I/O steps, run by _drive().  Per re-arm:
+        one exchange writes the tag(s) and circle_buf_flip for all
+        instances.  Each poll is one exchange reading the ready bits
+        and, for rfs, the slow_data (with tags) of every instance.
+        Polls are spaced by a fraction of the buffer fill time.
+
+        Returns a list with the wait_for_acq() result of each instance.
+        """
+        start = time.monotonic()
+        N = len(instances)
+        masks = [self._acq_mask(inst) for inst in instances]
 
+        # one exchange to read current tags and acquisition settings
+        names = []
+        for inst in instances:
             if self.rfs:
-                slow, = self.reg_read(['slow_data'], instance=instance)
-                tag_old = slow[34]
-                tag_new = slow[33]
-                dT = (tag_old - T) & 0xff
-                tag_match = dT == 0 and tag_new == tag_old
+                names.append(self.expand_regname('dsp_tag', instance=inst))
+            # as read by get_channels()
+            cinst = self._channel_instance(inst)
+            names.append(self.expand_regname('chan_keep', instance=cinst))
+            names.append(self.expand_regname('wave_samp_per',
+                                             instance=cinst))
+        vals = yield ('read', self._cached_plan(LEEPReadPlan, names, None))
+        if self.rfs:
+            T = list(vals[0::3])
+            keep, dec = vals[1], vals[2]
+        else:
+            T = [None] * N
+            keep, dec = vals[0], vals[1]
+        interval = self._acq_interval(keep, dec, instances[0])
+
+        # re-arm, w/ new tags the first time
+        wnames, wvals = [], []
+        if self.rfs and (tag or toggle_tag):
+            for i, inst in enumerate(instances):
+                T[i] = (T[i] + 1) & 0xff
+                wnames.append(names[3 * i])
+                wvals.append(T[i])
+                _log.debug('Set Tag %d', T[i])
+        flip = self._acq_flip()
+
+        # ready bits, then slow_data of each
+        pnames = [self._acq_ready_reg()]
+        if self.rfs:
+            pnames += [self.expand_regname('slow_data', instance=inst)
+                       for inst in instances]
+        poll = self._cached_plan(LEEPReadPlan, pnames, None)
+
+        ret = [None] * N
+        pending = list(range(N))
+        while pending:
+            mask = reduce(lambda a, b: a | b, [masks[i] for i in pending])
+            yield ('write',
+                   self._cached_plan(LEEPWritePlan, wnames + [flip], None),
+                   wvals + [mask])
+            wnames, wvals = [], []
 
-                if not tag:
+            while True:
+                vals = yield ('read', poll)
+                ready = vals[0]
+                if all([ready & masks[i] for i in pending]):
                     break
 
-                if tag_match:
+                remain = timeout - (time.monotonic() - start)
+                if remain <= 0:
+                    raise RuntimeError('Timeout')
+                yield ('sleep', min(interval, remain))
+
+            now = datetime.utcnow()
+            for i in pending[:]:
+                if not self.rfs:
+                    ret[i] = now
+                    pending.remove(i)
+                    continue
+                slow = vals[1 + i]
+                tag_match = self._acq_tag_match(T[i], slow, check=tag)
+
+                if not tag or tag_match:
                     # all done, waveform reflects latest parameter changes
+                    ret[i] = (tag_match, slow, now)
+                    pending.remove(i)
+
+            if pending:
+                _log.debug('Acquire retry')
+
+        return ret
+
+    def _step(self, op):
+        """Perform one I/O step.
+        ('read', plan[, raw]), ('write', plan, values), or ('sleep', dt)
+        """
+        if op[0] == 'read':
+            return self._plan_read(*op[1:])
+        elif op[0] == 'write':
+            return self._plan_write(op[1], op[2])
+        elif op[0] == 'sleep':
+            return time.sleep(op[1])
+        raise ValueError(op[0])
+
+    def _drive(self, steps):
+        """Run the I/O steps yielded by a generator.
+        :returns: The generator return value.
+        """
+        R = None
+        try:
+            while True:
+                R = self._step(steps.send(R))
+        except StopIteration as e:
+            return e.value
+
+    @timed('wait_for_acq')
+    def wait_for_acq(self, tag=False, toggle_tag=False, timeout=5.0,
+                     instance=[]):
+        """Wait for next waveform acquisition to complete.
+        If tag=True, then wait for the next acquisition which includes the
+        side-effects of all preceding register writes
+        """
+        ret, = self._drive(self._acq_steps([instance], tag=tag,
+                                           toggle_tag=toggle_tag,
+                                           timeout=timeout))
+        return ret
+
+    def _acquire_steps(self, chans, instances, tag=False, toggle_tag=False,
+                       timeout=5.0, dtype=None):
+        waits = yield from self._acq_steps(instances, tag=tag,
+                                           toggle_tag=toggle_tag,
+                                           timeout=timeout)
+        # read back waveforms of all instances in one exchange
+        names = []
+        for inst in instances:
+            regs, rinst = self._channel_regs(inst)
+            names.extend([self.expand_regname(reg, instance=rinst)
+                          if rinst is not None else reg for reg in regs])
+        vals = yield ('read', self._cached_plan(LEEPReadPlan, names, None))
+
+        ret = []
+        for i, inst in enumerate(instances):
+            keep, dec, data = vals[3 * i:3 * i + 3]
+            ret.append((waits[i], self._demux(chans, keep, dec, data,
+                                              instance=inst, dtype=dtype)))
+        return ret
+
+    def acquire(self, chans, instances=[[]], tag=False, toggle_tag=False,
+                timeout=5.0, dtype=None):
+        """Arm, wait for, and read back waveforms of several instances
+        (eg. shells) together.
+
+        >>> (W0, (A0, B0)), (W1, (A1, B1)) = dev.acquire([0, 1], [[0], [1]])
+
+        :param list chans: Channel numbers, as for get_channels().
+        :param list instances: A list of instance lists.
+        :returns: A list with a tuple for each instance.  The result of
+                  wait_for_acq(), and that of get_channels().
+        """
+        return self._drive(self._acquire_steps(chans, instances, tag=tag,
+                                               toggle_tag=toggle_tag,
+                                               timeout=timeout, dtype=dtype))
+
+    def _stream_steps(self, chans, instance=[], depth=2, tag=False,
+                      timeout=5.0, dtype=None):
+        """I/O steps of iter_acquisitions().  Also yields
+        ('record', (timestamp, tag, channels)).
+        """
+        names, inst = self._channel_regs(instance)
+        # config and data, or data alone when config is unchanged
+        full = self._cached_plan(LEEPReadPlan, names, inst)
+        data = self._cached_plan(LEEPReadPlan, names[2:], inst)
+        raw = numpy.empty(full.size, 'u4')
+
+        mask = self._acq_mask(instance)
+        arm = self._cached_plan(LEEPWritePlan, [self._acq_flip()], None)
+        pnames = [self._acq_ready_reg()]
+        if self.rfs:
+            pnames.append(self.expand_regname('slow_data', instance=instance))
+        poll = self._cached_plan(LEEPReadPlan, pnames, None)
+
+        W, = yield from self._acq_steps([instance], tag=tag, timeout=timeout)
+        if self.rfs:
+            _tag_match, slow, now = W
+            T = slow[33]
+        else:
+            now, T = W, None
+
+        config, seen = None, None
+        bufs = [None] * max(1, depth)
+        n = 0
+        while True:
+            if self._writes != seen:
+                keep, dec, wf = yield ('read', full, raw)
+                config = keep, dec
+                interval = self._acq_interval(keep, dec, instance)
+            else:
+                wf, = yield ('read', data, raw[2:])
+                keep, dec = config
+
+            # re-arm before handing over the data.  The next buffer
+            # fills while the consumer works on this one.
+            yield ('write', arm, [mask])
+            seen = self._writes
+
+            out = bufs[n]
+            nbits = bin(keep).count('1') or 1
+            shape = (len(chans), len(wf) // nbits)
+            if out is None or out.shape != shape:
+                odtype = numpy.dtype('f8' if dtype is None else dtype)
+                out = bufs[n] = numpy.empty(shape, odtype)
+            n = (n + 1) % len(bufs)
+
+            yield ('record', (now, T, self._demux(chans, keep, dec, wf,
+                                                  instance=instance,
+                                                  out=out)))
+
+            start = time.monotonic()
+            while True:
+                vals = yield ('read', poll)
+                if vals[0] & mask:
                     break
+                remain = timeout - (time.monotonic() - start)
+                if remain <= 0:
+                    raise RuntimeError('Timeout')
+                yield ('sleep', min(interval, remain))
+            now = datetime.utcnow()
+            if self.rfs:
+                T = vals[1][33]
+
+    def iter_acquisitions(self, chans, instance=[], depth=2, tag=False,
+                          timeout=5.0, dtype=None):
+        """Continuous acquisition.  Per waveform, one poll exchange
+        (ready bits and slow_data) then a read of circle_data, followed
+        by immediate re-arm.  chan_keep and wave_samp_per are read once,
+        and again only after a register write through this device.
+
+        Result arrays are re-used.  Those of a record are overwritten
+        after depth further records.
 
-                if dT != 0xff:
-                    msg = 'acquisition collides with another client:'
-                    msg += '%d %d %d' % (tag_old, tag_new, T)
-                    raise RuntimeError(msg)
+        See :py:meth:`DeviceBase.iter_acquisitions`.
+
+        :param dtype: Result type, as for get_channels().
+        """
+        steps = self._stream_steps(chans, instance=instance, depth=depth,
+                                   tag=tag, timeout=timeout, dtype=dtype)
+        R = None
+        while True:
+            op = steps.send(R)
+            if op[0] == 'record':
+                R = None
+                yield op[1]
             else:
-                return now
+                R = self._step(op)
 
-            _log.debug('Acquire retry')
+    def _channel_instance(self, instance=[]):
+        """Instance to read get_channels() registers with
+        """
+        if self.resctrl:
+            return None
+        elif self.injector:
+            return []
+        return instance
 
-        # datetimestr = now.isoformat()+'Z'
-        return tag_match, slow, now
+    def _channel_regs(self, instance=[]):
+        """Registers read by get_channels(), and the instance to read with.
+        """
+        if self.resctrl:
+            return ['chan_keep', 'wave_samp_per',
+                    'circle_data_%s' % (instance[0])], None
+        return (['chan_keep', 'wave_samp_per', 'circle_data'],
+                self._channel_instance(instance))
 
-    def get_channels(self, chans=[], instance=[]):
-        """:returns: a list of :py:class:`numpy.ndarray` with the numbered channels.
-        chans may be a bit mask or a list of channel numbers
+    def _demux(self, chans, keep, dec, data, instance=[], out=None,
+               dtype=None):
+        """Split the raw circle buffer into scaled channels.
+
+        Channels are strided views of a (nsamp, nchan) reshape of data.
+        Scaling, if any, is applied while copying into out.
         """
         info = self.get_reg_info('chan_keep', instance=instance)
         nch = info['data_width']
         interested = reduce(lambda l, r: l | r,
                             [2**(nch - 1 - n) for n in chans], 0)
 
-        if self.rfs:
-            keep, dec = self.reg_read(['chan_keep', 'wave_samp_per'],
-                                      instance=instance)
-            data, = self.reg_read(['circle_data'], instance=instance)
-            wave_shift, Ymax = yscale_rfs(dec)
-        else:
-            if self.resctrl:
-                keep, dec = self.reg_read(['chan_keep', 'wave_samp_per'],
-                                          instance=None)
-                data, = self.reg_read(['circle_data_%s' % (instance[0])],
-                                      instance=None)
-                wave_shift, Ymax = yscale_resctrl(dec)
-            elif self.injector:
-                keep, dec = self.reg_read(['chan_keep', 'wave_samp_per'],
-                                          instance=[])
-                data, = self.reg_read(['circle_data'], instance=[])
-                wave_shift, Ymax = yscale_inj(dec)
-
-        # assume wave_shift has been set properly
-        assert Ymax != 0, dec
-
         if (keep & interested) != interested:
             # chans must be a strict sub-set of keep
             msg = 'Requested channels (%x) not kept (%x)' % (interested, keep)
             raise RuntimeError(msg)
 
-        # count number of bits set
-        nbits, M = 0, keep
-        while M != 0:
-            if M & 1:
-                nbits += 1
-            M >>= 1
+        # number of bits set
+        nbits = bin(keep).count('1')
 
         # Lop off extra samples to get same number of samples per channel
-        L = len(data)
-        xtra = L % nbits
-        data = numpy.delete(data, range(L - xtra, L))
-        cdata, M = {}, 0
-        for ch in range(nch):
-            cmask = 2**(nch - 1 - ch)
-            if not (keep & cmask):
-                continue
-            if interested & cmask:
-                cdata[ch] = data[M::nbits] / Ymax
-
-            M += 1
-
-        # finally, ensure the results are in the same order as args
-        return list([cdata[ch] for ch in chans])
+        L = len(data) - len(data) % nbits
+        frames = data[:L].reshape(L // nbits, nbits)
+
+        # column of each channel.  Channel 0 is the MSB of keep,
+        # and the first sample in each frame.
+        cols = [bin(keep >> (nch - ch)).count('1') for ch in chans]
+
+        if dtype is None:
+            dtype = 'f8' if out is None else out[0].dtype
+        dtype = numpy.dtype(dtype)
+        if dtype.kind in 'iu':
+            # raw, unscaled
+            if out is None:
+                if dtype == frames.dtype:
+                    return [frames[:, M] for M in cols]  # no copy
+                return [frames[:, M].astype(dtype) for M in cols]
+            for M, dest in zip(cols, out):
+                dest[...] = frames[:, M]
+            return list(out)
+
+        wave_shift, Ymax = self._yscale(dec)
 
-    def get_timebase(self, chans=[], instance=[]):
+        # assume wave_shift has been set properly
+        assert Ymax != 0, dec
+
+        if out is None:
+            out = numpy.empty((len(chans), L // nbits), dtype=dtype)
+        for M, dest in zip(cols, out):
+            numpy.divide(frames[:, M], Ymax, out=dest, casting='unsafe')
+
+        # results are in the same order as args
+        return list(out)
+
+    @timed('get_channels')
+    def get_channels(self, chans=[], instance=[], out=None, dtype=None):
+        """:returns: a list of :py:class:`numpy.ndarray` with the numbered channels.
+        chans may be a bit mask or a list of channel numbers
+
+        :param out: Optional array of shape (len(chans), nsamp), or list of
+                    arrays, into which results are written and returned.
+        :param dtype: Result type.  Default float64, or out.dtype.
+                      Integer types give raw values, without scaling.
+        """
+        names, inst = self._channel_regs(instance)
+        plan = self._cached_plan(LEEPReadPlan, names, inst)
+        raw = None
+        if out is not None:
+            # steady state acquisition into out, re-use read buffer
+            scratch = getattr(self._local, 'scratch', None)
+            if scratch is None:
+                scratch = self._local.scratch = {}
+            raw = scratch.get(plan.size)
+            if raw is None:
+                raw = scratch[plan.size] = numpy.empty(plan.size, 'u4')
+        keep, dec, data = self._plan_read(plan, raw)
+        return self._demux(chans, keep, dec, data, instance=instance,
+                           out=out, dtype=dtype)
+
+    def _timebase_regs(self, instance=[]):
+        """Waveform register info, and the instance to read with.
+        """
         if self.rfs:
             info = self.get_reg_info('circle_data', instance=instance)
-            keep, dec = self.reg_read([
-                'chan_keep',
-                'wave_samp_per',
-            ], instance=instance)
-            period = 2 * 33 * dec * 14 / 1320e6
+            return info, instance
         else:
             info = self.get_reg_info('circle_%s_data' % instance[0],
                                      instance=None)
-            keep, dec = self.reg_read(['chan_keep', 'wave_samp_per'],
-                                      instance=None)
-            if self.resctrl:
-                period = dec / 8e3
-            elif self.injector:
-                period = 22 * dec * 140 / (11 * 1300e6)
-
-        totalsamp = 2**info['addr_width']
+            return info, None
 
-        # count number of bits set
-        nbits, M = 0, keep
-        while M != 0:
-            if M & 1:
-                nbits += 1
-            M >>= 1
-        # result is often one sample too long
-        T = numpy.arange(1 + totalsamp / nbits) * period
-
-        T = T.repeat(nbits)  # [a, b, ...] w/ nbits=2 --> [a, a, b, b, ...]
-        assert len(T) >= totalsamp, (len(T), totalsamp)
-        T = T[:totalsamp]  # clip to actual register size
+    def _sample_period(self, dec):
+        """Time between consecutive samples of a channel
+        """
+        if self.rfs:
+            return 2 * 33 * dec * 14 / 1320e6
+        elif self.resctrl:
+            return dec / 8e3
+        elif self.injector:
+            return 22 * dec * 140 / (11 * 1300e6)
 
-        # T now contains time of the sample read from each address
+    def _timebase(self, chans, info, keep, dec):
+        period = self._sample_period(dec)
 
-        # demux into logical channels of the appropriate length
-        # eg. if chan_keep selects an odd number of channels, then
-        # some will be one sample shorter.
-        return [T[i::nbits] for i in range(len(chans))]
+        totalsamp = 2**info['addr_width']
+        nbits = bin(keep).count('1')
+
+        key = (totalsamp, nbits, period, len(chans))
+        T = self._timebases.get(key)
+        if T is None:
+            # The time of the sample read from each address is
+            # (address // nbits) * period.  Demux into logical channels
+            # of the appropriate length.  eg. if chan_keep selects an odd
+            # number of channels, then some will be one sample shorter.
+            T = []
+            for i in range(len(chans)):
+                t = numpy.arange(len(range(i, totalsamp, nbits))) * period
+                t.flags.writeable = False  # shared by later calls
+                T.append(t)
+            if len(self._timebases) > 16:
+                self._timebases.clear()
+            self._timebases[key] = T
+        return list(T)
 
-    def _exchange(self, addrs, values=None):
-        """Exchange a single low level message
+    def get_timebase(self, chans=[], instance=[]):
+        info, inst = self._timebase_regs(instance)
+        keep, dec = self.reg_read(['chan_keep', 'wave_samp_per'],
+                                  instance=inst)
+        return self._timebase(chans, info, keep, dec)
+
+    def _pack(self, addrs, values):
+        """Encode address/value lists as a list of request messages.
+        See :py:func:`transport.pack`
         """
-        pad = None
-        if len(addrs) < 3:
-            pad = 3 - len(addrs)
-            addrs.extend([0] * pad)
-            values.extend([None] * pad)
-
-        msg = numpy.zeros(2 + 2 * len(addrs), dtype=be32)
-        msg[0] = random.randint(0, 0xffffffff)
-        msg[1] = msg[0] ^ 0xffffffff
-
-        for i, (A, V) in enumerate(zip(addrs, values), 1):
-            A &= 0x00ffffff
-            if V is None:
-                A |= 0x10000000
-            msg[2 * i] = A
-            msg[2 * i + 1] = V or 0
-
-        tosend = msg.tostring()
-        _spam.debug("%s Send (%d) %s", self.dest, len(tosend), repr(tosend))
-        self.sock.sendto(tosend, self.dest)
-
-        while True:
-            reply, src = self.sock.recvfrom(1024)
-            _spam.debug("%s Recv (%d) %s", src, len(reply), repr(reply))
-
-            if len(reply) % 8:
-                reply = reply[:-(len(reply) % 8)]
-
-            if len(tosend) != len(reply):
-                _log.error("Reply truncated %d %d", len(tosend), len(reply))
-                continue
-
-            reply = numpy.fromstring(reply, be32)
-            if (msg[:2] != reply[:2]).any():
-                _log.error('Ignore reply w/o matching nonce %s %s',
-                           msg[:2], reply[:2])
-                continue
-            elif (msg[2::2] != reply[2::2]).any():
-                _log.error('reply addresses are out of order')
-                continue
-
-            break
-
-        ret = reply[3::2]
-        if pad:
-            ret = ret[:-pad]
-        return ret
+        return pack(addrs, values, burst=self.burst_avail,
+                    max_words=self.max_words, max_burst=self.max_burst)
 
     def exchange(self, addrs, values=None):
         """Accepts a list of address and values (None to read).
         Returns a numpy.ndarray in the same order.
+
+        Requests longer than one packet are split into chunks.
+        With window > 1, up to that many chunks are kept in flight.
         """
         addrs = list(addrs)
 
@@ -493,22 +891,67 @@ class LEEPDevice(DeviceBase):
             values = [None] * len(addrs)
         else:
             values = list(values)
+            self._writes += 1
 
         ret = numpy.zeros(len(addrs), be32)
-        for i in range(0, len(addrs), 127):
-            A, B = addrs[i:i + 127], values[i:i + 127]
+        self._run(self._pack(addrs, values), ret)
+        return ret
 
-            P = self._exchange(A, B)
-            ret[i:i + 127] = P
+    @timed('exchange')
+    def _run(self, chunks, ret):
+        """Exchange messages from _pack().
+        Reply data is stored in ret, unless ret is None.
 
-        return ret
+        Uses an idle transport, or opens another for a concurrent caller.
+        """
+        with self._slots:
+            try:
+                T = self._idle.pop()
+            except IndexError:
+                T = self.transport.clone()
+                self._transports.append(T)
+            try:
+                T.run(chunks, ret)
+            finally:
+                self._idle.append(T)
+
+    def _set_rom_cache(self, rom_cache):
+        """rom_cache may be True (default location), a directory name,
+        or False to disable.
+        """
+        self._rom_cache = None
+        if rom_cache:
+            path = None if rom_cache is True else rom_cache
+            self._rom_cache = RomCache(path)
+
+    def _rom_cache_load(self, preamble):
+        """Use cached ROM contents matching preamble.
+        :returns: ROM words, or None
+        """
+        if self._rom_cache is None:
+            return None
+        ent = self._rom_cache.load(preamble, self.jsonhash)
+        if ent is None:
+            return None
+        rom, self.regmap = ent
+        return rom
+
+    def _rom_cache_store(self, preamble, rom):
+        if self._rom_cache is None or self._json_sha1 != self.jsonhash:
+            # don't cache if the ROM JSON hash is missing or wrong
+            return
+        self._rom_cache.store(preamble, self.jsonhash, rom, self.regmap)
 
     def _trysize(self, start_addr):
+        self.rom_addr = start_addr
         end_addr = start_addr + self.preamble_max_size
         values = self.exchange(range(start_addr, end_addr))
         values_preamble = numpy.array(values)
         self._checkrom(values, True)
         if self.size_rom != 0:
+            values_full = self._rom_cache_load(values_preamble)
+            if values_full is not None:
+                return values_full
             total_rom_size = (self.hash_descriptor_size
                               + self.size_desc + self.size_rom)
             stop_addr = end_addr + total_rom_size - self.preamble_max_size
@@ -516,6 +959,7 @@ class LEEPDevice(DeviceBase):
             preamble_json = numpy.concatenate((values_preamble, values_json))
             values_full = numpy.array(preamble_json, be32)
             self._checkrom(values_full)
+            self._rom_cache_store(values_preamble, values_full)
             return values_full
         else:
             raise RomError("ROM not found, size is zero")
@@ -568,8 +1012,9 @@ class LEEPDevice(DeviceBase):
                     _log.error("Ignoring additional JSON blob in ROM")
                 else:
                     _log.debug("Found JSON blob in ROM")
-                    self.regmap = json.loads(zlib.decompress(
-                        blob.tostring()).decode('ascii'))
+                    text = zlib.decompress(blob.tostring())
+                    self._json_sha1 = hashlib.sha1(text).hexdigest()
+                    self.regmap = json.loads(text.decode('ascii'))
 
             elif type == 3:
                 self.size_rom = size
@@ -582,6 +1027,7 @@ class LEEPDevice(DeviceBase):
         self.codehash = None
         self.jsonhash = None
         self.regmap = None
+        self._json_sha1 = None
 
         # Try to read ROM at both addresses before raising error
         try:
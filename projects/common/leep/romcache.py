@@ -0,0 +1,96 @@
+"""On-disk cache of device ROM contents and parsed register maps.
+
+Entries are keyed by the ROM preamble, which holds the JSON and code
+hashes, and the description.  Only ROMs whose JSON hash checks out are
+stored.
+
+The cache directory is $LEEP_ROM_CACHE, or by default
+$XDG_CACHE_HOME/leep (~/.cache/leep).  Set LEEP_ROM_CACHE to an empty
+string to disable caching.
+"""
+
+import logging
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+import numpy
+
+_log = logging.getLogger(__name__)
+
+
+def cache_dir():
+    """:returns: Default cache directory, or None if disabled.
+    """
+    path = os.environ.get('LEEP_ROM_CACHE')
+    if path is not None:
+        return path or None
+    base = os.environ.get('XDG_CACHE_HOME') or \
+        os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'leep')
+
+
+class RomCache(object):
+    """Store and retrieve ROM contents.
+
+    :param str path: Cache directory.  Default from :py:func:`cache_dir`.
+    """
+    version = 1
+
+    def __init__(self, path=None):
+        self.path = path or cache_dir()
+
+    def _fname(self, preamble):
+        key = hashlib.sha1(numpy.asarray(preamble, '>u4').tobytes())
+        return os.path.join(self.path, key.hexdigest() + '.pickle')
+
+    def load(self, preamble, jsonhash):
+        """:returns: (rom, regmap) or None
+        """
+        if self.path is None or jsonhash is None:
+            return None
+        fname = self._fname(preamble)
+        try:
+            with open(fname, 'rb') as F:
+                ent = pickle.load(F)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            _log.warning('Ignore corrupt ROM cache %s: %s', fname, e)
+            return None
+
+        if not isinstance(ent, dict) or ent.get('version') != self.version \
+                or ent.get('jsonhash') != jsonhash:
+            _log.debug('Ignore stale ROM cache %s', fname)
+            return None
+
+        _log.debug('ROM cache hit %s', fname)
+        return numpy.frombuffer(ent['rom'], '>u4'), ent['regmap']
+
+    def store(self, preamble, jsonhash, rom, regmap):
+        if self.path is None or jsonhash is None:
+            return
+        fname = self._fname(preamble)
+        ent = {
+            'version': self.version,
+            'jsonhash': jsonhash,
+            'rom': numpy.asarray(rom, '>u4').tobytes(),
+            'regmap': regmap,
+        }
+        try:
+            os.makedirs(self.path, mode=0o700, exist_ok=True)
+            # write and rename, so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as F:
+                    pickle.dump(ent, F, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, fname)
+            except Exception:
+                os.unlink(tmp)
+                raise
+        except (IOError, OSError) as e:
+            _log.warning('Unable to update ROM cache %s: %s', fname, e)
+        else:
+            _log.debug('ROM cache store %s', fname)
@@ -0,0 +1,527 @@
+"""Simulated LEEP devices
+
+Serves virtual boards, each described by a regmap JSON (as written by
+newad.py), over the UDP LEEP protocol.  Intended for exercising and
+benchmarking clients without hardware.
+
+- ROM holding JSON hash, code hash, description and regmap,
+  laid out as by build_rom.py.
+- Single beat and block-transfer/repeat-count (burst) requests.
+- Waveform acquisition.  circle_buf_flip re-arms, ready bits are
+  set once the buffer would have filled, circle_data is filled with
+  test signals for the channels in chan_keep, and slow_data latches
+  dsp_tag.
+- Raw ADC capture.  rawadc_trig fills banyan_data, and banyan_status
+  shows busy meanwhile.
+- Configurable reply latency, jitter, request/reply loss and reordering.
+
+Many boards are served from one thread, each on its own UDP port.
+Ready sockets are drained in batches of non-blocking receives into a
+re-used buffer.
+
+$ python -m leep.sim -n 4 -p 50006 regmap.json
+"""
+
+import logging
+
+import hashlib
+import heapq
+import json
+import random
+import selectors
+import socket
+import threading
+import time
+import zlib
+
+import numpy
+
+from .raw import _base_addr
+
+_log = logging.getLogger(__name__)
+
+
+def load_regmap(fname):
+    """:returns: (regmap, text) from a regmap JSON file.
+    """
+    with open(fname, 'rb') as F:
+        text = F.read()
+    return json.loads(text.decode('utf-8')), text
+
+
+def build_rom(text, description=b'leep.sim', codehash=None):
+    """ROM contents for a regmap JSON text.  See build_rom.py
+
+    :returns: An array of 16-bit values.
+    """
+    def chunk(values, flag):
+        assert len(values) < (1 << 14)
+        return [len(values) | (flag << 14)] + list(values)
+
+    def sixteen(blob, pad=b'\0'):
+        if len(blob) % 2:
+            blob += pad
+        return list(numpy.frombuffer(blob, '>u2'))
+
+    jsonhash = sixteen(hashlib.sha1(text).digest())
+    if codehash is None:
+        codehash = 40 * '0'
+    codehash = [int(codehash[i:i + 4], 16) for i in range(0, 40, 4)]
+    rom = chunk(jsonhash, 2) + chunk(codehash, 2) \
+        + chunk(sixteen(description, pad=b'.'), 1) \
+        + chunk(sixteen(zlib.compress(text, 9)), 3)
+    return numpy.asarray(rom, dtype='u4')
+
+
+def _find(regmap, suffix, prefix=''):
+    """Shortest register name with prefix and suffix, or None
+    """
+    names = [name for name in regmap
+             if name.startswith(prefix) and name.endswith(suffix)]
+    if not names and prefix:
+        return _find(regmap, suffix)
+    return min(names, key=len) if names else None
+
+
+class Board(object):
+    """A simulated device.  Decodes requests, and computes replies.
+
+    :param dict regmap: Register map.
+    :param bytes text: regmap JSON, as stored in ROM.  Default from regmap.
+    :param bool burst: Support block-transfer/repeat-count.
+    :param int rom_addr: ROM start address.
+    :param float sample_period: Time (seconds) of one waveform sample,
+                                before decimation by wave_samp_per.
+    """
+
+    def __init__(self, regmap, text=None, burst=True, rom_addr=0x800,
+                 sample_period=1e-6, description=b'leep.sim', seed=None):
+        if text is None:
+            text = json.dumps(regmap).encode('utf-8')
+        self.regmap = regmap
+        self.burst = burst
+        self.sample_period = sample_period
+        self._rand = numpy.random.RandomState(seed)
+
+        self.regs = {}  # name -> (base, length, data_width)
+        end = 0
+        for name, info in regmap.items():
+            if name == '__metadata__':
+                continue
+            base = _base_addr(info)
+            L = 2**info.get('addr_width', 0)
+            self.regs[name] = (base, L, info.get('data_width', 32))
+            end = max(end, base + L)
+
+        rom = build_rom(text, description=description)
+        end = max(end, rom_addr + len(rom))
+        # zero pages are only allocated when written
+        self.mem = numpy.zeros(end, dtype='u4')
+        self.mem[rom_addr:rom_addr + len(rom)] = rom
+
+        # writes elsewhere are ignored, as by the burst probe
+        self.writable = numpy.zeros(end, dtype=bool)
+        for name, (base, L, _dw) in self.regs.items():
+            if 'w' in regmap[name].get('access', 'rw'):
+                self.writable[base:base + L] = True
+
+        self._read_hooks = {}  # addr -> callable()
+        self._write_hooks = {}  # addr -> callable(value)
+        self._armed = {}  # circle buffer bit -> arm time
+        self._setup_circle()
+        self._setup_banyan()
+        self._hooked = numpy.asarray(sorted(set(self._read_hooks) |
+                                            set(self._write_hooks)), 'u4')
+
+    def addr(self, name):
+        return self.regs[name][0]
+
+    def reg(self, name):
+        """:returns: A writable view of register storage.
+        """
+        base, L, _dw = self.regs[name]
+        return self.mem[base:base + L]
+
+    def _setup_circle(self):
+        """Find the registers of each waveform buffer (eg. each shell)
+        """
+        regmap = self.regs
+        flip = _find(regmap, 'circle_buf_flip')
+        ready = _find(regmap, 'llrf_circle_ready') or \
+            _find(regmap, 'circle_data_ready')
+        self.circles = []
+        if flip is None or ready is None:
+            return
+
+        for name in sorted(regmap):
+            pos = name.rfind('circle_data')
+            if pos == -1 or name.endswith('_ready') or regmap[name][1] == 1:
+                continue
+            prefix = name[:pos]
+            # shell_#_circle_data or circle_data_#
+            bit = 0
+            for part in (prefix + name[pos + 11:]).split('_'):
+                if part.isdigit():
+                    bit = int(part)
+                    break
+            self.circles.append({
+                'bit': bit,
+                'data': name,
+                'keep': _find(regmap, 'chan_keep', prefix),
+                'dec': _find(regmap, 'wave_samp_per', prefix),
+                'tag': _find(regmap, 'dsp_tag', prefix),
+                'slow': _find(regmap, 'slow_data', prefix),
+                'sample': 0,  # running sample number
+            })
+
+        self._ready = ready
+        self._write_hooks[self.addr(flip)] = self._flip
+
+    def _setup_banyan(self):
+        regmap = self.regs
+        self.banyan = None
+        names = [_find(regmap, N) for N in ('banyan_data', 'banyan_status',
+                                            'rawadc_trig')]
+        if None in names:
+            return
+        data, status, trig = names
+        astep = self.regs[data][1] // 8
+        self.banyan = {
+            'data': data,
+            'status': status,
+            'astep': astep,
+            'done': None,  # time of capture completion
+            'sample': 0,
+        }
+        self.reg(status)[0] = (astep.bit_length() - 1) << 24
+        self._write_hooks[self.addr(trig)] = self._trigger
+
+    def signal(self, chans, start, nsamp, scale, dec=1):
+        """Test signals.  A sine wave, of different frequency and
+        phase for each channel, plus noise.
+
+        :returns: An (nsamp, len(chans)) float array.
+        """
+        n = numpy.arange(start, start + nsamp, dtype='f8')[:, None] * dec
+        ch = numpy.asarray(chans, dtype='f8')[None, :]
+        S = numpy.sin(2 * numpy.pi * n * (ch + 1) / 97.0 + ch)
+        S += self._rand.normal(scale=0.01, size=S.shape)
+        return S * (scale * 0.5)
+
+    def _flip(self, value):
+        now = time.monotonic()
+        for C in self.circles:
+            if value & (1 << C['bit']):
+                self._armed[C['bit']] = now
+                self.reg(self._ready)[0] &= 0xffffffff ^ (1 << C['bit'])
+
+    def _acq_time(self, C):
+        keep = int(self.reg(C['keep'])[0]) if C['keep'] else 1
+        dec = int(self.reg(C['dec'])[0]) if C['dec'] else 1
+        nbits = bin(keep).count('1') or 1
+        L = self.regs[C['data']][1]
+        return (L // nbits) * max(1, dec) * self.sample_period
+
+    def _fill(self, C):
+        """Acquisition into circle buffer C complete
+        """
+        _base, L, dw = self.regs[C['data']]
+        if C['keep']:
+            keep = int(self.reg(C['keep'])[0])
+            nch = self.regs[C['keep']][2]
+        else:
+            keep, nch = 1, 1
+        dec = int(self.reg(C['dec'])[0]) if C['dec'] else 1
+        # channel 0 is the MSB of chan_keep
+        chans = [ch for ch in range(nch) if keep & (1 << (nch - 1 - ch))]
+        data = self.reg(C['data'])
+        if chans:
+            nsamp = L // len(chans)
+            S = self.signal(chans, C['sample'], nsamp, 2**(dw - 1), dec)
+            C['sample'] += nsamp
+            data[:nsamp * len(chans)] = S.astype('i4').ravel() & \
+                ((1 << dw) - 1)
+        if C['tag'] and C['slow']:
+            T = self.reg(C['tag'])[0]
+            slow = self.reg(C['slow'])
+            slow[33] = slow[34] = T
+        self.reg(self._ready)[0] |= 1 << C['bit']
+
+    def _trigger(self, value):
+        B = self.banyan
+        B['done'] = time.monotonic() + B['astep'] * 2 * self.sample_period
+        self.reg(B['status'])[0] |= 0x80000000
+
+    def tick(self, now=None):
+        """Complete acquisitions which are due.
+        """
+        if now is None:
+            now = time.monotonic()
+        for C in self.circles:
+            T0 = self._armed.get(C['bit'])
+            if T0 is not None and now - T0 >= self._acq_time(C):
+                del self._armed[C['bit']]
+                self._fill(C)
+
+        B = self.banyan
+        if B and B['done'] is not None and now >= B['done']:
+            B['done'] = None
+            npt = 2 * B['astep']
+            S = self.signal(range(8), B['sample'], npt, 2**15)
+            B['sample'] += npt
+            S = S.astype('i2').view('u2').astype('u4')
+            # pairs of channels in the low and high half word
+            self.reg(B['data'])[:] = \
+                (S[:, 0::2] | (S[:, 1::2] << 16)).T.ravel()
+            self.reg(B['status'])[0] &= 0x7fffffff
+
+    def _segments(self, msg):
+        """Decode request into runs of reads or writes.
+        :returns: list of (read, addrs, didx)
+        """
+        N = len(msg)
+        cmds = msg[2:N - 1:2]
+        if not self.burst or not ((cmds >> 28) & 3 == 2).any():
+            # all single beat
+            addrs = cmds & 0xffffff
+            read = (cmds & 0x10000000) != 0
+            didx = numpy.arange(3, 3 + 2 * len(cmds), 2)
+            if read.all() or not read.any():
+                return [(bool(read[0]), addrs, didx)] if len(cmds) else []
+            edges = numpy.flatnonzero(numpy.diff(read)) + 1
+            return [(bool(r[0]), a, d) for r, a, d in
+                    zip(numpy.split(read, edges), numpy.split(addrs, edges),
+                        numpy.split(didx, edges))]
+
+        ret = []
+        i = 2
+        while i + 1 < N:
+            if (msg[i] >> 28) & 3 == 2:
+                count = int(msg[i]) & 0x1ff
+                cmd, i = int(msg[i + 1]), i + 2
+            else:
+                count, cmd = 1, int(msg[i])
+                i += 1
+            count = max(0, min(count, N - i))
+            A = cmd & 0xffffff
+            ret.append((bool(cmd & 0x10000000),
+                        numpy.arange(A, A + count),
+                        numpy.arange(i, i + count)))
+            i += count
+        return ret
+
+    def request(self, msg):
+        """Process a request.
+
+        :param msg: Request words (big endian), modified into the reply.
+        """
+        if self._armed or (self.banyan and self.banyan['done']):
+            self.tick()
+        mem = self.mem
+        for read, addrs, didx in self._segments(msg):
+            valid = addrs < len(mem)
+            hooked = len(self._hooked) and \
+                numpy.isin(addrs, self._hooked).any()
+            if read:
+                if hooked:
+                    for A in addrs[numpy.isin(addrs, self._hooked)]:
+                        fn = self._read_hooks.get(int(A))
+                        if fn:
+                            fn()
+                if valid.all():
+                    msg[didx] = mem[addrs]
+                else:
+                    msg[didx] = numpy.where(valid,
+                                            mem[numpy.where(valid, addrs, 0)],
+                                            0)
+            else:
+                vals = msg[didx]
+                valid[valid] = self.writable[addrs[valid]]
+                mem[addrs[valid]] = vals[valid]
+                if hooked:
+                    for A, V in zip(addrs, vals):
+                        fn = self._write_hooks.get(int(A))
+                        if fn:
+                            fn(int(V))
+        return msg
+
+
+class Server(object):
+    """Serve Boards over UDP.
+
+    :param float latency: Reply delay (seconds).
+    :param float jitter: Standard deviation (seconds) added to latency.
+    :param float loss: Probability that a request is lost.
+    :param float reply_loss: Probability that a reply is lost
+                             (after the request has taken effect).
+    :param float reorder: Probability that a reply is delayed by
+                          reorder_delay, to arrive after later replies.
+    """
+    max_request = 2048
+    # receives per socket per wakeup
+    batch = 64
+
+    def __init__(self, host='127.0.0.1', latency=0.0, jitter=0.0, loss=0.0,
+                 reply_loss=0.0, reorder=0.0, reorder_delay=0.002,
+                 seed=None):
+        self.host = host
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.reply_loss = reply_loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self._rand = random.Random(seed)
+
+        self.boards = []
+        self.sel = selectors.DefaultSelector()
+        self._queue = []  # heap of (due, seq, sock, reply, dest)
+        self._seq = 0
+        self._buf = bytearray(self.max_request)
+        self.running = False
+        self.T = None
+        self.stats = {
+            'requests': 0,
+            'replies': 0,
+            'lost': 0,
+            'reordered': 0,
+        }
+
+    def add(self, board, port=0):
+        """Serve a Board on a new socket.
+        :returns: URL of the board.  eg. "leep://127.0.0.1:50006"
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        sock.bind((self.host, port))
+        sock.setblocking(False)
+        self.sel.register(sock, selectors.EVENT_READ, board)
+        self.boards.append((board, sock))
+        url = 'leep://%s:%d' % sock.getsockname()
+        _log.info('Simulate %s', url)
+        return url
+
+    def _delay(self):
+        delay = self.latency
+        if self.jitter:
+            delay = max(0.0, delay + self._rand.gauss(0, self.jitter))
+        if self.reorder and self._rand.random() < self.reorder:
+            self.stats['reordered'] += 1
+            delay += self.reorder_delay
+        return delay
+
+    def _handle(self, sock, board):
+        buf = self._buf
+        for _n in range(self.batch):
+            try:
+                N, src = sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.stats['requests'] += 1
+            if N < 8 or N % 4:
+                continue
+            if self.loss and self._rand.random() < self.loss:
+                self.stats['lost'] += 1
+                continue
+
+            msg = numpy.frombuffer(buf, '>u4', N // 4).copy()
+            reply = board.request(msg).tobytes()
+
+            if self.reply_loss and self._rand.random() < self.reply_loss:
+                self.stats['lost'] += 1
+                continue
+            delay = self._delay()
+            if delay <= 0:
+                self._send(sock, reply, src)
+            else:
+                self._seq += 1
+                heapq.heappush(self._queue, (time.monotonic() + delay,
+                                             self._seq, sock, reply, src))
+
+    def _send(self, sock, reply, dest):
+        try:
+            sock.sendto(reply, dest)
+            self.stats['replies'] += 1
+        except OSError as e:
+            _log.debug('Send to %s fails: %s', dest, e)
+
+    def run(self):
+        """Serve until stop()
+        """
+        self.running = True
+        Q = self._queue
+        while self.running:
+            timeout = 0.1
+            if Q:
+                timeout = min(timeout, max(0.0, Q[0][0] - time.monotonic()))
+            for key, _mask in self.sel.select(timeout):
+                self._handle(key.fileobj, key.data)
+
+            now = time.monotonic()
+            while Q and Q[0][0] <= now:
+                _due, _seq, sock, reply, dest = heapq.heappop(Q)
+                self._send(sock, reply, dest)
+
+    def start(self):
+        """Serve from a worker thread
+        """
+        self.running = True
+        self.T = threading.Thread(target=self.run, daemon=True)
+        self.T.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.T is not None:
+            self.T.join()
+            self.T = None
+        for _board, sock in self.boards:
+            self.sel.unregister(sock)
+            sock.close()
+        self.boards = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, A, B, C):
+        self.stop()
+
+
+def getargs():
+    from argparse import ArgumentParser
+    P = ArgumentParser(description='Simulated LEEP devices')
+    P.add_argument('-d', '--debug', action='store_const',
+                   const=logging.DEBUG, default=logging.INFO)
+    P.add_argument('-H', '--host', default='127.0.0.1')
+    P.add_argument('-p', '--port', type=int, default=50006,
+                   help='Port of first board.  Others follow.')
+    P.add_argument('-n', '--boards', type=int, default=1,
+                   help='Number of boards')
+    P.add_argument('--no-burst', dest='burst', action='store_false',
+                   default=True, help='Disable burst support')
+    P.add_argument('--latency', type=float, default=0.0)
+    P.add_argument('--jitter', type=float, default=0.0)
+    P.add_argument('--loss', type=float, default=0.0)
+    P.add_argument('--reply-loss', type=float, default=0.0)
+    P.add_argument('--reorder', type=float, default=0.0)
+    P.add_argument('regmap', help='regmap JSON file, from newad.py')
+    return P.parse_args()
+
+
+def main():
+    args = getargs()
+    logging.basicConfig(level=args.debug)
+    regmap, text = load_regmap(args.regmap)
+    serv = Server(host=args.host, latency=args.latency, jitter=args.jitter,
+                  loss=args.loss, reply_loss=args.reply_loss,
+                  reorder=args.reorder)
+    for n in range(args.boards):
+        serv.add(Board(regmap, text, burst=args.burst), port=args.port + n)
+    try:
+        serv.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
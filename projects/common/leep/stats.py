@@ -0,0 +1,211 @@
+"""Transaction statistics of leep devices
+
+Every device has a ``stats`` attribute, a :py:class:`Stats`.
+This is a dict of counters (for leep://, packets and bytes in/out,
+retries, timeouts, ...) with latency histograms of the
+exchange(), reg_read(), wait_for_acq() and get_channels() calls.
+
+>>> dev = leep.open('leep://10.0.0.1')
+>>> dev.reg_read(['dsp_tag'])
+>>> dev.stats['retries']
+0
+>>> dev.stats.snapshot()['latency']['reg_read']['count']
+1
+
+Statistics may be exported in the Prometheus text format.
+
+>>> print(to_prometheus({'rfs1': dev}))
+>>> server = serve_metrics({'rfs1': dev}, bind=('127.0.0.1', 9101))
+"""
+
+import logging
+
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+
+_log = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds (seconds).  10 us to 10 s.
+BUCKETS = tuple(float('%se%d' % (M, E))
+                for E in range(-5, 1) for M in (1, 2.5, 5)) + (10.0,)
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)  # last is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, dt):
+        self.counts[bisect_left(self.bounds, dt)] += 1
+        self.count += 1
+        self.sum += dt
+
+    def snapshot(self):
+        """:returns: A dict with count, sum, and buckets, a list of
+                     (upper bound, cumulative count).  Observations
+                     above the last bound are only in count.
+        """
+        buckets, total = [], 0
+        for le, N in zip(self.bounds, self.counts):
+            total += N
+            buckets.append((le, total))
+        return {'count': self.count, 'sum': self.sum, 'buckets': buckets}
+
+
+class Stats(dict):
+    """Counters, with latency histograms per operation in self.latency
+
+    Counters are the dict items.
+    """
+
+    def __init__(self, *args, **kws):
+        dict.__init__(self, *args, **kws)
+        self.latency = {}
+
+    def observe(self, op, dt):
+        """Record that one op call took dt seconds.
+        """
+        H = self.latency.get(op)
+        if H is None:
+            H = self.latency[op] = Histogram()
+        H.observe(dt)
+
+    def reset(self):
+        for key in self:
+            self[key] = 0
+        for H in list(self.latency.values()):
+            H.reset()
+
+    def snapshot(self):
+        """:returns: A dict, suitable for JSON encoding.
+        """
+        return {
+            'counters': dict(self),
+            'latency': dict((op, H.snapshot())
+                            for op, H in list(self.latency.items())),
+        }
+
+
+def timed(op):
+    """Decorator recording the duration of a method call
+    in self.stats under op.  Works with coroutine functions.
+    """
+    def decorate(fcn):
+        if asyncio.iscoroutinefunction(fcn):
+            @wraps(fcn)
+            async def wrapper(self, *args, **kws):
+                T0 = time.perf_counter()
+                try:
+                    return await fcn(self, *args, **kws)
+                finally:
+                    self.stats.observe(op, time.perf_counter() - T0)
+        else:
+            @wraps(fcn)
+            def wrapper(self, *args, **kws):
+                T0 = time.perf_counter()
+                try:
+                    return fcn(self, *args, **kws)
+                finally:
+                    self.stats.observe(op, time.perf_counter() - T0)
+        return wrapper
+    return decorate
+
+
+def _labels(labels):
+    return ','.join(['%s="%s"' % (K, str(V).replace('\\', '\\\\')
+                                  .replace('"', '\\"'))
+                     for K, V in labels])
+
+
+def to_prometheus(sources, prefix='leep', label='device'):
+    """Format statistics in the Prometheus text exposition format.
+
+    Counters become <prefix>_<name>_total.  Latency histograms become
+    <prefix>_op_duration_seconds, with an "op" label.
+
+    :param dict sources: Map of label value to a device, or a dict of
+                         counters (eg. a :py:class:`Stats`).
+    :param str prefix: Metric name prefix.
+    :param str label: Label name for the keys of sources.
+    :returns: str
+    """
+    counters, hists = {}, {}
+    for name, src in sources.items():
+        stats = getattr(src, 'stats', src)
+        for key, val in list(stats.items()):
+            counters.setdefault(key, []).append((name, val))
+        for op, H in list(getattr(stats, 'latency', {}).items()):
+            hists.setdefault(op, []).append((name, H.snapshot()))
+
+    lines = []
+    for key in sorted(counters):
+        metric = '%s_%s_total' % (prefix, key)
+        lines.append('# TYPE %s counter' % metric)
+        for name, val in counters[key]:
+            lines.append('%s{%s} %s' % (metric, _labels([(label, name)]),
+                                        val))
+
+    if hists:
+        metric = '%s_op_duration_seconds' % prefix
+        lines.append('# TYPE %s histogram' % metric)
+        for op in sorted(hists):
+            for name, H in hists[op]:
+                L = [(label, name), ('op', op)]
+                for le, N in H['buckets']:
+                    lines.append('%s_bucket{%s} %d' % (
+                        metric, _labels(L + [('le', '%g' % le)]), N))
+                lines.append('%s_bucket{%s} %d' % (
+                    metric, _labels(L + [('le', '+Inf')]), H['count']))
+                lines.append('%s_sum{%s} %r' % (metric, _labels(L),
+                                                H['sum']))
+                lines.append('%s_count{%s} %d' % (metric, _labels(L),
+                                                  H['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics(sources, bind=('127.0.0.1', 9101)):
+    """Serve statistics in the Prometheus text format
+    over HTTP, from a background thread.
+
+    :param sources: A dict as for :py:func:`to_prometheus`,
+                    or a callable returning the text to serve.
+    :param tuple bind: Local (host, port) to listen on.
+    :returns: A :py:class:`http.server.HTTPServer`.  Call shutdown()
+              and server_close() to stop.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    collect = sources if callable(sources) else \
+        (lambda: to_prometheus(sources))
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = collect().encode()
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            _log.debug(fmt, *args)
+
+    server = ThreadingHTTPServer(bind, Handler)
+    server.daemon_threads = True
+    T = threading.Thread(target=server.serve_forever, daemon=True,
+                         name='leep-metrics')
+    T.start()
+    _log.info('Serving metrics on %s:%d', *server.server_address[:2])
+    return server
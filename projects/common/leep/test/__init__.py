@@ -0,0 +1,11 @@
+"""Tests of leep.  From projects/common:
+
+$ python -m unittest
+
+The ROM cache (see leep.romcache) is on by default.  Importing this
+package turns it off, so that no leep test, including any added later,
+touches ~/.cache/leep.
+"""
+import os
+
+os.environ['LEEP_ROM_CACHE'] = ''
@@ -0,0 +1,100 @@
+
+import logging
+
+import unittest
+import asyncio
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from ..aio import open, read_many, write_many
+from .test_raw import SimServer, WaveSimServer
+
+_log = logging.getLogger(__name__)
+
+
+class TestAIO(unittest.TestCase):
+    def setUp(self):
+        self.servs = [SimServer(), SimServer(burst=True)]
+
+    def tearDown(self):
+        for serv in self.servs:
+            serv.join()
+
+    def test_scalar(self):
+        serv = self.servs[0]
+
+        async def main():
+            async with await open(serv.url) as dev:
+                serv.data[42] = serv.data[43] = 0xdeadbeef
+                self.assertEqual(await dev.reg_read(['sval', 'uval']),
+                                 [-559038737, 0xdeadbeef])
+
+                await dev.reg_write([('sval', 0x12345678)])
+                self.assertEqual(serv.data[42], 0x12345678)
+
+                W = dev.prepare_write(['sval'])
+                R = dev.prepare_read(['sval'])
+                await W([-3])
+                self.assertEqual(await R(), [-3])
+
+        asyncio.run(main())
+
+    def test_array(self):
+        async def main():
+            devs = await asyncio.gather(*[open(serv.url, window=4,
+                                               allow_burst=True)
+                                          for serv in self.servs])
+            try:
+                self.assertFalse(devs[0].burst_avail)
+                self.assertTrue(devs[1].burst_avail)
+
+                for n, serv in enumerate(self.servs):
+                    for i in range(1000):
+                        serv.data[0x1000 + i] = i + n
+
+                R = await asyncio.gather(*[
+                    dev.exchange(range(0x1000, 0x1000 + 1000))
+                    for dev in devs])
+                assert_equal(R[0], np.arange(1000))
+                assert_equal(R[1], np.arange(1000) + 1)
+
+                await write_many(devs, [('uarr', [1, 2])])
+                R = await read_many(devs, ['uarr', 'uval'])
+                for (uarr, uval), serv in zip(R, self.servs):
+                    assert_equal(uarr, [1, 2])
+                    self.assertEqual(uval, serv.data.get(43, 0))
+            finally:
+                for dev in devs:
+                    dev.close()
+
+        asyncio.run(main())
+
+
+class TestAIOWave(unittest.TestCase):
+    def setUp(self):
+        self.serv = WaveSimServer()
+
+    def tearDown(self):
+        self.serv.join()
+
+    def test_iter(self):
+        serv = self.serv
+        serv.data[200] = 0b110000000000
+        serv.data[201] = 1
+        for i in range(32):
+            serv.data[256 + i] = i
+
+        async def main():
+            async with await open(serv.url) as dev:
+                N = 0
+                async for now, T, (A, B) in dev.iter_acquisitions(
+                        [0, 1], instance=[0], tag=True, dtype='i4'):
+                    self.assertEqual(T, 1)
+                    assert_equal(A, np.arange(0, 32, 2))
+                    assert_equal(B, np.arange(1, 32, 2))
+                    N += 1
+                    if N == 3:
+                        break
+
+        asyncio.run(main())
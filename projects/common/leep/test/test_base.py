@@ -64,3 +64,57 @@ class TestTGEN(unittest.TestCase):
             0x0000, 0x30300, 0x0102, 0x0304,
             0x0000, 0x30301, 0x0506, 0x0708,
         ])
+
+
+class TestExpand(unittest.TestCase):
+    def setUp(self):
+        self.D = TestingDevice()
+        for name in ['shell_0_dsp_fdbk_core_mp_proc_coeff',
+                     'shell_1_dsp_fdbk_core_mp_proc_coeff',
+                     'shell_0_dsp_lp_notch_lp1a_kx',
+                     'shell_0_dsp_lp_notch_lp1b_kx',
+                     'shell_0_circle_data',
+                     'shell_0_mycircle_data']:
+            self.D.regmap[name] = {'base_addr': 0, 'addr_width': 0}
+
+    def test_expand(self):
+        D = self.D
+        self.assertEqual(D.expand_regname('test1'), 'test1')
+        self.assertEqual(D.expand_regname('foo', instance=None), 'foo')
+        self.assertEqual(D.expand_regname('coeff', instance=[1]),
+                         'shell_1_dsp_fdbk_core_mp_proc_coeff')
+        self.assertEqual(D.expand_regname('proc_coeff', instance=[0]),
+                         'shell_0_dsp_fdbk_core_mp_proc_coeff')
+        self.assertEqual(D.expand_regname('lp1a_kx', instance=[0]),
+                         'shell_0_dsp_lp_notch_lp1a_kx')
+        self.assertEqual(D.expand_regname('kx', instance=[0, 'lp1b']),
+                         'shell_0_dsp_lp_notch_lp1b_kx')
+        # without instance, suffix need not start after '_'
+        self.assertEqual(D.expand_regname('ycircle_data'),
+                         'shell_0_mycircle_data')
+        # with instance, name must follow '_'
+        self.assertEqual(D.expand_regname('circle_data', instance=[0]),
+                         'shell_0_circle_data')
+        # cached
+        self.assertEqual(D.expand_regname('coeff', instance=[1]),
+                         'shell_1_dsp_fdbk_core_mp_proc_coeff')
+
+    def test_errors(self):
+        D = self.D
+        with self.assertRaisesRegex(RuntimeError, 'more than one') as C:
+            D.expand_regname('coeff')
+        self.assertIn('shell_0_dsp_fdbk_core_mp_proc_coeff '
+                      'shell_1_dsp_fdbk_core_mp_proc_coeff',
+                      str(C.exception))
+        with self.assertRaisesRegex(RuntimeError, 'more than one'):
+            D.expand_regname('circle_data')
+        with self.assertRaisesRegex(RuntimeError, 'No match'):
+            D.expand_regname('coeff', instance=[2])
+
+    def test_update(self):
+        D = self.D
+        with self.assertRaisesRegex(RuntimeError, 'No match'):
+            D.expand_regname('coeff', instance=[2])
+        D.regmap['shell_2_coeff'] = {}
+        self.assertEqual(D.expand_regname('coeff', instance=[2]),
+                         'shell_2_coeff')
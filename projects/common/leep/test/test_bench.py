@@ -0,0 +1,16 @@
+
+import unittest
+
+from ..bench import run
+
+
+class TestBench(unittest.TestCase):
+    def test_run(self):
+        R = run(['reg_read', 'array_16k'], count=3)
+        S = R['results']['reg_read']
+        self.assertEqual(S['calls'], 3)
+        self.assertEqual(S['packets_per_call'], 1.0)
+        self.assertGreater(S['latency_p99_us'], 0)
+        S = R['results']['array_16k']
+        self.assertLess(S['burst']['packets_per_call'],
+                        S['plain']['packets_per_call'])
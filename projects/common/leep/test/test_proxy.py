@@ -0,0 +1,192 @@
+
+import logging
+
+import unittest
+import asyncio
+import socket
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from ..aio import open
+from ..proxy import serve, parse_request
+from .test_raw import SimServer, WaveSimServer
+
+_log = logging.getLogger(__name__)
+
+
+class TestParse(unittest.TestCase):
+    def test_parse(self):
+        msg = np.asarray([0, 0,
+                          0x10000002, 0,  # read 2
+                          0x00000003, 5,  # write 3
+                          0x20000003, 0x10000010, 0, 0, 0,  # read 16-18
+                          ], dtype='>u4')
+        addrs, values, didx = parse_request(msg)
+        self.assertEqual(addrs, [2, 3, 16, 17, 18])
+        self.assertEqual(values, [None, 5, None, None, None])
+        self.assertEqual(didx, [3, 5, 8, 9, 10])
+
+
+class TestProxy(unittest.TestCase):
+    def setUp(self):
+        self.serv = SimServer()
+
+    def tearDown(self):
+        self.serv.join()
+
+    def test_proxy(self):
+        serv = self.serv
+        serv.data[100], serv.data[101] = 4, 5
+
+        async def main():
+            board = await serve(serv.url, bind=('127.0.0.1', 0),
+                                merge_window=0.01)
+            try:
+                url = 'leep://%s:%d' % board.transport.get_extra_info(
+                    'sockname')
+                start = serv.nreq
+                A = await open(url, allow_burst=True)
+                B = await open(url, allow_burst=True)
+                # burst probes, ROM from cache
+                self.assertEqual(board.stats['rom'], 4)
+                self.assertTrue(A.burst_avail)
+                self.assertLessEqual(serv.nreq - start, 2)
+
+                start = serv.nreq
+                R = await asyncio.gather(A.reg_read(['sarr', 'uval']),
+                                         B.reg_read(['sarr']))
+                assert_equal(R[0][0], [4, 5])
+                assert_equal(R[1][0], [4, 5])
+                self.assertEqual(serv.nreq - start, 1)
+                self.assertEqual(board.stats['merged'], 1)
+
+                await A.reg_write([('sval', -2)])
+                self.assertEqual(await B.reg_read(['sval']), [-2])
+
+                A.close()
+                B.close()
+            finally:
+                board.close()
+
+        asyncio.run(main())
+
+    def test_merge_order(self):
+        serv = self.serv
+        serv.data[42], serv.data[43] = 6, 7
+
+        async def main():
+            board = await serve(serv.url, bind=('127.0.0.1', 0),
+                                merge_window=0.01)
+            try:
+                exchange, upstream = board.dev.exchange, []
+
+                async def record(addrs):
+                    upstream.append(list(addrs))
+                    return await exchange(addrs)
+                board.dev.exchange = record
+
+                R = await asyncio.gather(board.read([43, 42, 43]),
+                                         board.read([42]),
+                                         board.read([43, 42, 43]))
+                assert_equal(R[0], [7, 6, 7])
+                assert_equal(R[1], [6])
+                assert_equal(R[2], [7, 6, 7])
+                # each request's order and repeats, identical ones once
+                self.assertEqual(upstream, [[43, 42, 43, 42]])
+            finally:
+                board.close()
+
+        asyncio.run(main())
+
+    def test_upstream_error(self):
+        serv = self.serv
+
+        async def main():
+            board = await serve(serv.url, bind=('127.0.0.1', 0))
+            try:
+                async def fail(addrs):
+                    raise ConnectionRefusedError()
+                board.dev.exchange = fail
+                with self.assertLogs('leep.proxy', 'WARNING'):
+                    await board.handle(np.asarray(
+                        [0, 0, 0x1000002a, 0], dtype='>u4').tobytes(),
+                        ('127.0.0.1', 1))
+            finally:
+                board.close()
+
+        asyncio.run(main())
+
+
+class TestProxyAcq(unittest.TestCase):
+    def setUp(self):
+        self.serv = WaveSimServer()
+
+    def tearDown(self):
+        self.serv.join()
+
+    def test_lease(self):
+        serv = self.serv
+
+        async def main():
+            board = await serve(serv.url, bind=('127.0.0.1', 0),
+                                merge_window=0.001)
+            try:
+                url = 'leep://%s:%d' % board.transport.get_extra_info(
+                    'sockname')
+                # default client timeout
+                A = await open(url)
+                B = await open(url)
+
+                await A.reg_write([('shell_0_dsp_tag', 1)])
+                # B waits until A reads back the waveform
+                T = asyncio.ensure_future(
+                    B.reg_write([('shell_0_dsp_tag', 2)]))
+                await asyncio.sleep(0.02)
+                self.assertFalse(T.done())
+                self.assertEqual(serv.data[202], 1)
+
+                await A.reg_read(['circle_data'])
+                await T
+                self.assertEqual(serv.data[202], 2)
+                self.assertEqual(board.stats['held'], 1)
+
+                A.close()
+                B.close()
+            finally:
+                board.close()
+
+        asyncio.run(main())
+
+    def test_busy(self):
+        serv = self.serv
+
+        async def main():
+            board = await serve(serv.url, bind=('127.0.0.1', 0))
+            try:
+                url = 'leep://%s:%d' % board.transport.get_extra_info(
+                    'sockname')
+                A = await open(url)
+                B = await open(url)
+
+                await A.reg_write([('shell_0_dsp_tag', 1)])
+                # A holds the lease for longer than B waits
+                with self.assertRaises(socket.timeout):
+                    await B.reg_write([('shell_0_dsp_tag', 2)])
+                # and B's write is never applied
+                await asyncio.sleep(0.1)
+                self.assertEqual(serv.data[202], 1)
+                self.assertEqual(board.stats['busy'], 1)
+
+                await A.reg_read(['circle_data'])
+                await asyncio.sleep(0.05)
+                self.assertEqual(serv.data[202], 1)
+                await B.reg_write([('shell_0_dsp_tag', 2)])
+                self.assertEqual(serv.data[202], 2)
+
+                A.close()
+                B.close()
+            finally:
+                board.close()
+
+        asyncio.run(main())
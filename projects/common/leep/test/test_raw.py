@@ -6,6 +6,11 @@ import json
 import zlib
 import threading
 import socket
+import time
+import hashlib
+import os
+import tempfile
+import shutil
 
 import numpy as np
 from numpy.testing import assert_equal
@@ -50,28 +55,51 @@ class SimServer(object):
         },
     }
 
-    def __init__(self):
+    def __init__(self, burst=False):
+        # emulate a gateway w/ block-transfer/repeat-count support
+        self.burst = burst
         self.S = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.S.bind(('127.0.0.1', 0))
         self.url = 'leep://%s:%d' % self.S.getsockname()
         _log.info('SimServer %s starting', self.url)
 
-        blob = zlib.compress(json.dumps(self.regmap).encode('utf-8'), 9)
+        text = json.dumps(self.regmap).encode('utf-8')
+        blob = zlib.compress(text, 9)
         if len(blob) & 1:
             blob = blob + b'\0'
         RM = np.frombuffer(blob, '>H')
         assert len(RM) <= 0x3fff
-        rom = np.zeros(1+len(RM), dtype='>I')  # high half-word not used
-        rom[0] = 0xc000 | len(RM)
-        rom[1:] = RM
+        # JSON hash, code hash, then JSON.  See build_rom.py
+        jsonhash = np.frombuffer(hashlib.sha1(text).digest(), '>H')
+        codehash = np.arange(10)
+        rom = np.zeros(24+len(RM), dtype='>I')  # high half-word not used
+        rom[0] = 0x8000 | 10
+        rom[1:11] = jsonhash
+        rom[11] = 0x8000 | 10
+        rom[12:22] = codehash
+        rom[22] = 0xc000 | len(RM)
+        rom[23:23+len(RM)] = RM
 
         self.data = dict([(0x800+i, val) for i, val in enumerate(rom)])
 
+        # drop every Nth request (0 to never drop)
+        self.drop_every = 0
+        self.nreq = 0
+
         self.running = True
         self.T = threading.Thread(target=self.run)
         self.T.start()
         print('start')
 
+    def read(self, addr):
+        return self.data.get(addr, 0)
+
+    def write(self, addr, value):
+        if value == 0:
+            self.data.pop(addr, None)
+        else:
+            self.data[addr] = value
+
     def join(self):
         print('join')
         _log.info('SimServer %s joining', self.url)
@@ -93,20 +121,32 @@ class SimServer(object):
                 break
             _log.debug('Request from %s', src)
 
+            self.nreq += 1
+            if self.drop_every and self.nreq % self.drop_every == 0:
+                _log.debug('Drop request from %s', src)
+                continue
+
             buf = np.frombuffer(buf, dtype='>I')
             buf = buf.copy()
 
-            for i in range(2, len(buf) & ~1, 2):
-                addr = buf[i] & 0xffffff
-                if buf[i] & 0x10000000:
-                    # read
-                    buf[i+1] = self.data.get(addr, 0)
+            i = 2
+            while i + 1 < len(buf):
+                if self.burst and (buf[i] >> 28) & 3 == 2:
+                    # burst.  repeat count, then command/address
+                    count = buf[i] & 0x1ff
+                    cmd, i = buf[i+1], i+2
                 else:
-                    # write
-                    if buf[i+1] == 0:
-                        self.data.pop(addr)
+                    count, cmd = 1, buf[i]
+                    i += 1
+                addr = cmd & 0xffffff
+                for n in range(count):
+                    if i >= len(buf):
+                        break
+                    if cmd & 0x10000000:
+                        buf[i] = self.read(addr + n)
                     else:
-                        self.data[addr] = buf[i+1]
+                        self.write(addr + n, buf[i])
+                    i += 1
 
             _log.debug('Reply to %s', src)
             self.S.sendto(buf.tobytes(), src)
@@ -189,3 +229,353 @@ class TestRaw(unittest.TestCase):
             self.assertEqual(self.serv.data[101], 0xdeadbeef)
             self.assertEqual(self.serv.data[102], 0x12345679)
             self.assertEqual(self.serv.data[103], 0xdeadbeef)
+
+    def test_plan(self):
+        with open(self.serv.url) as dev:
+            R = dev.prepare_read(['sval', 'uval', 'sarr', 'uarr'])
+            W = dev.prepare_write(['sval', 'uarr'])
+
+            W([-2, [0x12345678, 0xdeadbeef]])
+            self.assertEqual(self.serv.data[42], 0xfffffffe)
+            self.assertEqual(self.serv.data[102], 0x12345678)
+            self.assertEqual(self.serv.data[103], 0xdeadbeef)
+
+            self.serv.data[43] = 0xdeadbeef
+            self.serv.data[100] = 0x12345678
+            self.serv.data[101] = 0xdeadbeef
+            for i in range(2):
+                sval, uval, sarr, uarr = R()
+                self.assertEqual(sval, -2)
+                self.assertEqual(uval, 0xdeadbeef)
+                assert_equal(sarr, [0x12345678, -559038737])
+                assert_equal(uarr, [0x12345678, 0xdeadbeef])
+
+    def test_rom_cache(self):
+        cache = tempfile.mkdtemp()
+        try:
+            with open(self.serv.url, rom_cache=cache) as dev:
+                regmap = dev.regmap
+                rom = dev.the_rom
+            self.assertEqual(len(os.listdir(cache)), 1)
+
+            start = self.serv.nreq
+            with open(self.serv.url, rom_cache=cache) as dev:
+                self.assertEqual(dev.regmap, regmap)
+                assert_equal(dev.the_rom, rom)
+                self.assertEqual(dev.jsonhash, hashlib.sha1(json.dumps(
+                    self.serv.regmap).encode('utf-8')).hexdigest())
+            # only the preamble read
+            self.assertLessEqual(self.serv.nreq - start, 1)
+        finally:
+            shutil.rmtree(cache)
+
+    def test_pipelined(self):
+        with open(self.serv.url, window=4) as dev:
+            for i in range(1000):
+                self.serv.data[0x1000 + i] = i * 3
+
+            assert_equal(dev.exchange(range(0x1000, 0x1000 + 1000)),
+                         np.arange(1000) * 3)
+
+            dev.exchange(range(0x1000, 0x1000 + 1000),
+                         np.arange(1000) + 1)
+            self.assertEqual(self.serv.data[0x1000], 1)
+            self.assertEqual(self.serv.data[0x1000 + 999], 1000)
+
+    def test_pipelined_loss(self):
+        with open(self.serv.url, window=4, retries=4) as dev:
+            for i in range(1000):
+                self.serv.data[0x1000 + i] = i
+
+            self.serv.drop_every = 3
+            assert_equal(dev.exchange(range(0x1000, 0x1000 + 1000)),
+                         np.arange(1000))
+
+    def test_threads(self):
+        with open(self.serv.url) as dev:
+            for i in range(4):
+                self.serv.data[0x1000 + i] = i + 1
+            errors = []
+
+            def worker(i):
+                try:
+                    for n in range(100):
+                        V = dev.exchange([0x1000 + i])
+                        assert V[0] == i + 1, V
+                except Exception as e:
+                    errors.append(e)
+            T = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+            [t.start() for t in T]
+            [t.join() for t in T]
+            self.assertEqual(errors, [])
+            # no cross-talk.  Only late replies to retransmissions.
+            self.assertLessEqual(dev.stats['dropped'], dev.stats['retries'])
+            self.assertGreater(len(dev._transports), 1)
+
+    def test_retransmit(self):
+        # stop-and-wait, with a timeout much longer than the RTT
+        with open(self.serv.url, timeout=1.0, min_timeout=0.005) as dev:
+            self.serv.data[42] = 5
+            for i in range(10):
+                dev.reg_read(['sval'])
+            self.assertLess(dev.transport.rtt.rto, 0.1)
+
+            self.serv.drop_every = 2
+            T0 = time.monotonic()
+            for i in range(10):
+                self.assertEqual(dev.reg_read(['sval']), [5])
+            self.assertLess(time.monotonic() - T0, 1.0)
+            self.assertGreater(dev.stats['retries'], 0)
+
+            # a lost write is not repeated
+            self.serv.drop_every = 1
+            dev.transport.timeout = 0.1
+            start = self.serv.nreq
+            self.assertRaises(socket.timeout, dev.reg_write, [('sval', 1)])
+            self.assertEqual(self.serv.nreq - start, 1)
+
+
+class TestBurst(TestRaw):
+    def setUp(self):
+        self.serv = SimServer(burst=True)
+
+    def test_detect(self):
+        with open(self.serv.url, allow_burst=True) as dev:
+            self.assertTrue(dev.burst_avail)
+
+        self.serv.burst = False
+        with open(self.serv.url, allow_burst=True) as dev:
+            self.assertFalse(dev.burst_avail)
+        # the probe wrote to address 2
+        self.assertIn(2, self.serv.data)
+
+        # no probe, or write, unless asked
+        self.serv.data.pop(2)
+        with open(self.serv.url) as dev:
+            self.assertFalse(dev.burst_avail)
+        self.assertNotIn(2, self.serv.data)
+
+    def test_pack(self):
+        with open(self.serv.url, force_burst=True) as dev:
+            A = [5, 6, 7, 8, 20, 21, 30, 31, 32]
+            V = [None] * 4 + [1, 2] + [None, 3, 4]
+            (offset, msg, (didx, check, write)), = dev._pack(A, V)
+            # burst of 4, then 5 single beats
+            self.assertEqual(len(msg), 2 + 6 + 10)
+            assert_equal(msg[2:4], [0x20000004, 0x10000005])
+
+            self.serv.data[6] = 6
+            self.serv.data[31] = 31
+            assert_equal(dev.exchange(A, V), [0, 6, 0, 0, 1, 2, 0, 3, 4])
+            self.assertEqual(self.serv.data[20], 1)
+            self.assertEqual(self.serv.data[32], 4)
+
+
+class WaveSimServer(SimServer):
+    regmap = dict(SimServer.regmap)
+    regmap.update({
+        'chan_keep': {
+            'access': 'rw',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 200,
+            'data_width': 12,
+        },
+        'wave_samp_per': {
+            'access': 'rw',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 201,
+            'data_width': 8,
+        },
+        'circle_data': {
+            'access': 'r',
+            'addr_width': 5,
+            'sign': 'signed',
+            'base_addr': 256,
+            'data_width': 22,
+        },
+    })
+
+    regmap.update({
+        'shell_0_dsp_tag': {
+            'access': 'rw',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 202,
+            'data_width': 8,
+        },
+        'shell_1_dsp_tag': {
+            'access': 'rw',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 203,
+            'data_width': 8,
+        },
+        'circle_buf_flip': {
+            'access': 'w',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 204,
+            'data_width': 2,
+        },
+        'llrf_circle_ready': {
+            'access': 'r',
+            'addr_width': 0,
+            'sign': 'unsigned',
+            'base_addr': 205,
+            'data_width': 2,
+        },
+        'shell_0_slow_data': {
+            'access': 'r',
+            'addr_width': 6,
+            'sign': 'unsigned',
+            'base_addr': 320,
+            'data_width': 8,
+        },
+        'shell_1_slow_data': {
+            'access': 'r',
+            'addr_width': 6,
+            'sign': 'unsigned',
+            'base_addr': 384,
+            'data_width': 8,
+        },
+    })
+
+    # ready polls until an acquisition completes
+    acq_polls = 2
+
+    def __init__(self, *args, **kws):
+        self.armed = {}  # shell -> polls remaining
+        SimServer.__init__(self, *args, **kws)
+
+    def read(self, addr):
+        if addr == 205:
+            # llrf_circle_ready
+            for shell, remain in list(self.armed.items()):
+                if remain:
+                    self.armed[shell] -= 1
+                    continue
+                # acquisition complete, latch tag
+                del self.armed[shell]
+                self.data[205] = self.data.get(205, 0) | (1 << shell)
+                T = self.data.get(202 + shell, 0)
+                self.data[320 + 64 * shell + 33] = T
+                self.data[320 + 64 * shell + 34] = T
+        return SimServer.read(self, addr)
+
+    def write(self, addr, value):
+        if addr == 204:
+            # circle_buf_flip
+            for shell in range(2):
+                if value & (1 << shell):
+                    self.armed[shell] = self.acq_polls
+                    self.data[205] = self.data.get(205, 0) & ~(1 << shell)
+            return
+        SimServer.write(self, addr, value)
+
+
+class TestWave(unittest.TestCase):
+    def setUp(self):
+        self.serv = WaveSimServer()
+
+    def tearDown(self):
+        self.serv.join()
+
+    def test_channels(self):
+        with open(self.serv.url) as dev:
+            # keep channels 1, 2, and 5
+            self.serv.data[200] = 0b011001000000
+            self.serv.data[201] = 1
+            raw = np.arange(32) - 16
+            for i, v in enumerate(raw):
+                self.serv.data[256 + i] = int(v) & 0xffffffff
+
+            _shift, Ymax = dev._yscale(1)
+
+            A, B = dev.get_channels([5, 1])
+            assert_equal(A, raw[2:30:3] / Ymax)
+            assert_equal(B, raw[0:30:3] / Ymax)
+
+            A, = dev.get_channels([2], dtype='f4')
+            self.assertEqual(A.dtype, np.float32)
+            assert_equal(A, (raw[1:30:3] / Ymax).astype('f4'))
+
+            A, = dev.get_channels([2], dtype='i4')
+            assert_equal(A, raw[1:30:3])
+
+            out = np.zeros((2, 10), dtype='f4')
+            A, B = dev.get_channels([1, 2], out=out)
+            self.assertIs(A.base, out)
+            assert_equal(out[1], (raw[1:30:3] / Ymax).astype('f4'))
+
+            self.assertRaises(RuntimeError, dev.get_channels, [0])
+
+            T0, T1 = dev.get_timebase([1, 2])
+            self.assertEqual(len(T0), 11)
+            self.assertEqual(len(T1), 11)
+            self.assertEqual(T0[1], 2 * 33 * 14 / 1320e6)
+
+    def test_wait(self):
+        with open(self.serv.url) as dev:
+            start = self.serv.nreq
+            tag_match, slow, now = dev.wait_for_acq(tag=True, instance=[0])
+            self.assertTrue(tag_match)
+            self.assertEqual(slow[33], 1)
+            self.assertEqual(self.serv.data[202], 1)
+            # setup read, arm, polls.  No separate slow_data read
+            self.assertEqual(self.serv.nreq - start,
+                             2 + 1 + self.serv.acq_polls)
+
+            tag_match, slow, now = dev.wait_for_acq(instance=[1])
+            self.assertTrue(tag_match)
+
+            self.serv.acq_polls = 1000
+            self.assertRaises(RuntimeError, dev.wait_for_acq,
+                              instance=[0], timeout=0.01)
+
+    def test_acquire(self):
+        with open(self.serv.url) as dev:
+            self.serv.data[200] = 0b110000000000
+            self.serv.data[201] = 1
+            for i in range(32):
+                self.serv.data[256 + i] = i
+
+            R = dev.acquire([0, 1], [[0], [1]], toggle_tag=True,
+                            dtype='i4')
+            self.assertEqual(len(R), 2)
+            for (tag_match, slow, now), (A, B) in R:
+                assert_equal(A, np.arange(0, 32, 2))
+                assert_equal(B, np.arange(1, 32, 2))
+            self.assertEqual(self.serv.data[202], 1)
+            self.assertEqual(self.serv.data[203], 1)
+
+    def test_iter(self):
+        with open(self.serv.url) as dev:
+            self.serv.data[200] = 0b110000000000
+            self.serv.data[201] = 1
+            for i in range(32):
+                self.serv.data[256 + i] = i
+
+            it = dev.iter_acquisitions([1], instance=[0], depth=2,
+                                       tag=True, dtype='i4')
+            now, T, (B0,) = next(it)
+            self.assertEqual(T, 1)
+            assert_equal(B0, np.arange(1, 32, 2))
+            self.serv.data[256 + 1] = 100
+
+            start = self.serv.nreq
+            now, T, (B1,) = next(it)
+            # read, re-arm, polls.  No config re-read
+            self.assertEqual(self.serv.nreq - start,
+                             1 + 1 + self.serv.acq_polls + 1)
+            self.assertEqual(B1[0], 100)
+            self.assertEqual(B0[0], 1)  # depth=2, not yet re-used
+
+            # a write invalidates the cached config
+            dev.reg_write([('chan_keep', 0b111000000000)], instance=[0])
+            for i in range(32):
+                self.serv.data[256 + i] = i
+            now, T, (B2,) = next(it)
+            assert_equal(B2, np.arange(1, 30, 3))
+            it.close()
@@ -0,0 +1,147 @@
+
+import logging
+
+import unittest
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from ..raw import LEEPDevice
+from ..sim import Board, Server
+
+_log = logging.getLogger(__name__)
+
+
+def _reg(base, addr_width=0, data_width=32, sign='unsigned'):
+    return {
+        'access': 'rw',
+        'addr_width': addr_width,
+        'sign': sign,
+        'base_addr': base,
+        'data_width': data_width,
+    }
+
+
+regmap = {
+    'uval': _reg(43),
+    'uarr': _reg(0x1000, addr_width=4),
+    'circle_buf_flip': _reg(10, data_width=2),
+    'llrf_circle_ready': _reg(11, data_width=2),
+    'shell_0_dsp_tag': _reg(12, data_width=8),
+    'shell_0_dsp_chan_keep': _reg(13, data_width=12),
+    'shell_0_dsp_wave_samp_per': _reg(14, data_width=8),
+    'shell_0_slow_data': _reg(0x40, addr_width=6, data_width=8),
+    'shell_0_circle_data': _reg(0x2000, addr_width=10, data_width=22,
+                                sign='signed'),
+    'banyan_status': _reg(20),
+    'rawadc_trig': _reg(21, data_width=1),
+    'banyan_data': _reg(0x3000, addr_width=9),
+}
+
+
+class TestSim(unittest.TestCase):
+    def setUp(self):
+        self.serv = Server(seed=42)
+        self.boards = [Board(regmap, burst=burst, sample_period=1e-8,
+                             seed=1) for burst in (False, True)]
+        self.urls = [self.serv.add(B) for B in self.boards]
+        self.serv.start()
+
+    def tearDown(self):
+        self.serv.stop()
+
+    def test_regs(self):
+        for url, burst in zip(self.urls, (False, True)):
+            dev = LEEPDevice(url[7:], allow_burst=True)
+            self.assertEqual(dev.burst_avail, burst)
+            self.assertEqual(set(dev.regmap), set(regmap))
+            self.assertEqual(dev.descript, b'leep.sim')
+
+            dev.reg_write([('uval', 5), ('uarr', np.arange(16))])
+            uval, uarr = dev.reg_read(['uval', 'uarr'])
+            self.assertEqual(uval, 5)
+            assert_equal(uarr, np.arange(16))
+            dev.close()
+
+    def test_acquire(self):
+        dev = LEEPDevice(self.urls[1][7:])
+        dev.set_channel_mask([0, 1], instance=[0])
+        dev.reg_write([('wave_samp_per', 1)], instance=[0])
+        tag_match, slow, now = dev.wait_for_acq(tag=True, instance=[0])
+        self.assertTrue(tag_match)
+        A, B = dev.get_channels([0, 1], instance=[0], dtype='i4')
+        self.assertEqual(len(A), 512)
+        self.assertGreater(A.max(), 2**19)
+        self.assertLess(A.min(), -2**19)
+        self.assertFalse((A == B).all())
+        dev.close()
+
+    def test_banyan(self):
+        dev = LEEPDevice(self.urls[1][7:])
+        status, = dev.reg_read(['banyan_status'])
+        self.assertEqual(1 << ((status >> 24) & 0x3f), 64)
+        dev.reg_write([('rawadc_trig', 1)])
+        while dev.reg_read(['banyan_status'])[0] & 0x80000000:
+            pass
+        data, = dev.reg_read(['banyan_data'])
+        lo = (data & 0xffff).astype('u2').view('i2')
+        self.assertGreater(abs(lo.astype('i4')).max(), 2**13)
+        dev.close()
+
+
+resctrl_regmap = {
+    'circle_buf_flip': _reg(10, data_width=4),
+    'circle_data_ready': _reg(11, data_width=4),
+    'chan_keep': _reg(13, data_width=12),
+    'wave_samp_per': _reg(14, data_width=8),
+    '__metadata__': {'application': 'RES_CTRL'},
+}
+for _n in range(4):
+    resctrl_regmap['circle_data_%d' % _n] = _reg(0x2000 + 0x400 * _n,
+                                                 addr_width=10)
+
+injector_regmap = {
+    'circle_buf_flip': _reg(10, data_width=2),
+    'llrf_circle_ready': _reg(11, data_width=2),
+    'chan_keep': _reg(13, data_width=12),
+    'wave_samp_per': _reg(14, data_width=8),
+    'circle_data': _reg(0x2000, addr_width=10),
+    '__metadata__': {'application': 'INJECTOR'},
+}
+
+
+class TestApps(unittest.TestCase):
+    def _acquire(self, regmap):
+        with Server() as serv:
+            url = serv.add(Board(regmap, sample_period=1e-8))
+            dev = LEEPDevice(url[7:])
+            dev.reg_write([('wave_samp_per', 1)], instance=None)
+            # w/o instance, as leep.cli acquire
+            self.assertIsNotNone(dev.wait_for_acq(tag=True))
+            dev.close()
+            return dev
+
+    def test_resctrl(self):
+        dev = self._acquire(resctrl_regmap)
+        self.assertTrue(dev.resctrl)
+
+    def test_injector(self):
+        dev = self._acquire(injector_regmap)
+        self.assertTrue(dev.injector)
+
+
+class TestImpair(unittest.TestCase):
+    def test_loss(self):
+        with Server(loss=0.05, reply_loss=0.05, reorder=0.1,
+                    latency=0.0005, seed=2) as serv:
+            url = serv.add(Board(regmap, burst=False))
+            # writes of plain registers may be repeated
+            dev = LEEPDevice(url[7:], window=4, retries=20, write_retries=20,
+                             timeout=0.02)
+            arr = np.arange(0x400)
+            dev.reg_write([('circle_data', arr)], instance=[0])
+            data, = dev.reg_read(['circle_data'], instance=[0])
+            assert_equal(data, arr)
+            self.assertGreater(serv.stats['lost'], 0)
+            self.assertGreater(serv.stats['reordered'], 0)
+            dev.close()
@@ -0,0 +1,65 @@
+
+import unittest
+from urllib.request import urlopen
+
+from .. import open
+from ..stats import Stats, Histogram, to_prometheus, serve_metrics
+from .test_raw import SimServer
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        H = Histogram(bounds=(1.0, 2.0))
+        for dt in (0.5, 1.0, 1.5, 3.0):
+            H.observe(dt)
+        S = H.snapshot()
+        self.assertEqual(S['count'], 4)
+        self.assertEqual(S['sum'], 6.0)
+        self.assertEqual(S['buckets'], [(1.0, 2), (2.0, 3)])
+
+    def test_prometheus(self):
+        S = Stats(retries=2)
+        S.observe('exchange', 0.0002)
+        text = to_prometheus({'a"b': S})
+        self.assertIn('# TYPE leep_retries_total counter\n'
+                      'leep_retries_total{device="a\\"b"} 2\n', text)
+        self.assertIn('leep_op_duration_seconds_bucket{device="a\\"b",'
+                      'op="exchange",le="0.0001"} 0\n', text)
+        self.assertIn('leep_op_duration_seconds_bucket{device="a\\"b",'
+                      'op="exchange",le="0.00025"} 1\n', text)
+        self.assertIn('leep_op_duration_seconds_count{device="a\\"b",'
+                      'op="exchange"} 1\n', text)
+
+
+class TestDevice(unittest.TestCase):
+    def setUp(self):
+        self.serv = SimServer()
+
+    def tearDown(self):
+        self.serv.join()
+
+    def test_stats(self):
+        with open(self.serv.url) as dev:
+            dev.stats.reset()
+            dev.reg_read(['sval'])
+            dev.reg_read(['sval'])
+
+            S = dev.stats.snapshot()
+            self.assertEqual(S['counters']['packets_out'], 2)
+            self.assertEqual(S['counters']['packets_in'], 2)
+            self.assertEqual(S['counters']['bytes_out'], 64)
+            self.assertEqual(S['counters']['retries'], 0)
+            self.assertEqual(S['latency']['reg_read']['count'], 2)
+            self.assertEqual(S['latency']['exchange']['count'], 2)
+
+            server = serve_metrics({'dev': dev}, bind=('127.0.0.1', 0))
+            try:
+                url = 'http://%s:%d/metrics' % server.server_address[:2]
+                with urlopen(url, timeout=5) as R:
+                    text = R.read().decode()
+            finally:
+                server.shutdown()
+                server.server_close()
+            self.assertIn('leep_packets_in_total{device="dev"} 2\n', text)
+            self.assertIn('leep_op_duration_seconds_count{device="dev",'
+                          'op="reg_read"} 2\n', text)
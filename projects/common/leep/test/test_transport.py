@@ -0,0 +1,92 @@
+
+import socket
+import threading
+import unittest
+
+import numpy as np
+from numpy.testing import assert_equal
+
+from ..transport import pack, unpack, new_stats, Transport
+
+
+class TestPack(unittest.TestCase):
+    def test_single(self):
+        (offset, msg, (didx, check, write)), = pack([1, 2], [None, 5])
+        # padded to 8 words with reads of address 0
+        assert_equal(msg[2:], [0x10000001, 0, 2, 5, 0x10000000, 0])
+        assert_equal(didx, [3, 5])
+        self.assertFalse(check[3] or check[5])
+        self.assertTrue(write)
+
+        # 127 operations, 1024 bytes per packet
+        chunks = pack(range(300))
+        self.assertEqual([C[0] for C in chunks], [0, 127, 254])
+        self.assertEqual([len(C[1]) for C in chunks], [256, 256, 94])
+
+    def test_burst(self):
+        chunks = pack(range(600), burst=True)
+        self.assertEqual([C[0] for C in chunks], [0, 255, 510])
+        offset, msg, (didx, check, write) = chunks[2]
+        assert_equal(msg[2:4], [0x20000000 | 90, 0x10000000 | 510])
+        assert_equal(didx, np.arange(4, 94))
+        self.assertFalse(write)
+
+        # a burst alone may exceed 1024 bytes, singles after it may not
+        chunks = pack(list(range(255)) + [1000] * 10, burst=True)
+        self.assertEqual([len(C[1]) for C in chunks], [259, 22])
+
+        # padded to 8 words with a whole read of address 0
+        (offset, msg, layout), = pack([1, 2, 3], burst=True)
+        assert_equal(msg[2:], [0x20000003, 0x10000001, 0, 0, 0,
+                               0x10000000, 0])
+
+        # runs of < 3 are single beats
+        (offset, msg, layout), = pack([1, 2, 10, 11, 12], burst=True)
+        assert_equal(msg[2:7], [0x10000001, 0, 0x10000002, 0, 0x20000003])
+        assert_equal(layout[0], [3, 5, 8, 9, 10])
+
+    def test_unpack(self):
+        (offset, msg, layout), = pack([1, 2])
+        msg[:2] = [0x1234, 0x1234 ^ 0xffffffff]
+        reply = msg.copy()
+        reply[layout[0]] = [7, 8]
+        stats = new_stats()
+        assert_equal(unpack(msg, layout, reply, stats), [7, 8])
+
+        reply[2] = 3  # wrong address
+        self.assertIsNone(unpack(msg, layout, reply, stats))
+        self.assertIsNone(unpack(msg, layout, reply[:4], stats))
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['truncated'], 1)
+
+        # a late reply to an earlier try is dropped quietly
+        reply = msg.copy()
+        reply[0] ^= 1
+        with self.assertLogs('leep.transport', 'DEBUG') as logs:
+            self.assertIsNone(unpack(msg, layout, reply, stats))
+            self.assertIsNone(unpack(msg, layout, reply[:4], stats))
+        self.assertEqual(set(R.levelname for R in logs.records), {'DEBUG'})
+        self.assertEqual(stats['dropped'], 3)
+        self.assertEqual(stats['truncated'], 1)
+
+
+class TestTransport(unittest.TestCase):
+    def test_truncated_once(self):
+        dev = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        dev.bind(('127.0.0.1', 0))
+        T = Transport(dev.getsockname(), timeout=0.5, retries=0)
+
+        def reply():
+            msg, src = dev.recvfrom(2048)
+            dev.sendto(msg[:-2], src)  # odd, and one word short
+        responder = threading.Thread(target=reply)
+        responder.start()
+        try:
+            (offset, msg, layout), = T.pack([1, 2])
+            with self.assertRaises(socket.timeout):
+                T.exchange(msg, layout)
+        finally:
+            responder.join()
+            T.close()
+            dev.close()
+        self.assertEqual(T.stats['truncated'], 1)
@@ -0,0 +1,562 @@
+"""Low level LEEP/Packet Badger UDP transport
+
+Used by leep.raw, leep.aio and badger/lbus_access.py.
+
+A request is a 64-bit nonce followed by operations.  Each single beat
+operation is a command/address word (bit 28 set to read) and a data
+word.  Gateways with block-transfer/repeat-count (burst) support also
+accept a repeat count word (0x2 in bits 29:28), a command/address, then
+count data words.  The reply has the same length, with read data filled in.
+"""
+
+import logging
+
+import random
+import socket
+import time
+
+import numpy
+
+_log = logging.getLogger(__name__)
+# special logger for packet dumps
+_spam = logging.getLogger(__name__ + '.packets')
+_spam.propagate = False
+
+be32 = numpy.dtype('>u4')
+
+# Request size limit in 32-bit words, including the nonce.
+# 127 single beat operations, 1024 bytes, as the gateway receive buffer.
+# A packet of one burst may be longer, up to 4 + MAX_BURST words.
+MAX_WORDS = 2 + 2 * 127
+MAX_BURST = 255
+
+
+def burst_probe():
+    """Build the block-transfer/repeat-count probe message.
+
+    A gateway without burst support will see two writes to address 2.
+    """
+    msg = numpy.zeros(14, dtype=be32)
+    msg[0] = random.randint(0, 0xffffffff)
+    msg[1] = msg[0] ^ 0xffffffff
+    msg[2] = 0x10000002  # read 2
+    msg[3] = 0xa5a5a5a5  # pad
+    msg[4] = 0x10000001  # read 1
+    msg[5] = 0xa5a5a5a5  # pad
+    msg[6] = 0x20000002  # repeat 2 / write 2
+    msg[7] = 0x10000001  # read 1 / write data
+    msg[8] = 0x10000001  # pad / read 1
+    msg[9] = 0xa5a5a5a5  # pad
+    msg[10] = 0x20000002  # repeat 2 / write 2
+    msg[11] = 0x10000001  # read 1 / write data
+    msg[12] = 0x10000002  # pad / read 2
+    msg[13] = 0xa5a5a5a5  # pad
+    return msg
+
+
+def burst_check(msg, reply):
+    """Interpret the reply to burst_probe()
+    :returns: True if the gateway supports burst.
+    """
+    r1, r2 = reply[5], reply[3]
+    if msg[8] == reply[8] and r1 == reply[9] and \
+            msg[12] == reply[12] and r2 == reply[13]:
+        _log.debug('Seems to be no-burst')
+        return False
+    elif r1 == reply[8] and r2 == reply[9] and \
+            r1 == reply[12] and r2 == reply[13]:
+        _log.debug('Seems to be burst')
+        return True
+    else:
+        _log.warning('Burst autodetect failed')
+        return False
+
+
+def _arrays(addrs, values):
+    """Address, value and read-flag arrays.  Values of None are reads.
+    """
+    if isinstance(addrs, range):
+        addrs = numpy.arange(addrs.start, addrs.stop, addrs.step,
+                             dtype='i8')
+    else:
+        addrs = numpy.asarray(addrs, dtype='i8')
+    N = len(addrs)
+    if values is None:
+        return addrs, numpy.zeros(N, 'u4'), numpy.ones(N, dtype=bool)
+    elif isinstance(values, numpy.ndarray):
+        return addrs, values.astype('u4'), numpy.zeros(N, dtype=bool)
+    values = list(values)
+    read = numpy.fromiter((V is None for V in values), bool, N)
+    values = numpy.fromiter(((V or 0) & 0xffffffff for V in values),
+                            'u4', N)
+    return addrs, values, read
+
+
+def _segments(addrs, read, burst, max_burst):
+    """Group operations into runs.
+    :returns: list of (start, stop, is_burst)
+    """
+    N = len(addrs)
+    if not burst or max_burst < 3:
+        return [(0, N, False)]
+
+    # runs of consecutive addresses w/ same direction
+    brk = numpy.flatnonzero((numpy.diff(addrs) != 1) |
+                            (read[1:] != read[:-1])) + 1
+    starts = [0] + list(brk)
+    stops = list(brk) + [N]
+
+    ret = []
+    for i, j in zip(starts, stops):
+        while j - i >= 3:
+            # burst of 1 or 2 is no shorter than single beat
+            k = min(j, i + max_burst)
+            if k - i < 3:
+                break
+            ret.append((i, k, True))
+            i = k
+        if i < j:
+            if ret and not ret[-1][2]:
+                ret[-1] = (ret[-1][0], j, False)  # merge singles
+            else:
+                ret.append((i, j, False))
+    return ret
+
+
+def pack(addrs, values=None, burst=False, max_words=MAX_WORDS,
+         max_burst=MAX_BURST):
+    """Encode address/value lists as a list of request messages.
+
+    Consecutive addresses which are all read, or all written, are
+    encoded as block-transfer/repeat-count transactions if burst.
+    Otherwise each operation takes two words.
+
+    :param addrs: Addresses.  A list, range, or array.
+    :param values: Values, with None to read.  Or None to read all,
+                   or an array to write all.
+    :returns: A list of (offset, msg, layout) where offset is the index
+              of the first operation in msg, and layout is
+              (didx, check, write).  didx is an array of the reply word
+              indices holding the data of each operation in msg.  check
+              masks the reply words which must be echoed.  write is True
+              if msg includes any write.  The nonce words of msg are
+              filled in when sent.
+    """
+    addrs, values, read = _arrays(addrs, values)
+    N = len(addrs)
+    ret = []
+    if N == 0:
+        return ret
+    cmds = (addrs & 0x00ffffff).astype('u4')
+    cmds[read] |= 0x10000000
+
+    # (start, stop, is_burst) of each piece in each packet
+    packets, cur, used = [], [], 2
+    for i, j, isburst in _segments(addrs, read, burst, max_burst):
+        if isburst:
+            # alone, a burst may exceed max_words
+            if cur and used + 2 + j - i > max_words:
+                packets.append(cur)
+                cur, used = [], 2
+            cur.append((i, j, True))
+            used += 2 + j - i
+            continue
+        while i < j:
+            room = (max_words - used) // 2
+            if room <= 0:
+                packets.append(cur)
+                cur, used = [], 2
+                continue
+            k = min(j, i + room)
+            cur.append((i, k, False))
+            used += 2 * (k - i)
+            i = k
+    packets.append(cur)
+
+    for pieces in packets:
+        nwords = 2 + sum([2 + j - i if isburst else 2 * (j - i)
+                          for i, j, isburst in pieces])
+        # pad short messages to 8 words with whole (command, data)
+        # pairs, reading address zero
+        npad = 2 * (-(-max(8 - nwords, 0) // 2))
+        msg = numpy.zeros(nwords + npad, dtype=be32)
+        msg[nwords::2] = 0x10000000
+        didx = numpy.empty(pieces[-1][1] - pieces[0][0], dtype=int)
+        w, d = 2, 0
+        for i, j, isburst in pieces:
+            n = j - i
+            if isburst:
+                msg[w] = 0x20000000 | n
+                msg[w + 1] = cmds[i]
+                msg[w + 2:w + 2 + n] = values[i:j]
+                didx[d:d + n] = numpy.arange(w + 2, w + 2 + n)
+                w += 2 + n
+            else:
+                msg[w:w + 2 * n:2] = cmds[i:j]
+                msg[w + 1:w + 2 * n:2] = values[i:j]
+                didx[d:d + n] = numpy.arange(w + 1, w + 2 * n, 2)
+                w += 2 * n
+            d += n
+        # everything but the data words is echoed back
+        check = numpy.ones(len(msg), dtype=bool)
+        check[didx] = False
+        write = not read[pieces[0][0]:pieces[-1][1]].all()
+        write = bool(write)
+        ret.append((pieces[0][0], msg, (didx, check, write)))
+    return ret
+
+
+def new_stats():
+    """:returns: Zeroed transport statistics
+    """
+    return {
+        'packets_out': 0,
+        'packets_in': 0,
+        'bytes_out': 0,
+        'bytes_in': 0,
+        'retries': 0,  # retransmissions
+        'timeouts': 0,  # requests given up on
+        'truncated': 0,  # replies of the wrong length
+        'dropped': 0,  # replies w/o matching nonce, or out of order
+    }
+
+
+def words(reply):
+    """Reply bytes as an array of words, ignoring any partial word.
+    """
+    return numpy.frombuffer(reply, be32, len(reply) // 4)
+
+
+def unpack(msg, layout, reply, stats=None):
+    """Validate a reply against the request message.
+
+    :param reply: Reply words.
+    :param dict stats: Transport statistics to update.
+    :returns: A copy of the data words, or None if the reply does not
+              belong to msg.
+    """
+    if len(reply) >= 2 and (msg[:2] != reply[:2]).any():
+        # expected, eg. a late reply to a try before a retransmission
+        _log.debug('Ignore reply w/o matching nonce %s %s',
+                   msg[:2], reply[:2])
+        if stats is not None:
+            stats['dropped'] += 1
+        return None
+
+    if len(msg) != len(reply):
+        _log.error("Reply truncated %d %d", 4 * len(msg), 4 * len(reply))
+        if stats is not None:
+            stats['truncated'] += 1
+        return None
+
+    didx, check = layout[0], layout[1]
+    if (msg[check] != reply[check]).any():
+        _log.error('reply addresses are out of order')
+    else:
+        return reply[didx]
+    if stats is not None:
+        stats['dropped'] += 1
+    return None
+
+
+class RTTEstimator(object):
+    """Adaptive retransmission timeout from the smoothed round trip
+    time and its variation, as in TCP (RFC 6298).
+
+    :param float initial: Timeout before the first sample, and upper bound.
+    :param float minimum: Lower bound.
+    """
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, initial=0.1, minimum=0.002):
+        self.maximum = initial
+        self.minimum = min(minimum, initial)
+        self.srtt = self.rttvar = None
+        self.rto = initial
+
+    def sample(self, rtt):
+        """Update from the round trip time of one transmission.
+
+        Retransmissions carry a new nonce, so unlike TCP (Karn's
+        algorithm) replies to them are not ambiguous and are sampled too.
+        """
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar += self.beta * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += self.alpha * (rtt - self.srtt)
+        self.rto = min(self.maximum,
+                       max(self.minimum, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        """After a timeout, double the timeout.
+        """
+        self.rto = min(self.maximum, 2 * self.rto)
+
+
+class Transport(object):
+    """One UDP socket to a gateway.
+
+    :param tuple dest: (host, port)
+    :param float timeout: Reply timeout (seconds).
+    :param int window: Number of request datagrams which may be in
+                       flight.  1 is strict stop-and-wait.
+    :param int retries: Retransmissions of a lost read request before
+                        giving up.
+    :param int write_retries: Retransmissions of a lost request which
+                              writes.  Default 0, as a write may have
+                              been applied even though the reply was lost.
+                              Only for devices where writes are idempotent.
+    :param float min_timeout: Lower bound of the adaptive timeout.
+    :param rtt: An :py:class:`RTTEstimator` to share.  Default a new one.
+
+    While a retransmission remains, a request is given up on after an
+    adaptive timeout (see :py:class:`RTTEstimator`), a few times the
+    round trip time.  The last attempt, and a write without
+    write_retries, waits for the full timeout.
+    :param bool burst: Gateway supports block-transfer/repeat-count.
+                       See probe_burst().
+    :param dict stats: Counters to update, eg. a device's
+                       :py:class:`leep.stats.Stats`.  Default a new dict.
+    """
+    max_words = MAX_WORDS
+    max_burst = MAX_BURST
+    max_reply = 1500
+
+    def __init__(self, dest, timeout=0.1, window=1, retries=2, burst=False,
+                 stats=None, write_retries=0, min_timeout=0.002, rtt=None):
+        self.dest = dest
+        self.timeout = timeout
+        self.window = max(1, int(window))
+        self.retries = retries
+        self.write_retries = write_retries
+        self.rtt = RTTEstimator(timeout, min_timeout) if rtt is None else rtt
+        self.burst = burst
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        self.sock.settimeout(timeout)
+        # reusable reply buffer
+        self._rxbuf = bytearray(self.max_reply)
+        self._rxwords = numpy.frombuffer(self._rxbuf, be32)
+        # request buffer of exchange().  Messages from pack() may be
+        # shared between transports, so the nonce is filled in a copy.
+        self._txwords = numpy.zeros(self.max_reply // 4, be32)
+
+        self.stats = {} if stats is None else stats
+        for key, val in new_stats().items():
+            self.stats.setdefault(key, val)
+
+    def close(self):
+        self.sock.close()
+
+    def clone(self):
+        """A new transport (socket) to the same destination, with the
+        same settings, sharing stats and RTT estimate.
+        """
+        return Transport(self.dest, timeout=self.timeout, window=self.window,
+                         retries=self.retries, burst=self.burst,
+                         stats=self.stats, write_retries=self.write_retries,
+                         rtt=self.rtt)
+
+    def probe_burst(self):
+        """Determines if device supports block-transfer/repeat-count.
+        Sets and returns self.burst
+        """
+        msg = burst_probe()
+        self.sock.settimeout(self.timeout)
+        self.send(msg, nonce=False)
+        try:
+            while True:
+                reply = self.recv()
+                if len(reply) == len(msg) and \
+                        (reply[:2] == msg[:2]).all():
+                    break
+        except socket.timeout:
+            _log.debug('Burst autodetect timeout')
+            self.burst = False
+            return False
+
+        self.burst = burst_check(msg, reply)
+        return self.burst
+
+    def pack(self, addrs, values=None):
+        """See :py:func:`pack`
+        """
+        return pack(addrs, values, burst=self.burst,
+                    max_words=self.max_words, max_burst=self.max_burst)
+
+    def send(self, msg, nonce=True):
+        """Send a request.  With nonce, a new nonce is placed in msg.
+        """
+        if nonce:
+            msg[0] = random.randint(0, 0xffffffff)
+            msg[1] = msg[0] ^ 0xffffffff
+        _spam.debug("%s Send (%d) %s", self.dest, msg.nbytes,
+                    repr(msg.tobytes()))
+        self.sock.sendto(msg, self.dest)
+        self.stats['packets_out'] += 1
+        self.stats['bytes_out'] += msg.nbytes
+
+    def recv(self):
+        """Receive one reply.
+        :returns: Array of reply words, a view valid until the next recv().
+        """
+        nbytes = self.sock.recv_into(self._rxbuf)
+        _spam.debug("%s Recv (%d) %s", self.dest, nbytes,
+                    repr(bytes(self._rxbuf[:nbytes])))
+        self.stats['packets_in'] += 1
+        self.stats['bytes_in'] += nbytes
+        # a partial last word is dropped.  A reply which is then too
+        # short is counted as truncated where it is checked.
+        return self._rxwords[:nbytes // 4]
+
+    def unpack(self, msg, layout, reply):
+        """See :py:func:`unpack`
+        """
+        return unpack(msg, layout, reply, self.stats)
+
+    def _policy(self, layout, tries):
+        """:returns: (retry, timeout) for attempt number tries
+        """
+        limit = self.write_retries if layout[2] else self.retries
+        if tries < limit:
+            return True, self.rtt.rto
+        return False, self.timeout
+
+    def exchange(self, msg, layout):
+        """Exchange a single low level message,
+        retransmitting (with a new nonce) as allowed.
+        """
+        if len(msg) <= len(self._txwords):
+            tx = self._txwords[:len(msg)]
+            tx[:] = msg
+            msg = tx
+        else:
+            msg = msg.copy()
+        tries = 0
+        while True:
+            retry, wait = self._policy(layout, tries)
+            self.send(msg)
+            start = time.perf_counter()
+            deadline = start + wait
+            try:
+                while True:
+                    remain = deadline - time.perf_counter()
+                    if remain <= 0:
+                        raise socket.timeout()
+                    self.sock.settimeout(remain)
+                    reply = self.recv()
+                    ret = self.unpack(msg, layout, reply)
+                    if ret is not None:
+                        self.rtt.sample(time.perf_counter() - start)
+                        return ret
+            except socket.timeout:
+                self.rtt.backoff()
+                if not retry:
+                    self.stats['timeouts'] += 1
+                    raise socket.timeout('exchange timeout after %d retries'
+                                         % tries)
+            _log.debug('Retransmit to %s', self.dest)
+            self.stats['retries'] += 1
+            tries += 1
+
+    def exchange_pipelined(self, chunks, ret):
+        """Exchange several low level messages, keeping up to self.window
+        requests in flight.  Replies are matched to requests by nonce
+        and may arrive in any order.  Requests which time out are
+        retransmitted (with a new nonce) as allowed by self.retries
+        and self.write_retries.
+
+        :param list chunks: list of (offset, msg, layout) from pack().
+        :param ret: Array into which reply data is placed at offset,
+                    or None to discard.
+        """
+        todo = list(reversed(chunks))  # pop() from the end
+        # nonce -> [deadline, tries, offset, msg, layout, retry, start]
+        inflight = {}
+
+        def send(offset, msg, layout, tries):
+            if tries == 0:
+                msg = msg.copy()  # see _txwords
+            retry, wait = self._policy(layout, tries)
+            self.send(msg)
+            start = time.perf_counter()
+            inflight[int(msg[0])] = [start + wait, tries, offset, msg, layout,
+                                     retry, start]
+
+        try:
+            while todo or inflight:
+                while todo and len(inflight) < self.window:
+                    send(*todo.pop(), tries=0)
+
+                now = time.perf_counter()
+                deadline = min([E[0] for E in inflight.values()])
+                if deadline <= now:
+                    # retransmit everything which has timed out
+                    for nonce, E in list(inflight.items()):
+                        if E[0] > now:
+                            continue
+                        del inflight[nonce]
+                        self.rtt.backoff()
+                        if not E[5]:
+                            self.stats['timeouts'] += 1
+                            raise socket.timeout(
+                                'exchange timeout after %d retries'
+                                % E[1])
+                        _log.debug('Retransmit chunk @%d', E[2])
+                        self.stats['retries'] += 1
+                        send(E[2], E[3], E[4], E[1] + 1)
+                    continue
+
+                self.sock.settimeout(deadline - now)
+                try:
+                    reply = self.recv()
+                except socket.timeout:
+                    continue
+
+                if len(reply) < 2:
+                    _log.error("Reply truncated %d", 4 * len(reply))
+                    self.stats['truncated'] += 1
+                    continue
+
+                E = inflight.get(int(reply[0]))
+                if E is None:
+                    # perhaps a late reply to a retransmitted request
+                    _log.debug('Ignore reply w/o matching nonce %08x',
+                               reply[0])
+                    self.stats['dropped'] += 1
+                    continue
+
+                P = self.unpack(E[3], E[4], reply)
+                if P is None:
+                    continue
+
+                del inflight[int(reply[0])]
+                self.rtt.sample(time.perf_counter() - E[6])
+                if ret is not None:
+                    ret[E[2]:E[2] + len(P)] = P
+        finally:
+            self.sock.settimeout(self.timeout)
+
+    def run(self, chunks, ret):
+        """Exchange messages from pack().
+        Reply data is stored in ret, unless ret is None.
+        """
+        if self.window > 1 and len(chunks) > 1:
+            self.exchange_pipelined(chunks, ret)
+            return
+
+        for i, msg, layout in chunks:
+            P = self.exchange(msg, layout)
+            if ret is not None:
+                ret[i:i + len(P)] = P
+
+    def transact(self, addrs, values=None):
+        """Accepts a list of address and values (None to read).
+        Returns a numpy.ndarray in the same order.
+        """
+        chunks = self.pack(addrs, values)
+        ret = numpy.zeros(sum([len(C[2][0]) for C in chunks]), be32)
+        self.run(chunks, ret)
+        return ret
@@ -8,9 +8,9 @@ import numpy as np
 
 from litex import RemoteClient
 
-from misc import ADC, DataBlock
+from misc import ADC, BlockRing, DataBlock, PostProcessor
 from banyan_ch_find import banyan_ch_find
-from get_raw_adcs import collect_adcs
+from get_raw_adcs import by_channel, collect_adcs
 from zest_setup import c_zest
 from ltc_setup_litex_client import initLTC, get_data
 
@@ -30,11 +30,8 @@ class Carrier():
         raise NotImplementedError
 
     def _process_subscriptions(self):
-        # TODO: Perhaps implement something to avoid race condition on results
-        for sub_id, (single_subscribe, fn, *fn_args) in list(self.subscriptions.items()):
-            self.results[sub_id] = fn(self._db, *fn_args)
-            if single_subscribe:
-                self.remove_subscription(sub_id)
+        # publish to the ring, read by the worker pool and any other consumers
+        self.ring.put(self._db)
 
     def add_subscription(self, sub_id, fn, *fn_args, single_subscribe=False):
         # TODO: Add args/kwargs to the function
@@ -58,6 +55,8 @@ class LTCOnMarblemini(Carrier):
         self.test = test
         self.pts_per_ch = 8192
         self.subscriptions, self.results = {}, {}
+        self.ring = BlockRing()
+        self.processor = PostProcessor(self)
         self.set_log_decimation_factor(log_decimation_factor)
         self.wb = RemoteClient()
         self.wb.open()
@@ -119,15 +118,22 @@ class ZestOnBMB7Carrier(Carrier):
         self.set_log_decimation_factor(log_decimation_factor)
         self.pts_per_ch = self.npt * 8 // self.n_channels
         self.subscriptions, self.results = {}, {}
+        self.ring = BlockRing()
+        self.processor = PostProcessor(self)
 
     def set_log_decimation_factor(self, ldf):
         Logger.info(f'Changed log_decimation factor from {self.log_decimation_factor} to {ldf}')
         ADC.decimation_factor = 1 << ldf
         if not self.test:
-            try:
-                self.carrier.leep.reg_write([('config_adc_downsample_ratio', ldf)])
-            except socket.timeout:
-                self.set_log_decimation_factor(ldf)
+            # rewriting the same value is harmless, so retry a few times
+            for attempt in range(3):
+                try:
+                    self.carrier.leep.reg_write([('config_adc_downsample_ratio', ldf)])
+                    break
+                except socket.timeout:
+                    Logger.warning('Timeout writing config_adc_downsample_ratio, attempt {}'.format(attempt + 1))
+            else:
+                raise socket.timeout('config_adc_downsample_ratio write failed')
         ADC.fpga_output_rate = ADC.sample_rate / ADC.decimation_factor
         self.log_decimation_factor = ldf
 
@@ -147,19 +153,16 @@ class ZestOnBMB7Carrier(Carrier):
             except socket.timeout:
                 print('foo')
                 continue
-            data_raw = [y for _, y in sorted(zip(self.channel_order, data_raw_))]
+            data_raw = by_channel(data_raw_, self.channel_order)
             print(self.npt, self.n_channels, time.time()-start, self.channel_order)
-            self._db = DataBlock(ADC.counts_to_volts(np.array(data_raw)), ts)
+            self._db = DataBlock(ADC.counts_to_volts(data_raw), ts)
             # ADC count / FULL SCALE => [-1.0, 1.]
             self._process_subscriptions()
             # time.sleep(0.1)  # This is now unnecessary, as this routine is the bottleneck
 
     def _process_subscriptions(self):
-        # TODO: Perhaps implement something to avoid race condition on results
-        for sub_id, (single_subscribe, fn, *fn_args) in list(self.subscriptions.items()):
-            self.results[sub_id] = fn(self._db, *fn_args)
-            if single_subscribe:
-                self.remove_subscription(sub_id)
+        # publish to the ring, read by the worker pool and any other consumers
+        self.ring.put(self._db)
 
     def add_subscription(self, sub_id, fn, *fn_args, single_subscribe=False):
         # TODO: Add args/kwargs to the function
@@ -22,7 +22,7 @@ from threading import Thread
 from matplotlib import pyplot as plt
 
 from carrier import ZestOnBMB7Carrier, LTCOnMarblemini
-from misc import Processing
+from misc import Processing, SpectrumAverage, CrossSpectrumAverage, minmax_decimate
 
 g_plot_type_limits = {}
 
@@ -76,21 +76,29 @@ class GUIGraph:
         self.ax.grid(True)
         self.carrier_ch_n = int(ch_id[1]) if int(ch_id[0]) < 2 else None
         self.plot_info = plot_info
-        self._old_results = []
+        self._old_seq = None
+        self.skipped = 0  # frames computed, but never drawn
 
     def update_data(self):
         if self.ch_id not in carrier.results:
             # Logger.critical('No data found')
             return
-        if carrier.results[self.ch_id] is self._old_results:
+        seq, results = carrier.results[self.ch_id]
+        if seq == self._old_seq:
             return
+        if self._old_seq is not None and seq > self._old_seq + 1:
+            self.skipped += seq - self._old_seq - 1
+        self._old_seq = seq
         if self.plot_info.plot_type == 'T':
-            x_data, y_data, y_max, ts = carrier.results[self.ch_id]
+            x_data, y_data, y_max, ts = results
         elif self.plot_info.plot_type == 'F':
-            x_data, y_data, xargmax, y_max = carrier.results[self.ch_id]
+            x_data, y_data, xargmax, y_max = results
+        # no more than 2 points per pixel column
+        x_data, y_data = minmax_decimate(x_data, y_data, int(self.fig.bbox.width))
         self.line.set_xdata(x_data)
         self.line.set_ydata(y_data)
-        self._old_results = carrier.results[self.ch_id]
+        self.ax.set_title('frame {}, skipped {}, dropped {}'.format(
+            seq, self.skipped, carrier.processor.dropped), fontsize='small')
         if not self.plot_info.autoscale:
             self.ax.set_xlim(self.plot_info.xlim)
             self.ax.set_ylim(self.plot_info.ylim)
@@ -234,13 +242,13 @@ class Logic(BoxLayout):
                 carrier.add_subscription(plot_id, Processing.time_domain,
                                          int(plot_id[1]))
             elif plot_type == '1':
-                carrier.add_subscription(plot_id, Processing.stacking_fft,
-                                         int(plot_id[1]), 'hanning')
+                carrier.add_subscription(plot_id, SpectrumAverage(
+                    int(plot_id[1]), 'hanning', mode='peak'))
             elif plot_type == '3':
                 print(self.csd_channels)
-                carrier.add_subscription('3', Processing.H,
-                                         self.csd_channels[0],
-                                         self.csd_channels[1], 'hanning')
+                carrier.add_subscription('3', CrossSpectrumAverage(
+                    self.csd_channels[0], self.csd_channels[1], kind='H',
+                    window='hanning'))
         else:
             CH.set_plot_active(False)
             self.remove_widget(CH.wid)
@@ -254,8 +262,9 @@ class Logic(BoxLayout):
             if any([x >= carrier.n_channels for x in self.csd_channels]):
                 raise Exception
             Logger.info('Set CSD channels to: {}'.format(args[1]))
-            carrier.add_subscription('3', Processing.csd, self.csd_channels[0],
-                                     self.csd_channels[1], 'hanning')
+            carrier.add_subscription('3', CrossSpectrumAverage(
+                self.csd_channels[0], self.csd_channels[1], kind='csd',
+                window='hanning'))
         except Exception:
             Logger.warning('Invalid CSD string: ' + args[1])
 
@@ -264,8 +273,8 @@ class Logic(BoxLayout):
             'save', Processing.save, copy.deepcopy(carrier._db), single_subscribe=True)
 
     def restack_data(self, *args):
-        Processing.reset_ch_stack_count(0)
-        Processing.reset_ch_stack_count(1)
+        # restart averages of all stateful subscriptions
+        carrier.processor.reset()
 
     def update_graph(self, dt):
         for _, ch in GUIGraph.graphs.items():
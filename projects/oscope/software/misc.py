@@ -1,9 +1,18 @@
+import logging
+import os
+import threading
 import time
+import copy
 import dataclasses
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 
 import numpy as np
+from scipy import fft as sp_fft
 from scipy import signal
 
+Logger = logging.getLogger(__name__)
+
 
 @dataclasses.dataclass
 class ADC:
@@ -32,10 +41,85 @@ class ADC:
         return raw_counts
 
 
+# per worker thread buffers
+_scratch = threading.local()
+
+
+@lru_cache(maxsize=32)
+def get_window(window, n):
+    '''
+    float32 window of n points, and its sum and sum of squares.
+    'hanning' is accepted for 'hann'
+    '''
+    if window == 'hanning':
+        window = 'hann'
+    w = signal.get_window(window, n).astype(np.float32)
+    w.setflags(write=False)
+    return w, float(w.sum(dtype=np.float64)), float(np.dot(w, w))
+
+
+@lru_cache(maxsize=32)
+def rfft_freqs(n, rate):
+    f = np.fft.rfftfreq(n, d=1 / rate)
+    f.setflags(write=False)
+    return f
+
+
 class DataBlock():
     def __init__(self, data_block, ts=time.time()):
         self.ts = ts
         self.data = data_block
+        # (ch_n, window, nperseg, noverlap) -> Future of the spectrum.
+        # See spectrum()
+        self._spectra = {}
+        self._lock = threading.Lock()
+
+    def __deepcopy__(self, memo):
+        return DataBlock(copy.deepcopy(self.data, memo), self.ts)
+
+    def spectrum(self, ch_n, window='hann', nperseg=None, noverlap=None):
+        '''
+        Windowed FFT (complex64) of a channel, computed once
+        and shared by all subscriptions, whichever thread asks first.
+
+        With nperseg, the channel is split into segments of nperseg
+        points overlapping by noverlap (default nperseg // 2), as for
+        Welch's method, and the result has one row per segment.
+        '''
+        n = len(self.data[ch_n])
+        if nperseg is None or nperseg >= n:
+            nperseg, noverlap = None, None
+        elif noverlap is None:
+            noverlap = nperseg // 2
+        key = (ch_n, window, nperseg, noverlap)
+        with self._lock:
+            fut = self._spectra.get(key)
+            mine = fut is None
+            if mine:
+                fut = self._spectra[key] = Future()
+        if mine:
+            try:
+                fut.set_result(self._spectrum(ch_n, window, nperseg, noverlap))
+            except BaseException as e:
+                fut.set_exception(e)
+                raise
+        return fut.result()
+
+    def _spectrum(self, ch_n, window, nperseg, noverlap):
+        x = np.asarray(self.data[ch_n])
+        if nperseg is not None:
+            step = nperseg - noverlap
+            x = np.lib.stride_tricks.sliding_window_view(x, nperseg)[::step]
+        w, _s1, _s2 = get_window(window, x.shape[-1])
+        # windowed samples in a reusable float32 buffer
+        bufs = getattr(_scratch, 'bufs', None)
+        if bufs is None:
+            bufs = _scratch.bufs = {}
+        buf = bufs.get(x.shape)
+        if buf is None:
+            buf = bufs[x.shape] = np.empty(x.shape, np.float32)
+        np.multiply(x, w, out=buf)
+        return sp_fft.rfft(buf, axis=-1, overwrite_x=True)
 
 
 def vdir(obj):
@@ -45,30 +129,17 @@ def vdir(obj):
 class Processing:
     '''
     A set of data processing functions for an Oscilloscope
+    Stateful (averaging) subscriptions are SpectrumAverage and
+    CrossSpectrumAverage.
     TODO:
     1. Easily testable in itself. So add python unittests!
     '''
-    max_val_freq, max_val = 0.0, 0.0
-    stacked_fft = {}
-    stacked_H = {}
-    stacked_data = {}
-    stack_n = 100000
-    old_data = None
-    fft_stack_count = {0: 0, 1: 0, 2: 0, 3: 0}
-    H_stack_count = {0: 0, 1: 0}
 
     @staticmethod
     def time_domain(data_block, ch_n):
         ch_data = data_block.data[ch_n]
-        # with open('td_file', 'a') as f:
-        #     f.write('{}, {}, {}, {}, {}\n'.format(np.max(ch_data),
-        #                                           np.max(ch_data) -
-        #                                           np.min(ch_data),
-        #                                           Processing.max_val_freq,
-        #                                           Processing.max_val,
-        #                                           ch_n))
         T = np.arange(len(ch_data)) / ADC.fpga_output_rate  # in seconds
-        return T, ch_data, np.max(ch_data) - np.min(ch_data), data_block.ts
+        return T, ch_data, int(np.max(ch_data)) - int(np.min(ch_data)), data_block.ts
 
     @staticmethod
     def save(data_block, *args):
@@ -81,100 +152,428 @@ class Processing:
             np.savetxt(f, data.T, fmt='%d')
 
     @staticmethod
-    def fft(data_block, ch_n, window):
-        ch_data = data_block.data[ch_n]
-        fft_x = np.fft.rfftfreq(len(ch_data), d=1 / ADC.fpga_output_rate)
-        fft_result = np.abs(np.fft.rfft(ch_data))
-        amax = np.argmax(fft_result[10:])
-        Processing.max_val_freq = fft_x[10:][amax]
-        Processing.max_val = np.max(fft_result[10:])
-        return (fft_x[10:], fft_result[10:],
-                Processing.max_val_freq, Processing.max_val)
+    def amplitude(data_block, ch_n, window):
+        '''
+        Magnitude of the shared windowed FFT, scaled to the
+        same coherent gain as an unwindowed FFT
+        '''
+        n = len(data_block.data[ch_n])
+        _w, s1, _s2 = get_window(window, n)
+        fft_result = np.abs(data_block.spectrum(ch_n, window))
+        fft_result *= n / s1
+        return rfft_freqs(n, ADC.fpga_output_rate), fft_result
 
     @staticmethod
-    def reset_ch_stack_count(ch_n):
-        Processing.fft_stack_count[ch_n] = 0
-        Processing.H_stack_count[ch_n] = 0
+    def density_scale(P, n, window):
+        '''
+        Scale (in place) |X|**2 or conj(X)*Y of n point windowed FFTs
+        to a one-sided spectral density
+        '''
+        _w, _s1, s2 = get_window(window, n)
+        P *= 2 / (ADC.fpga_output_rate * s2)
+        P[..., 0] /= 2
+        if n % 2 == 0:
+            P[..., -1] /= 2
+        return P
 
     @staticmethod
-    def stacking_fft(data_block, ch_n, window):
-        ch_data = data_block.data[ch_n]
-        count = Processing.fft_stack_count[ch_n] % Processing.stack_n
-        fft_x = np.fft.rfftfreq(len(ch_data), d=1 / ADC.fpga_output_rate)
-        fft_result = np.abs(np.fft.rfft(ch_data))
-        if count == 0:
-            Processing.stacked_fft[ch_n] = fft_result
+    def cross_density(data_block, ch_1, ch_2, window, nperseg=None):
+        '''
+        One-sided cross spectral density (PSD if ch_1 == ch_2)
+        from the shared windowed FFTs.  With nperseg, averaged over
+        Welch segments of nperseg points, overlapping by half
+        '''
+        X = data_block.spectrum(ch_1, window, nperseg)
+        if ch_1 == ch_2:
+            P = power(X)
         else:
-            Processing.stacked_fft[ch_n] = np.amax(
-                [fft_result, Processing.stacked_fft[ch_n]], axis=0)
-            Processing.stacked_fft[ch_n] = fft_result
-        amax = np.argmax(fft_result[10:])
-        Processing.max_val_freq = fft_x[10:][amax]
-        Processing.max_val = np.max(fft_result[10:])
-        Processing.fft_stack_count[ch_n] += 1
-        return (fft_x[10:],
-                Processing.stacked_fft[ch_n][10:],
-                Processing.max_val_freq,
-                Processing.max_val)
+            P = np.conj(X) * data_block.spectrum(ch_2, window, nperseg)
+        if P.ndim == 2:
+            P = P.mean(axis=0, dtype=P.dtype)
+        # FFT length
+        n = nperseg if X.ndim == 2 else len(data_block.data[ch_1])
+        return (rfft_freqs(n, ADC.fpga_output_rate),
+                Processing.density_scale(P, n, window))
 
     @staticmethod
-    def stacking2_fft(data_block, ch_n, window):
-        ch_data = data_block.data[ch_n]
-        count = Processing.fft_stack_count[ch_n] % Processing.stack_n
-        fft_x = np.fft.rfftfreq(len(ch_data), d=1 / ADC.fpga_output_rate)
-        # fft_result = np.abs(np.fft.rfft(ch_data))
-        fft_result = (np.fft.rfft(ch_data))
-        if count == 0:
-            Processing.stacked_fft[ch_n] = fft_result
-        else:
-            Processing.stacked_fft[ch_n] += fft_result
-        amax = np.argmax(fft_result[10:])
-        Processing.max_val_freq = fft_x[10:][amax]
-        Processing.max_val = np.max(fft_result[10:])
-        Processing.fft_stack_count[ch_n] += 1
-        return (fft_x[10:],
-                Processing.stacked_fft[ch_n][10:] / (count + 1),
-                Processing.max_val_freq,
-                Processing.max_val)
+    def peak(fft_x, fft_result, skip=10):
+        '''
+        Frequency and value of the largest bin, ignoring the first skip
+        '''
+        amax = np.argmax(fft_result[skip:])
+        return fft_x[skip:][amax], fft_result[skip:][amax]
+
+    @staticmethod
+    def fft(data_block, ch_n, window):
+        fft_x, fft_result = Processing.amplitude(data_block, ch_n, window)
+        max_val_freq, max_val = Processing.peak(fft_x, fft_result)
+        return fft_x[10:], fft_result[10:], max_val_freq, max_val
 
     @staticmethod
     def psd(data_block, ch_n, window='hanning'):
-        x, y = signal.csd(data_block.data[ch_n], data_block.data[ch_n],
-                          ADC.fpga_output_rate,
-                          nperseg=len(data_block.data[ch_n])/4,
-                          window=window)
+        nperseg = len(data_block.data[ch_n]) // 4
+        x, y = Processing.cross_density(data_block, ch_n, ch_n, window, nperseg)
         return x, y, 0, 0
 
     @staticmethod
-    def csd(data_block, ch_1, ch_2, window='hanning'):
-        ch1_data, ch2_data = data_block.data[ch_1], data_block.data[ch_2]
-        x, y = signal.csd(ch1_data, ch2_data, ADC.fpga_output_rate,
-                          window=window)
+    def csd(data_block, ch_1, ch_2, window='hanning', nperseg=256):
+        x, y = Processing.cross_density(data_block, ch_1, ch_2, window, nperseg)
         return x, y, 0, 0
 
-    def get_fft(data):
-        fft_x = np.fft.rfftfreq(len(data), d=1 / ADC.fpga_output_rate)
-        fft_result = np.abs(np.fft.rfft(data))
-        return fft_x, fft_result
 
-    @staticmethod
-    def H(data_block, ch_1, ch_2, window='hanning'):
-        ch1_data, ch2_data = data_block.data[ch_1], data_block.data[ch_2]
+def power(X):
+    '''
+    |X|**2 as float32
+    '''
+    return (X.real * X.real + X.imag * X.imag).astype(np.float32, copy=False)
+
+
+class Averager:
+    '''
+    Incremental average of a sequence of equal shape arrays (spectra).
+    Each update() is O(1) in depth.
+
+    mode 'linear': mean of the last depth arrays, from a ring of them and
+                   a running sum.
+    mode 'exponential': exponential moving average with time constant of
+                        depth updates.  Linear until depth are seen.
+    mode 'peak': element-wise maximum (peak hold).  Real arrays only.
+    '''
+    modes = ('linear', 'exponential', 'peak')
+
+    def __init__(self, mode='linear', depth=16):
+        if mode not in self.modes:
+            raise ValueError('Unknown averaging mode {}'.format(mode))
+        self.mode = mode
+        self.depth = max(1, int(depth))
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self._acc = None
+        self._ring = None
 
-        x, fft1 = Processing.get_fft(ch1_data)
-        x, fft2 = Processing.get_fft(ch2_data)
+    def update(self, x):
+        '''
+        Add x.
+        :returns: The average so far, a new array.
+        '''
+        if self._acc is None or self._acc.shape != x.shape:
+            self.count = 0
+            if self.mode == 'linear':
+                # wide running sum, so add/subtract does not drift
+                wide = np.complex128 if np.iscomplexobj(x) else np.float64
+                self._acc = np.zeros(x.shape, wide)
+                self._ring = np.zeros((self.depth,) + x.shape, x.dtype)
+            else:
+                self._acc = np.zeros(x.shape, x.dtype)
 
-        count = Processing.H_stack_count[ch_1] % Processing.stack_n
+        if self.mode == 'linear':
+            slot = self._ring[self.count % self.depth]
+            if self.count >= self.depth:
+                self._acc -= slot
+            slot[...] = x
+            self._acc += x
+            self.count += 1
+            return (self._acc / min(self.count, self.depth)).astype(x.dtype)
 
-        if count == 0:
-            Processing.stacked_H[ch_1] = fft1
-            Processing.stacked_H[ch_2] = fft2
+        if self.count == 0:
+            self._acc[...] = x
+        elif self.mode == 'peak':
+            np.maximum(self._acc, x, out=self._acc)
         else:
-            Processing.stacked_H[ch_1] += fft1
-            Processing.stacked_H[ch_2] += fft2
-        Processing.H_stack_count[ch_1] += 1
-        return (x[10:],
-                (Processing.stacked_H[ch_1][10:] /
-                 Processing.stacked_H[ch_2][10:]),
-                0,
-                0)
+            alpha = 1 / min(self.count + 1, self.depth)
+            self._acc += alpha * (x - self._acc)
+        self.count += 1
+        return self._acc.copy()
+
+
+class SpectrumAverage:
+    '''
+    Subscription giving the averaged magnitude spectrum of one channel:
+    (frequencies, magnitude, frequency of peak, peak)
+
+    Power spectra are averaged (or peak held), from the whole DataBlock,
+    or from Welch segments of nperseg points with the given overlap
+    fraction.  With vector=True, complex spectra are averaged instead,
+    which keeps only signals coherent with the acquisition.
+    Magnitudes are scaled as Processing.amplitude().
+    '''
+    def __init__(self, ch_n, window='hanning', mode='peak', depth=16,
+                 nperseg=None, overlap=0.5, vector=False):
+        self.ch_n = ch_n
+        self.window = window
+        self.nperseg = nperseg
+        self.overlap = overlap
+        self.vector = vector
+        self.averager = Averager(mode, depth)
+
+    def reset(self):
+        self.averager.reset()
+
+    def _segments(self, data_block, ch_n):
+        noverlap = None
+        if self.nperseg is not None:
+            noverlap = int(self.nperseg * self.overlap)
+        X = data_block.spectrum(ch_n, self.window, self.nperseg, noverlap)
+        # FFT length
+        n = self.nperseg if X.ndim == 2 else len(data_block.data[ch_n])
+        return n, X
+
+    def __call__(self, data_block):
+        n, X = self._segments(data_block, self.ch_n)
+        _w, s1, _s2 = get_window(self.window, n)
+        if self.vector:
+            if X.ndim == 2:
+                X = X.mean(axis=0)
+            y = np.abs(self.averager.update(X))
+        else:
+            P = power(X)
+            if P.ndim == 2:
+                P = P.mean(axis=0, dtype=np.float32)
+            y = np.sqrt(self.averager.update(P))
+        y *= n / s1
+        fft_x = rfft_freqs(n, ADC.fpga_output_rate)
+        max_val_freq, max_val = Processing.peak(fft_x, y)
+        return fft_x[10:], y[10:], max_val_freq, max_val
+
+
+class CrossSpectrumAverage(SpectrumAverage):
+    '''
+    Subscription giving averaged cross spectra of two channels:
+    (frequencies, y, 0, 0)
+
+    kind 'csd': cross spectral density of ch_1 and ch_2.
+    kind 'H': magnitude of the transfer function from ch_2 to ch_1,
+              H1 estimate, averaged conj(X2)*X1 / averaged |X2|**2.
+    Averaging mode 'linear' or 'exponential'.
+    '''
+    def __init__(self, ch_1, ch_2, kind='csd', window='hanning',
+                 mode='linear', depth=16, nperseg=None, overlap=0.5):
+        if mode == 'peak':
+            raise ValueError('No peak hold of cross spectra')
+        SpectrumAverage.__init__(self, ch_1, window=window, mode=mode,
+                                 depth=depth, nperseg=nperseg,
+                                 overlap=overlap)
+        self.ch_2 = ch_2
+        self.kind = kind
+        self.auto = Averager(mode, depth)
+
+    def reset(self):
+        self.averager.reset()
+        self.auto.reset()
+
+    def __call__(self, data_block):
+        n, X1 = self._segments(data_block, self.ch_n)
+        _n, X2 = self._segments(data_block, self.ch_2)
+        Pxy = np.conj(X2) * X1 if self.kind == 'H' else np.conj(X1) * X2
+        if Pxy.ndim == 2:
+            Pxy = Pxy.mean(axis=0)
+        Sxy = self.averager.update(Pxy)
+        fft_x = rfft_freqs(n, ADC.fpga_output_rate)
+        if self.kind == 'H':
+            P2 = power(X2)
+            if P2.ndim == 2:
+                P2 = P2.mean(axis=0, dtype=np.float32)
+            S22 = self.auto.update(P2)
+            y = np.abs(Sxy) / np.maximum(S22, np.finfo(np.float32).tiny)
+            return fft_x[10:], y[10:], 0, 0
+        return fft_x, Processing.density_scale(Sxy, n, self.window), 0, 0
+
+
+class BlockRing:
+    '''
+    Bounded ring of the latest DataBlocks, from one producer (the
+    acquisition thread) to any number of consumers.
+
+    put() stamps each block with a sequence number, block.seq.
+    Each consumer reads through its own Reader, seeing every block in
+    order, or with latest=True only the newest.  Blocks a reader misses
+    are counted in its dropped.
+
+    Back-pressure: put() waits, up to timeout, before overwriting a block
+    which a Reader(blocking=True) has not read yet.  After the timeout
+    the block is overwritten anyway, and counted in overruns.
+
+    latest() takes no lock.
+    '''
+    def __init__(self, capacity=8, timeout=1.0):
+        self.capacity = capacity
+        self.timeout = timeout
+        self.seq = 0  # of the next block
+        self.overruns = 0
+        self._slots = [None] * capacity
+        self._readers = []
+        self._cv = threading.Condition()
+
+    def reader(self, blocking=False, latest=False):
+        R = Reader(self, blocking, latest)
+        with self._cv:
+            self._readers.append(R)
+        return R
+
+    def put(self, block):
+        with self._cv:
+            # sequence number of the block about to be overwritten
+            oldest = self.seq - self.capacity
+            deadline = time.monotonic() + self.timeout
+            while any(R.blocking and R.next <= oldest for R in self._readers):
+                remain = deadline - time.monotonic()
+                if remain <= 0:
+                    self.overruns += 1
+                    break
+                self._cv.wait(remain)
+            block.seq = self.seq
+            self._slots[self.seq % self.capacity] = block
+            self.seq += 1
+            self._cv.notify_all()
+
+    def latest(self):
+        '''
+        Newest block, or None.  Does not wait.
+        '''
+        seq = self.seq
+        return self._slots[(seq - 1) % self.capacity] if seq else None
+
+
+class Reader:
+    '''
+    A consumer of a BlockRing.  See BlockRing.reader()
+    '''
+    def __init__(self, ring, blocking=False, latest=False):
+        self.ring = ring
+        self.blocking = blocking
+        self.latest = latest
+        self.next = ring.seq  # sequence number of the next block to read
+        self.dropped = 0
+
+    def get(self, timeout=None):
+        '''
+        Wait for, and return, the next block.  None on timeout.
+        '''
+        ring = self.ring
+        with ring._cv:
+            if not ring._cv.wait_for(lambda: ring.seq > self.next, timeout):
+                return None
+            if self.latest:
+                seq = ring.seq - 1
+            else:
+                seq = max(self.next, ring.seq - ring.capacity)
+            self.dropped += seq - self.next
+            block = ring._slots[seq % ring.capacity]
+            self.next = seq + 1
+            # a producer may be waiting for this reader
+            ring._cv.notify_all()
+        return block
+
+    def close(self):
+        with self.ring._cv:
+            self.ring._readers.remove(self)
+            self.ring._cv.notify_all()
+
+
+def minmax_decimate(x, y, ncols):
+    '''
+    Reduce a trace to the min and max of y in each of ncols columns
+    (screen pixels), which draws the same as the full trace.
+    :returns: x, y of 2 * ncols points, or the inputs when no longer.
+    '''
+    n = len(y)
+    if ncols <= 0 or n <= 2 * ncols:
+        return x, y
+    edges = np.linspace(0, n, ncols + 1).astype(np.intp)[:-1]
+    out_x = np.repeat(np.asarray(x)[edges], 2)
+    out_y = np.empty(2 * ncols, dtype=np.result_type(y))
+    if np.iscomplexobj(y):
+        y = np.abs(y)
+        out_y = out_y.real
+    out_y[0::2] = np.minimum.reduceat(y, edges)
+    out_y[1::2] = np.maximum.reduceat(y, edges)
+    return out_x, out_y
+
+
+class PostProcessor:
+    '''
+    Runs the subscriptions of a carrier on each new DataBlock,
+    in parallel on a pool of worker threads, off the acquisition thread.
+
+    FFTs release the GIL, and each channel's spectrum is computed once
+    per DataBlock (see DataBlock.spectrum()), so subscriptions to
+    different channels proceed concurrently.  Stateful subscriptions
+    (those with a reset(), eg. SpectrumAverage) run one after another
+    in a single job, never two at once.
+
+    Reads the newest block from carrier.ring, never holding up
+    acquisition.  Blocks skipped while processing falls behind are
+    counted in dropped.  Results are stored as
+    carrier.results[sub_id] = (block sequence number, result).
+    '''
+    def __init__(self, carrier, workers=None):
+        self.carrier = carrier
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count() or 4,
+                                       thread_name_prefix='oscope-proc')
+        self.reader = carrier.ring.reader(latest=True)
+        self._reset = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True,
+                                        name='oscope-dispatch')
+        self._thread.start()
+
+    @property
+    def dropped(self):
+        return self.reader.dropped
+
+    def reset(self):
+        '''
+        Restart the averages of all stateful subscriptions, before
+        the next block.  Safe from any thread.
+        '''
+        self._reset.set()
+
+    def _loop(self):
+        while True:
+            self.process(self.reader.get())
+
+    def process(self, data_block):
+        carrier = self.carrier
+        if self._reset.is_set():
+            # none of them is running between blocks
+            self._reset.clear()
+            for _single, fn, *_args in list(carrier.subscriptions.values()):
+                if hasattr(fn, 'reset'):
+                    fn.reset()
+        jobs, stateful = [], []
+        for sub_id, (single_subscribe, fn, *fn_args) in list(carrier.subscriptions.items()):
+            if hasattr(fn, 'reset'):
+                stateful.append((sub_id, single_subscribe, fn, fn_args))
+                continue
+            jobs.append((sub_id, single_subscribe,
+                         self.pool.submit(fn, data_block, *fn_args)))
+        if stateful:
+            # one after another, as they may share state
+            chain = self.pool.submit(_run_serial, data_block, stateful)
+            jobs.extend((sub_id, single_subscribe, job)
+                        for (sub_id, single_subscribe, _fn, _args), job
+                        in zip(stateful, chain.result()))
+        for sub_id, single_subscribe, job in jobs:
+            try:
+                carrier.results[sub_id] = (data_block.seq, job.result())
+            except Exception:
+                Logger.exception('Subscription {} failed'.format(sub_id))
+            if single_subscribe and sub_id in carrier.subscriptions:
+                carrier.remove_subscription(sub_id)
+
+
+def _run_serial(data_block, subs):
+    '''
+    Run subscriptions in order.
+    :returns: a done Future of the result of each
+    '''
+    done = []
+    for _sub_id, _single, fn, fn_args in subs:
+        fut = Future()
+        try:
+            fut.set_result(fn(data_block, *fn_args))
+        except Exception as e:
+            fut.set_exception(e)
+        done.append(fut)
+    return done
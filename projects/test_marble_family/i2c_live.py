@@ -2,6 +2,7 @@ from time import sleep
 import sys
 sys.path.append("bedrock/peripheral_drivers/i2cbridge")
 sys.path.append("bedrock/badger")
+sys.path.append("bedrock/projects/common")
 import lbus_access
 from c2vcd import produce_vcd
 
@@ -4,6 +4,7 @@ import sys
 import os
 import time
 sys.path.append(os.path.join(os.path.dirname(__file__), "../../badger"))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../common"))
 from lbus_access import lbus_access
 
 
@@ -3,6 +3,7 @@ import sys
 bedrock_dir = "../../"
 sys.path.append(bedrock_dir + "peripheral_drivers/i2cbridge")
 sys.path.append(bedrock_dir + "badger")
+sys.path.append(bedrock_dir + "projects/common")
 import lbus_access
 from c2vcd import produce_vcd
 from fmc_test_l import fmc_decode
@@ -1,9 +1,8 @@
 import socket
-import struct
 import time
 
 from multiprocessing import Process
-from functools import reduce
+from threading import Thread
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -11,13 +10,17 @@ from matplotlib import pyplot as plt
 from litex import RemoteClient
 from liteeth.common import convert_ip
 
+from receiver import Receiver
+from recorder import Recorder, open_output
+
 # np.set_printoptions(threshold=sys.maxsize)
 
 
 def trigger_hardware(n_points, cap_ip, cap_port,
-                    csr_csv = None):
-    wb = RemoteClient(csr_csv=csr_csv)
-    wb.open()
+                    csr_csv = None, wb=None):
+    if wb is None:
+        wb = RemoteClient(csr_csv=csr_csv)
+        wb.open()
 
     # Try communication a few times before giving up
     try_list = range(0, 3)
@@ -51,30 +54,7 @@ def trigger_hardware(n_points, cap_ip, cap_port,
                 continue
         else:
             break
-
-
-def recvall(sock, n_points=1024 * 1024):
-    BUFF_SIZE = n_points * 8 * 2   # 1M points from 8 ADCs each 2 bytes wide
-    yet_to_rx = BUFF_SIZE
-    data = []
-    total_len = 0
-    packet_cnt = 0
-    while True:
-        if yet_to_rx > 1464:
-            ask = 1472
-        else:
-            ask = yet_to_rx + 8
-        part, _ = sock.recvfrom(ask)
-        data.append(part)
-        total_len += len(part) - 8
-        yet_to_rx -= len(part) - 8
-        if total_len >= BUFF_SIZE:
-            # either 0 or end of data
-            break
-        packet_cnt += 1
-
-    print(f'time-rx-complete {time.time()}\npackets-received {len(data)}\nbytes-received {total_len}')
-    return data
+    return triggered_at
 
 
 def capture(ip, port, plot_n, n_points, to_file="dump.bin"):
@@ -82,24 +62,17 @@ def capture(ip, port, plot_n, n_points, to_file="dump.bin"):
     sock.bind((ip, port))
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 * 16)
     print(sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
-    data = recvall(sock, n_points)
-    ids = [struct.unpack(f'>{2}I', p[:8])[1] for p in data]
-
-    # Checking no packets went missing
-    print("checking no packets gone missing")
-    for i, j in zip(ids[:-1], ids[1:]):
-        if i + 1 != j:
-            print(i, j)
-            print("ERROR: Missing packets")
-
-    print("splicing ..")
-    D = reduce(lambda x, y: x+y, [p[8:] for p in data])
-    x = len(D)//2
-
-    print("unpacking ..")
-    D = struct.unpack(f'<{x}h', D)
-    D = np.array(D, np.dtype(np.int16))
-    D = np.reshape(D, (-1, 8))
+    # straight to the file, if any
+    out = None if to_file is None else open_output(to_file, (n_points, 8))
+    rx = Receiver(sock, n_points, out=out)
+    # no resend: DataPipe can't send some fragments again, so losses are gaps
+    rx.run()
+    print(rx.summary())
+    result = rx.result()
+    D = result.data  # (n_points, 8) int16, no copies
+
+    for start, stop in result.gaps:
+        print(f"ERROR: Missing samples [{start}, {stop})")
 
     print("plotting ..")
     if plot_n != 0:
@@ -107,9 +80,48 @@ def capture(ip, port, plot_n, n_points, to_file="dump.bin"):
             plt.plot(D[:, i][:plot_n])
         plt.show()
 
-    print(f"dumping to {to_file} ..")
     if to_file is not None:
-        D.tofile(to_file)
+        print(f"flushing {to_file} ..")
+        D.flush()
+    return result
+
+
+def _receive(rx, errors):
+    # until the board sends, however long arming takes
+    try:
+        rx.run(first_timeout=None)
+    except Exception as e:
+        errors.append(e)
+
+
+def stream(ip, port, n_points, directory, triggers=None, per_file=16,
+           keep=None, fmt="npy", csr_csv=None):
+    '''
+    Trigger and capture repeatedly (forever, if triggers is None)
+    into a rolling set of files in directory.  See recorder.Recorder
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((ip, port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 * 16)
+    wb = RemoteClient(csr_csv=csr_csv)
+    wb.open()
+    rec = Recorder(directory, n_points, per_file=per_file, keep=keep, fmt=fmt)
+    try:
+        while triggers is None or rec.count < triggers:
+            rx = Receiver(sock, n_points, out=rec.next())
+            errors = []
+            # daemon: if arming fails, nothing arrives to end the receive
+            t = Thread(target=_receive, args=(rx, errors), daemon=True)
+            t.start()
+            triggered_at = trigger_hardware(n_points, ip, port, wb=wb)
+            t.join()
+            if errors:
+                raise errors[0]
+            entry = rec.record(rx, triggered_at)
+            print(f"capture {rec.count} -> {entry['file']}[{entry['slot']}], {len(entry['gaps'])} gaps")
+    finally:
+        rec.close()
+        wb.close()
 
 
 def main():
@@ -124,6 +136,12 @@ def main():
                         "get stored as there are 8 ADC channels in zest)")
     parser.add_argument("--to-file", default="dump.bin", help="dump data to file")
     parser.add_argument("--from-file", default="", help="plot data from file; No capture in this case")
+    parser.add_argument("--stream-dir", default="",
+                        help="capture repeatedly into rolling files in this directory")
+    parser.add_argument("--triggers", default=None, type=int, help="number of captures to stream (default forever)")
+    parser.add_argument("--per-file", default=16, type=int, help="captures per streamed file")
+    parser.add_argument("--keep", default=None, type=int, help="keep only the newest N streamed files")
+    parser.add_argument("--format", default="npy", choices=["npy", "raw"], help="streamed file format")
     cmd_args = parser.parse_args()
     if cmd_args.from_file != "":
         D = np.fromfile(cmd_args.from_file, dtype=np.int16)
@@ -133,6 +151,10 @@ def main():
         for i in range(8):
             plt.plot(D[:, i][:int(cmd_args.plot_n)])
         plt.show()
+    elif cmd_args.stream_dir != "":
+        stream(cmd_args.ip, cmd_args.port, cmd_args.fifo_size, cmd_args.stream_dir,
+               triggers=cmd_args.triggers, per_file=cmd_args.per_file,
+               keep=cmd_args.keep, fmt=cmd_args.format)
     else:
         fifo_size = cmd_args.fifo_size
         p = Process(target=capture,
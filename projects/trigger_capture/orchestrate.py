@@ -0,0 +1,182 @@
+'''
+Capture from several trigger_capture boards at once.
+
+Each board sends to its own UDP port on this host, and is received by a
+worker process (see receiver.Receiver), straight into a memory-mapped
+<directory>/<name>.npy.  Once all workers listen, every board is armed
+in parallel with trigger_hardware(), each over its own litex_server
+connection.  Captures are aligned by the time each board was triggered.
+
+That alignment is approximate.  The trigger time of a board is the host
+clock (time.time()) once the Etherbone write which arms it returns, in
+its own thread and litex_server connection.  It is off by the write
+latency and its jitter, typically milliseconds, ie. many thousands of
+samples.  There is no hardware timestamp or shared counter to do better.
+
+$ python orchestrate.py --ip 192.168.1.114 --fifo-size 1048576 \
+      a=7778@localhost:1234 b=7779@localhost:1235
+'''
+import dataclasses
+import json
+import multiprocessing
+import os
+import queue
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from litex import RemoteClient
+
+from capture import trigger_hardware
+from receiver import N_ADC, Receiver
+from recorder import open_output
+
+
+@dataclasses.dataclass
+class Board:
+    name: str
+    port: int  # UDP port on this host the board sends to
+    wb_host: str = 'localhost'  # its litex_server
+    wb_port: int = 1234
+    csr_csv: str = None
+
+    @classmethod
+    def parse(cls, spec):
+        '''
+        NAME=PORT[@WB_HOST:WB_PORT]
+        '''
+        name, _, rest = spec.partition('=')
+        port, _, wb = rest.partition('@')
+        board = cls(name, int(port))
+        if wb:
+            host, _, wb_port = wb.rpartition(':')
+            board.wb_host, board.wb_port = host or board.wb_host, int(wb_port)
+        return board
+
+
+def _receive(ip, board, n_points, path, timeout, ready, results):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((ip, board.port))
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024 * 16)
+    out = open_output(path, (n_points, N_ADC))
+    rx = Receiver(sock, n_points, out=out, timeout=timeout)
+    ready.set()
+    # until the board is armed, however long that takes; losses are
+    # left as gaps (no resend, see receiver)
+    rx.run(first_timeout=None)
+    out.flush()
+    results.put((board.name, {
+        'file': path,
+        'capture': rx.capture,
+        'packets': rx.packets,
+        'complete': bool(rx.complete),
+        'gaps': rx.gaps().tolist(),
+    }))
+
+
+def _arm(ip, board, n_points):
+    wb = RemoteClient(host=board.wb_host, port=board.wb_port, csr_csv=board.csr_csv)
+    wb.open()
+    try:
+        return trigger_hardware(n_points, ip, board.port, wb=wb)
+    finally:
+        wb.close()
+
+
+def capture_all(ip, boards, n_points, directory, timeout=5.0, sample_rate=None):
+    '''
+    Capture n_points from each of boards, received on ip.
+
+    :returns: dict of board name to a dict of file, capture counter,
+              triggered_at, offset (seconds after the first trigger;
+              and in samples, with sample_rate), gaps, ...
+              triggered_at and offset are host clock times, approximate
+              to milliseconds.  See the module docstring.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    results = multiprocessing.Queue()
+    workers = []
+    for board in boards:
+        ready = multiprocessing.Event()
+        path = os.path.join(directory, f'{board.name}.npy')
+        p = multiprocessing.Process(target=_receive, name=f'capture-{board.name}',
+                                    args=(ip, board, n_points, path, timeout, ready, results))
+        p.start()
+        workers.append((p, ready))
+    for p, ready in workers:
+        if not ready.wait(timeout):
+            raise RuntimeError(f'{p.name} did not start')
+
+    captures = {}
+    try:
+        with ThreadPoolExecutor(len(boards)) as pool:
+            triggered = list(pool.map(lambda b: _arm(ip, b, n_points), boards))
+        for _ in workers:
+            name, info = results.get(timeout=timeout + 1.0)
+            captures[name] = info
+    except queue.Empty:
+        pass
+    finally:
+        for p, _ in workers:
+            if p.is_alive() and p.name[len('capture-'):] not in captures:
+                p.terminate()  # nothing received, or arming failed
+            p.join()
+    missing = [b.name for b in boards if b.name not in captures]
+    if missing:
+        raise RuntimeError(f'Nothing received from {", ".join(missing)}')
+
+    t0 = min(triggered)
+    for board, t in zip(boards, triggered):
+        info = captures[board.name]
+        info['triggered_at'] = t
+        info['offset'] = t - t0
+        if sample_rate is not None:
+            info['offset_samples'] = int(round((t - t0) * sample_rate))
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(captures, f, indent=1)
+    return captures
+
+
+def align(captures):
+    '''
+    Views of the captures over the time they have in common,
+    using offset_samples (see capture_all(sample_rate=...)).
+    Only as good as the host clock trigger times, so approximate to
+    milliseconds worth of samples.  See the module docstring.
+    :returns: dict of board name to (n, 8) int16 array
+    '''
+    missing = [name for name, info in captures.items() if 'offset_samples' not in info]
+    if missing:
+        raise ValueError(f'No offset_samples for {", ".join(missing)}: '
+                         'capture_all() needs sample_rate to align')
+    data = dict((name, np.load(info['file'], mmap_mode='r'))
+                for name, info in captures.items())
+    last = max(info['offset_samples'] for info in captures.values())
+    start = dict((name, last - info['offset_samples']) for name, info in captures.items())
+    n = min(len(data[name]) - start[name] for name in data)
+    return dict((name, D[start[name]:start[name] + n]) for name, D in data.items())
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Capture buffers from several boards")
+    parser.add_argument("--ip", default="192.168.1.114", help="capture host ip")
+    parser.add_argument("--fifo-size", default=1024*1024, type=int,
+                        help="Number of ADC channel data points to store, per board")
+    parser.add_argument("--dir", default="captures", help="directory for the captures")
+    parser.add_argument("--timeout", default=5.0, type=float, help="receive timeout (seconds)")
+    parser.add_argument("--sample-rate", default=None, type=float,
+                        help="ADC sample rate, to align captures (approximately, by host clock trigger times)")
+    parser.add_argument("boards", nargs="+", metavar="NAME=PORT[@WB_HOST:WB_PORT]",
+                        help="board, the UDP port it sends to, and its litex_server")
+    cmd_args = parser.parse_args()
+    captures = capture_all(cmd_args.ip, [Board.parse(b) for b in cmd_args.boards],
+                           cmd_args.fifo_size, cmd_args.dir,
+                           timeout=cmd_args.timeout, sample_rate=cmd_args.sample_rate)
+    for name, info in captures.items():
+        print(f"{name}: {info['file']} offset {info['offset']:.6f} s, {len(info['gaps'])} gaps")
+
+
+if __name__ == "__main__":
+    main()
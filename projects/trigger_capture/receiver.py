@@ -0,0 +1,313 @@
+'''
+Receive the buffer DataPipe sends, straight into a numpy array.
+
+UDPFragmenter splits the buffer into UDP datagrams, each an 8 byte header
+of two big-endian words (capture counter, fragment id) followed by up to
+FRAGMENT bytes of payload.  Fragment i holds bytes [i * FRAGMENT, ...) of
+the buffer, so its payload is received (scatter read) directly at that
+offset, guessing the id from the last fragment received.  Only fragments
+arriving out of order are moved afterwards.
+
+On Linux, recvmmsg() receives up to batch datagrams per system call.
+Elsewhere, one recvmsg_into() per datagram.
+
+Fragments may arrive in any order.  Duplicates are discarded.  So are
+fragments of an earlier capture (counter), once one of a newer capture
+arrives.  Lost fragments are reported in the
+result as gaps, and with a mask of the valid samples of each channel.
+
+Lost fragments are only reported, not recovered: DataPipe cannot send a
+range of fragments again.  Its fifo_read sends the whole buffer, and
+fifo_load refills it from the ADCs, so capture.py and orchestrate.py
+call run() without resend.  The resend hook of run() is there for a
+sender which can.
+'''
+import ctypes
+import dataclasses
+import errno
+import os
+import select
+import sys
+import time
+
+import numpy as np
+
+HEADER = 8
+FRAGMENT = 1472 - HEADER  # UDPFragmenter.UDP_FRAG_MTU
+N_ADC = 8
+
+header_dtype = np.dtype([('capture', '>u4'), ('fragment', '>u4')])
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [('base', ctypes.c_void_p), ('len', ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [('name', ctypes.c_void_p), ('namelen', ctypes.c_uint32),
+                ('iov', ctypes.POINTER(_iovec)), ('iovlen', ctypes.c_size_t),
+                ('control', ctypes.c_void_p), ('controllen', ctypes.c_size_t),
+                ('flags', ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [('hdr', _msghdr), ('len', ctypes.c_uint)]
+
+
+MSG_DONTWAIT = 0x40
+
+
+def _find_recvmmsg():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        fn = ctypes.CDLL(None, use_errno=True).recvmmsg
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint,
+                   ctypes.c_int, ctypes.c_void_p]
+    fn.restype = ctypes.c_int
+    return fn
+
+
+_recvmmsg = _find_recvmmsg()
+
+
+@dataclasses.dataclass
+class CaptureResult:
+    data: np.ndarray  # (n_points, N_ADC) int16
+    valid: np.ndarray  # (n_points, N_ADC) bool, False where lost
+    gaps: np.ndarray  # (n_gaps, 2) [start, stop) rows with lost samples
+    lost: np.ndarray  # (n_fragments,) bool, the loss bitmap
+    capture: int  # counter of the DataPipe capture
+
+    @property
+    def complete(self):
+        return not self.lost.any()
+
+
+def _runs(mask):
+    '''
+    :returns: (n, 2) array of [start, stop) of the runs of True in mask
+    '''
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.stack((np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)), axis=1)
+
+
+def fill_gaps(result):
+    '''
+    Linearly interpolate each channel across its lost samples.
+    :returns: A float array shaped like result.data
+    '''
+    out = result.data.astype(float)
+    x = np.arange(len(out))
+    for ch in range(out.shape[1]):
+        ok = result.valid[:, ch]
+        if ok.any() and not ok.all():
+            out[~ok, ch] = np.interp(x[~ok], x[ok], out[ok, ch])
+    return out
+
+
+class Receiver:
+    '''
+    Receive one buffer of n_points samples of each of N_ADC channels
+    from sock.  After run(), self.data is the (n_points, N_ADC) int16
+    array, and self.received marks the fragments which arrived.
+
+    :param out: Optional (n_points, N_ADC) int16 array to receive into,
+                eg. a numpy.memmap (see recorder.Recorder).
+    '''
+    def __init__(self, sock, n_points, batch=64, timeout=5.0, out=None):
+        self.sock = sock
+        self.batch = batch if _recvmmsg is not None else 1
+        self.timeout = timeout
+        self.nbytes = n_points * N_ADC * 2
+        self.n_fragments = -(-self.nbytes // FRAGMENT)
+        if out is None:
+            out = np.zeros((n_points, N_ADC), '<i2')
+        assert out.nbytes == self.nbytes and out.flags.c_contiguous
+        self.data = out
+        self._out = out.reshape(-1).view(np.uint8)
+        # one fragment per batch entry, for datagrams whose guessed place
+        # is already taken, or would overrun out
+        self._scratch = np.zeros(self.batch * FRAGMENT, np.uint8)
+        self._whole = self.nbytes // FRAGMENT  # fragments which fit whole
+        self.received = np.zeros(self.n_fragments, bool)
+        self.headers = np.zeros(self.batch, header_dtype)
+        self.packets = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.stale = 0  # fragments of another capture
+        self.capture = None  # counter of the capture being received
+        self._next = 0  # guess of the next fragment id
+        if _recvmmsg is not None:
+            self._iov = (_iovec * (2 * self.batch))()
+            self._msgs = (_mmsghdr * self.batch)()
+            for k in range(self.batch):
+                self._iov[2 * k].base = self.headers.ctypes.data + k * HEADER
+                self._iov[2 * k].len = HEADER
+                self._iov[2 * k + 1].len = FRAGMENT
+                self._msgs[k].hdr.iov = ctypes.pointer(self._iov[2 * k])
+                self._msgs[k].hdr.iovlen = 2
+
+    @property
+    def complete(self):
+        return self.received.all()
+
+    def _slots(self, n):
+        '''
+        Where to receive the payloads of the next n datagrams:
+        the guessed fragment if it is still missing, else scratch.
+        '''
+        slots = np.arange(self._next, self._next + n)
+        taken = slots >= self._whole
+        taken[~taken] = self.received[slots[~taken]]
+        slots[taken] = self.n_fragments + np.flatnonzero(taken)
+        return slots
+
+    def _view(self, slot):
+        if slot < self.n_fragments:
+            return self._out[slot * FRAGMENT:][:FRAGMENT]
+        return self._scratch[(slot - self.n_fragments) * FRAGMENT:][:FRAGMENT]
+
+    def _recv_batch(self):
+        slots = self._slots(self.batch)
+        for k, slot in enumerate(slots):
+            self._iov[2 * k + 1].base = self._view(slot).ctypes.data
+        n = _recvmmsg(self.sock.fileno(), self._msgs, self.batch, MSG_DONTWAIT, None)
+        if n < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return slots, np.zeros(0, int)
+            raise OSError(err, os.strerror(err))
+        lengths = np.array([self._msgs[k].len for k in range(n)])
+        return slots[:n], lengths
+
+    def _recv_one(self):
+        slot = self._slots(1)
+        payload = self._view(slot[0])
+        try:
+            nbytes, _, _, _ = self.sock.recvmsg_into(
+                [self.headers.view(np.uint8)[:HEADER], payload])
+        except BlockingIOError:
+            return slot, np.zeros(0, int)
+        return slot, np.array([nbytes])
+
+    def _place(self, slots, lengths):
+        '''
+        Account for received datagrams, moving those which
+        did not land on their own fragment.
+        '''
+        n = len(lengths)
+        self.packets += n
+        if not n:
+            return
+        ids = self.headers['fragment'][:n].astype(np.int64)
+        valid = (lengths >= HEADER) & (ids < self.n_fragments)
+        caps = self.headers['capture'][:n].astype(np.int64)
+        if self.capture is None and valid.any():
+            self.capture = int(caps[valid][0])
+        # capture counters wrap at 16 bits: ahead by less than half is newer
+        ahead = (caps - (self.capture or 0)) & 0xffff
+        newer = valid & (ahead > 0) & (ahead < 0x8000)
+        if newer.any():
+            # a later capture has started, leftovers of the earlier are stale
+            self.stale += int(self.received.sum())
+            self.received[:] = False
+            self.capture = int(caps[newer][np.argmax(ahead[newer])])
+        same = caps == self.capture
+        self.stale += int((valid & ~same).sum())
+        valid &= same
+        fast = valid & (ids == slots)
+        self.received[ids[fast]] = True
+        if not fast.all():
+            # copy out first, as a payload may sit where another belongs
+            moves = []
+            for k in np.flatnonzero(valid & ~fast):
+                fid = ids[k]
+                if self.received[fid]:
+                    self.duplicates += 1
+                    continue
+                src = self._view(slots[k])[:lengths[k] - HEADER]
+                moves.append((fid, src.copy()))
+                self.received[fid] = True
+                self.reordered += 1
+            for fid, payload in moves:
+                dst = self._out[fid * FRAGMENT:][:len(payload)]
+                dst[:] = payload[:len(dst)]
+        last = ids[valid]
+        if len(last):
+            self._next = int(last[-1]) + 1
+
+    def lost(self):
+        '''
+        :returns: (n, 2) array of [first, stop) of runs of lost fragments
+        '''
+        return _runs(~self.received)
+
+    def gaps(self):
+        '''
+        :returns: (n, 2) array of [start, stop) of runs of rows (samples)
+                  with data lost on some channel
+        '''
+        row = N_ADC * 2
+        lost = self.lost() * FRAGMENT
+        lost[:, 0] //= row
+        lost[:, 1] = np.minimum(-(-lost[:, 1] // row), len(self.data))
+        return lost
+
+    def run(self, resend=None, retries=2, first_timeout=-1):
+        '''
+        Receive until all fragments have arrived, or none for timeout seconds.
+
+        :param first_timeout: Seconds to wait for the first datagram.
+                              None waits forever.  Default: timeout.
+
+        :param resend: Optional callable(first, count) asking the sender
+                       to send fragments again.  Called for each run of
+                       lost fragments, at most retries times.  DataPipe
+                       has no such request (see the module docstring),
+                       so without it lost fragments are left as gaps.
+        :returns: self.data
+        '''
+        recv = self._recv_batch if _recvmmsg is not None else self._recv_one
+        self.sock.setblocking(False)
+        if first_timeout == -1:
+            first_timeout = self.timeout
+        while not self.complete:
+            timeout = first_timeout if self.packets == 0 else self.timeout
+            if not select.select([self.sock], [], [], timeout)[0]:
+                if resend is None or retries <= 0:
+                    break
+                retries -= 1
+                runs = self.lost()
+                for first, stop in runs:
+                    resend(int(first), int(stop - first))
+                self._next = int(runs[0][0])
+                continue
+            self._place(*recv())
+        return self.data
+
+    def result(self):
+        '''
+        :returns: A CaptureResult, with the gap metadata
+        '''
+        n_points = len(self.data)
+        # int16 samples in each fragment (FRAGMENT is even), the last short
+        counts = np.full(self.n_fragments, FRAGMENT // 2)
+        counts[-1] = n_points * N_ADC - (self.n_fragments - 1) * (FRAGMENT // 2)
+        valid = np.repeat(self.received, counts).reshape(n_points, N_ADC)
+        return CaptureResult(data=self.data, valid=valid,
+                             gaps=self.gaps(),
+                             lost=~self.received,
+                             capture=self.capture)
+
+    def summary(self):
+        missing = self.n_fragments - int(self.received.sum())
+        return (f'time-rx-complete {time.time()}\n'
+                f'packets-received {self.packets}\n'
+                f'bytes-expected {self.nbytes}\n'
+                f'fragments-missing {missing}\n'
+                f'fragments-reordered {self.reordered}\n'
+                f'fragments-duplicate {self.duplicates}\n'
+                f'fragments-stale {self.stale}')
@@ -0,0 +1,96 @@
+'''
+Record repeated captures into a rolling set of memory-mapped files.
+
+Each file holds per_file captures of (n_points, 8) int16 samples, as a
+.npy array shaped (per_file, n_points, 8), or raw.  Data is received
+straight into the mapping (see receiver.Receiver(out=...)), so memory
+use does not grow with the length of a run.  With keep, only the newest
+keep files are kept.
+
+Every capture appends one JSON line to index.jsonl in the directory:
+file, slot, capture counter, trigger and completion times, the runs of
+fragments received, and gaps ([start, stop) rows with lost samples).
+'''
+import json
+import os
+import time
+
+import numpy as np
+
+from receiver import N_ADC, _runs
+
+
+def open_output(path, shape, fmt=None):
+    '''
+    Create a file of int16 samples, memory-mapped.
+    :param fmt: 'npy' (with header) or 'raw'.  Default from the path suffix.
+    '''
+    if fmt is None:
+        fmt = 'npy' if path.endswith('.npy') else 'raw'
+    if fmt == 'npy':
+        return np.lib.format.open_memmap(path, mode='w+', dtype='<i2', shape=shape)
+    return np.memmap(path, mode='w+', dtype='<i2', shape=shape)
+
+
+class Recorder:
+    def __init__(self, directory, n_points, per_file=16, keep=None,
+                 fmt='npy', prefix='capture'):
+        assert fmt in ('npy', 'raw')
+        self.directory = directory
+        self.n_points = n_points
+        self.per_file = per_file
+        self.keep = keep
+        self.fmt = fmt
+        self.prefix = prefix
+        self.count = 0  # captures recorded
+        self.files = []  # oldest first
+        self._map = None
+        os.makedirs(directory, exist_ok=True)
+        self._index = open(os.path.join(directory, 'index.jsonl'), 'a')
+
+    def _open(self):
+        name = f'{self.prefix}_{time.strftime("%Y%m%d_%H%M%S")}_{self.count // self.per_file:06d}.{self.fmt}'
+        path = os.path.join(self.directory, name)
+        self._map = open_output(path, (self.per_file, self.n_points, N_ADC), self.fmt)
+        self.files.append(path)
+        if self.keep is not None:
+            while len(self.files) > self.keep:
+                os.remove(self.files.pop(0))
+
+    def next(self):
+        '''
+        :returns: (n_points, 8) int16 array, in the file, for the next capture
+        '''
+        slot = self.count % self.per_file
+        if slot == 0:
+            self._close_map()
+            self._open()
+        return self._map[slot]
+
+    def record(self, rx, triggered_at=None):
+        '''
+        Index the capture just received into next() by rx, a receiver.Receiver
+        '''
+        entry = {
+            'file': os.path.basename(self.files[-1]),
+            'slot': self.count % self.per_file,
+            'capture': rx.capture,
+            'triggered_at': triggered_at,
+            'received_at': time.time(),
+            'fragments': _runs(rx.received).tolist(),
+            'gaps': rx.gaps().tolist(),
+        }
+        self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        self.count += 1
+        return entry
+
+    def _close_map(self):
+        if self._map is not None:
+            self._map.flush()
+            del self._map
+            self._map = None
+
+    def close(self):
+        self._close_map()
+        self._index.close()
@@ -0,0 +1,110 @@
+'''
+Loopback tests of receiver.Receiver.
+
+$ python3 -m unittest -q test_receiver
+'''
+import socket
+import unittest
+
+import numpy as np
+
+from receiver import FRAGMENT, N_ADC, Receiver, header_dtype
+
+N_POINTS = 1000  # 16000 bytes: 10 whole fragments, and a short last one
+
+
+class TestReceiver(unittest.TestCase):
+    def setUp(self):
+        self.rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.rx_sock.bind(('127.0.0.1', 0))
+        self.tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(self.rx_sock.close)
+        self.addCleanup(self.tx_sock.close)
+        rng = np.random.default_rng(0)
+        self.buf = rng.integers(-2**15, 2**15, (N_POINTS, N_ADC)).astype('<i2')
+        self.rx = Receiver(self.rx_sock, N_POINTS, timeout=0.2)
+
+    def send(self, fragments, capture=1):
+        raw = self.buf.tobytes()
+        for fid in fragments:
+            header = np.array([(capture, fid)], header_dtype).tobytes()
+            self.tx_sock.sendto(header + raw[fid * FRAGMENT:][:FRAGMENT],
+                                self.rx_sock.getsockname())
+
+    def test_in_order(self):
+        n = self.rx.n_fragments
+        self.assertEqual(n, 11)
+        self.send(range(n))
+        self.rx.run()
+        res = self.rx.result()
+        self.assertTrue(res.complete)
+        self.assertTrue(res.valid.all())
+        self.assertEqual(len(res.gaps), 0)
+        np.testing.assert_array_equal(res.data, self.buf)
+        # only the short last fragment, which goes through scratch
+        self.assertEqual(self.rx.reordered, 1)
+
+    def test_reorder(self):
+        order = [1, 0, 10, 2, 3, 5, 4, 9, 8, 7, 6, 3]
+        self.send(order)
+        self.rx.run()
+        res = self.rx.result()
+        self.assertTrue(res.complete)
+        np.testing.assert_array_equal(res.data, self.buf)
+        self.assertGreater(self.rx.reordered, 0)
+        self.assertEqual(self.rx.duplicates, 1)
+
+    def test_loss(self):
+        self.send([0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.rx.run()
+        res = self.rx.result()
+        self.assertFalse(res.complete)
+        np.testing.assert_array_equal(np.flatnonzero(res.lost), [3, 10])
+        row = N_ADC * 2
+        np.testing.assert_array_equal(res.gaps, [
+            [3 * FRAGMENT // row, -(-4 * FRAGMENT // row)],
+            [10 * FRAGMENT // row, N_POINTS]])
+        # exactly the samples of fragments 3 and 10 are invalid
+        lost = np.zeros(N_POINTS * N_ADC, bool)
+        lost[3 * FRAGMENT // 2:4 * FRAGMENT // 2] = True
+        lost[10 * FRAGMENT // 2:] = True
+        np.testing.assert_array_equal(res.valid, ~lost.reshape(N_POINTS, N_ADC))
+        np.testing.assert_array_equal(res.data[res.valid], self.buf[res.valid])
+
+    def test_resend_short_last(self):
+        self.send(range(10))
+        asked = []
+
+        def resend(first, count):
+            asked.append((first, count))
+            self.send(range(first, first + count))
+        self.rx.run(resend=resend)
+        self.assertEqual(asked, [(10, 1)])
+        self.assertTrue(self.rx.complete)
+        np.testing.assert_array_equal(self.rx.data, self.buf)
+
+    def test_stale_capture(self):
+        self.send([0, 1, 2], capture=5)
+        # capture 6 starts, with late fragments of 5 mixed in
+        self.send([0, 1, 2, 3], capture=6)
+        self.send([3, 4], capture=5)
+        self.send(range(4, 11), capture=6)
+        self.rx.run()
+        self.assertEqual(self.rx.capture, 6)
+        self.assertTrue(self.rx.complete)
+        np.testing.assert_array_equal(self.rx.data, self.buf)
+        self.assertEqual(self.rx.stale, 5)
+
+    def test_stale_capture_wraps(self):
+        self.send([0, 1], capture=0xffff)
+        self.send(range(5), capture=0x10000)  # newer, 0 in 16 bits
+        self.send([2, 3], capture=0xfffe)
+        self.send(range(5, 11), capture=0x10000)
+        self.rx.run()
+        self.assertEqual(self.rx.capture, 0x10000)
+        self.assertTrue(self.rx.complete)
+        self.assertEqual(self.rx.stale, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()